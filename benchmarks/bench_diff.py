@@ -0,0 +1,71 @@
+"""
+followingsの差分計算のベンチマーク
+
+これまでの方法(IDを文字列に変換し、setを2つ作って両方向の差集合を取る)と、
+ソート済みの64bit整数配列のスナップショットとのマージで差分を取る方法を比較する
+
+    python -m benchmarks.bench_diff
+"""
+import random
+import timeit
+import tracemalloc
+from typing import Any, Callable, List, Tuple
+
+from influ_rader.diff import Snapshot
+
+SIZES = [10_000, 100_000]
+CHANGE_RATE = 0.01  # 1回の実行でフォロー/フォロー解除されるユーザの割合
+
+
+def make_followings(size: int, seed: int = 0) -> Tuple[List[int], List[int]]:
+    rng = random.Random(seed)
+    old = rng.sample(range(1, 2**62), size)
+    changes = int(size * CHANGE_RATE)
+    new = old[changes:] + rng.sample(range(1, 2**62), changes)
+    rng.shuffle(new)  # Twitter APIのレスポンスはID順ではない
+    return old, new
+
+
+def legacy_diff(from_twitter: List[int], from_db: List[str]) -> Tuple[List[str], List[str]]:
+    twitter = [str(f) for f in from_twitter]
+    return list(set(twitter) - set(from_db)), list(set(from_db) - set(twitter))
+
+
+def snapshot_diff(from_twitter: List[int], snapshot: Snapshot) -> Tuple[Any, Any]:
+    return snapshot.diff(Snapshot.from_ids(from_twitter))
+
+
+def measure(func: Callable[[], Any], number: int = 5) -> float:
+    return min(timeit.repeat(func, number=1, repeat=number)) * 1000
+
+
+def stored_bytes(factory: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    value = factory()  # noqa: F841
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main() -> None:
+    header = ["size", "list/set [ms]", "snapshot [ms]", "list[str] [KiB]", "snapshot [KiB]"]
+    print(" | ".join(f"{h:>15}" for h in header))
+    for size in SIZES:
+        old, new = make_followings(size)
+        from_db = [str(f) for f in old]
+        snapshot = Snapshot.from_ids(old)
+
+        legacy_added, legacy_removed = legacy_diff(new, from_db)
+        added, removed = snapshot_diff(new, snapshot)
+        assert sorted(int(f) for f in legacy_added) == list(added)
+        assert sorted(int(f) for f in legacy_removed) == list(removed)
+
+        legacy_ms = measure(lambda: legacy_diff(new, from_db))
+        snapshot_ms = measure(lambda: snapshot_diff(new, snapshot))
+        legacy_kib = stored_bytes(lambda: [str(f) for f in old]) / 1024
+        snapshot_kib = stored_bytes(lambda: Snapshot.from_ids(old)) / 1024
+        print(f"{size:>15} | {legacy_ms:>15.2f} | {snapshot_ms:>15.2f} | {legacy_kib:>15.0f} | {snapshot_kib:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
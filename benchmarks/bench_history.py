@@ -0,0 +1,80 @@
+"""
+フォロー履歴の問い合わせのベンチマーク
+
+対象ユーザ数targetsの初回のfollowings(BASELINE)と、毎日のフォロー/フォロー解除をdays日分記録し、
+履歴のコマンドで使う問い合わせの時間を測る
+
+    python -m benchmarks.bench_history --events 2000000
+"""
+import argparse
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from influ_rader.history import FollowHistory
+from influ_rader.tests.fakes import FakeClock
+
+DAY = 24 * 60 * 60
+
+
+def populate(history: FollowHistory, clock: FakeClock, events: int, targets: int, days: int, seed: int) -> None:
+    """
+    イベントの半分をBASELINE、残りを毎日のフォロー/フォロー解除(3:1)にする
+    フォローされるユーザは人気に偏りがあるように選ぶ
+    """
+    rng = random.Random(seed)
+    population = max(events // 4, 1000)
+
+    def pick() -> int:
+        return int(rng.paretovariate(1.2) * 1000) % population
+
+    per_target = events // 2 // targets
+    followings: Dict[int, List[int]] = {t: rng.sample(range(population), per_target) for t in range(targets)}
+    history.record(followings, {}, {})
+    per_day = (events - per_target * targets) // days // targets
+    for _ in range(days):
+        clock.sleep(DAY)
+        added = {t: [pick() for _ in range(per_day * 3 // 4)] for t in range(targets)}
+        removed = {t: followings[t][: per_day - len(added[t])] for t in range(targets)}
+        for t in range(targets):
+            followings[t] = followings[t][len(removed[t]) :] + added[t]
+        history.record(followings, added, removed)
+
+
+def measure(func: Callable[[], object], repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--targets", type=int, default=50)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        clock = FakeClock(now=0.0)
+        history = FollowHistory(f"{directory}/history.sqlite3", clock=clock)
+        start = time.perf_counter()
+        populate(history, clock, args.events, args.targets, args.days, args.seed)
+        print(f"recorded {sum(history.counts().values())} events in {time.perf_counter() - start:.1f} s")
+
+        queries = {
+            "co_followed (7 days, >=3 targets)": lambda: history.co_followed(clock.now - 7 * DAY, 3),
+            "co_followed (30 days, >=3 targets)": lambda: history.co_followed(clock.now - 30 * DAY, 3),
+            "followings_at (30 days ago)": lambda: history.followings_at(0, clock.now - 30 * DAY),
+            "events (7 days)": lambda: history.events(0, clock.now - 7 * DAY),
+        }
+        for name, query in queries.items():
+            print(f"{name:>36} | {measure(query):>10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+diffパイプライン全体(スケジュール→事前チェック→following取得→差分→保存→再スケジュール→投稿)のオフラインベンチマーク
+
+Twitter API・Firestore・Discordのチャンネルは偽物(tests.fakesのフェイクと投稿を記録するだけのチャンネル)を使うので、
+ネットワークにも認証情報にも依存せずCIで実行できる
+レート制限による待機は時計を進めるだけで実際には待たず、待つはずだった時間を別に集計する
+
+TwitterCogの各フェーズ(PHASE_SECONDSで計測している区間)と、キューに入れたDiscordへの投稿を送り終えるまで(send)について、
+実時間・ピークメモリ(tracemallocで計測した増分)・Twitter APIのリクエスト数・DBの操作数(FirestoreのRPC/SQLiteの文)・
+レート制限による待ち時間を出力する
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --targets 100 --followings 50000 --backend sqlite
+    python -m benchmarks.bench_pipeline --record fixture.json  # 生成したフィクスチャを保存する
+    python -m benchmarks.bench_pipeline --fixture fixture.json  # 記録したフィクスチャで実行する
+    python -m benchmarks.bench_pipeline --json result.json --baseline benchmarks/pipeline_baseline.json
+
+--baselineを指定した場合、リクエスト数・操作数が基準より増えたか、実時間・ピークメモリが許容範囲を超えたら終了コード1で終わる
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from unittest import mock
+
+from discord.ext import tasks
+from loguru import logger
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.twitter_cog import TwitterCog
+from influ_rader.db import Db
+from influ_rader.jobs import JobQueue
+from influ_rader.metrics import PHASE_SECONDS
+from influ_rader.notify import DiscordChannelSink, NotificationQueue, Notifier
+from influ_rader.precheck import ChangeDetector
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.schedule import PollScheduler
+from influ_rader.sqlite_db import SqliteDb
+from influ_rader.storage import Storage
+from influ_rader.tests.fakes import FakeClock, FakeFirestoreClient, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+TARGETS = 100
+FOLLOWINGS = 10_000
+CHANGE_RATE = 0.01  # 1回の実行でフォロー/フォロー解除されるユーザの割合
+LIMITS = {"get_users": 300, "get_users_following": 15}
+
+# 基準との比較で、実時間とピークメモリは誤差を見込んで許容範囲を広げる
+TOLERANCE = 1.0  # 基準値に対する増加の許容割合
+MIN_SLACK = {"wall_ms": 50.0, "peak_kib": 256.0}  # 基準値が小さい場合でも許容する増加量
+COUNTS = ["api_requests", "db_ops"]  # 決定的に決まるので、基準より増えたら回帰とみなす値
+
+# 対象ユーザIDごとのfollowings
+Followings = Dict[int, List[int]]
+
+
+def make_fixture(
+    targets: int = TARGETS, followings: int = FOLLOWINGS, change_rate: float = CHANGE_RATE, seed: int = 0
+) -> Dict[str, Followings]:
+    """
+    保存済みのfollowings(stored)と、そこからchange_rateの割合だけフォロー/解除したTwitter上のfollowings(twitter)を作る
+    Twitter APIのレスポンスと同じく、twitterは新しくフォローしたユーザが先頭に来る順に並べる
+    """
+    rng = random.Random(seed)
+    stored: Followings = {}
+    twitter: Followings = {}
+    for user_id in range(1, targets + 1):
+        old = rng.sample(range(1, 2**62), followings)
+        changes = int(followings * change_rate)
+        removed = set(rng.sample(old, changes))
+        stored[user_id] = old
+        twitter[user_id] = rng.sample(range(1, 2**62), changes) + [f for f in old if f not in removed]
+    return {"stored": stored, "twitter": twitter}
+
+
+def save_fixture(path: str, fixture: Dict[str, Followings]) -> None:
+    with open(path, "w") as f:
+        json.dump({k: {str(u): v for u, v in followings.items()} for k, followings in fixture.items()}, f)
+
+
+def load_fixture(path: str) -> Dict[str, Followings]:
+    """
+    save_fixtureで保存した(またはAPIのレスポンスから同じ形式で記録した)フィクスチャを読み込む
+    {"stored": {ユーザID: [ユーザID, ...]}, "twitter": {ユーザID: [ユーザID, ...]}}
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return {k: {int(u): [int(i) for i in v] for u, v in data[k].items()} for k in ("stored", "twitter")}
+
+
+class FakeChannel:
+    """
+    投稿したメッセージを記録するだけのDiscordのチャンネル
+    """
+
+    def __init__(self) -> None:
+        self.messages: List[str] = []
+
+    async def send(self, content: str) -> None:
+        self.messages.append(content)
+
+
+class FakeBot:
+    def __init__(self, channel: FakeChannel) -> None:
+        self.channel = channel
+
+    def get_channel(self, channel_id: int) -> FakeChannel:
+        return self.channel
+
+
+class StageRecorder:
+    """
+    PHASE_SECONDS.timeの代わりに使い、フェーズごとの実時間・ピークメモリ・リクエスト数・DB操作数を記録するクラス
+    """
+
+    def __init__(self, client: FakeTwitterClient, db_ops: Callable[[], int]) -> None:
+        self.client = client
+        self.db_ops = db_ops
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.__started: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, phase: str) -> Iterator[None]:
+        self.begin(phase)
+        try:
+            yield
+        finally:
+            self.end(phase)
+
+    def begin(self, phase: str) -> None:
+        tracemalloc.reset_peak()
+        self.__started[phase] = {
+            "wall_ms": time.perf_counter() * 1000,
+            "peak_kib": tracemalloc.get_traced_memory()[0] / 1024,
+            **self.__counts(),
+        }
+
+    def end(self, phase: str) -> None:
+        now = {"wall_ms": time.perf_counter() * 1000, "peak_kib": tracemalloc.get_traced_memory()[1] / 1024}
+        started = self.__started.pop(phase, None)
+        if started is None:
+            return
+        self.stages[phase] = {k: v - started[k] for k, v in {**now, **self.__counts()}.items()}
+        if phase == "notify":
+            # 投稿はnotifyフェーズでキューに入れた後、別のタスクで送られる
+            self.begin("send")
+
+    def __counts(self) -> Dict[str, float]:
+        return {
+            "api_requests": len(self.client.requests),
+            "db_ops": self.db_ops(),
+            "rate_limit_wait_s": sum(self.client.clock.sleeps),
+        }
+
+
+def firestore_storage(client: FakeFirestoreClient, stored: Followings) -> Db:
+    """
+    FakeFirestoreClientを使うDbを作り、保存済みのfollowingsを(スナップショットの形式で)入れておく
+    保存に使ったのとは別の(スナップショットをメモリに持たない)インスタンスを返す
+    """
+
+    def create() -> Db:
+        with mock.patch.multiple(
+            Db,
+            _Db__parse_credential_string=mock.DEFAULT,
+            _Db__initialize_credential=mock.DEFAULT,
+            _Db__initialize_firebase_app=mock.DEFAULT,
+            _Db__initialize_firestore=mock.DEFAULT,
+        ):
+            db = Db(credential="bench")
+        db.client = client
+        return db
+
+    create().save_users_followings(stored, {})
+    client.rpcs.clear()
+    return create()
+
+
+def sqlite_storage(path: str, stored: Followings) -> SqliteDb:
+    """
+    保存済みのfollowingsを入れたSQLiteのDBを作り、(スナップショットをメモリに持たない)別のインスタンスで開き直す
+    """
+    SqliteDb(path).save_users_followings(stored, {})
+    return SqliteDb(path)
+
+
+def run(
+    fixture: Dict[str, Followings], backend: str = "firestore", concurrency: int = 4
+) -> Dict[str, Dict[str, float]]:
+    """
+    フィクスチャの状態から1回のrunを実行し、フェーズごとの計測結果を返す
+    """
+    clock = FakeClock()
+    client = FakeTwitterClient(clock, fixture["twitter"], LIMITS)
+    twitter = Twitter(bearer_token="bench", rate_limiter=RateLimiter(clock=clock))
+    twitter._Twitter__client = client  # type: ignore
+
+    with tempfile.TemporaryDirectory() as directory:
+        db: Storage
+        # DBの操作数は、FirestoreならRPCの数、SQLiteなら実行したSQL文の数
+        operations: List[Any]
+        if backend == "firestore":
+            firestore_client = FakeFirestoreClient()
+            db = firestore_storage(firestore_client, fixture["stored"])
+            operations = firestore_client.rpcs
+        else:
+            sqlite_db = sqlite_storage(os.path.join(directory, "bench.sqlite3"), fixture["stored"])
+            operations = []
+            sqlite_db.connection.set_trace_callback(operations.append)
+            db = sqlite_db
+
+        channel = FakeChannel()
+        recorder = StageRecorder(client, lambda: len(operations))
+        executor = BoundedExecutor(max_workers=concurrency)
+
+        async def tick() -> None:
+            bot = FakeBot(channel)
+            # Discordのチャンネルごとのレート制限による待機も、時計を進めるだけにする
+            sink = DiscordChannelSink(bot, 0, clock=clock, sleep=clock.async_sleep)
+            with recorder.stage("startup"):
+                cog = TwitterCog(
+                    bot,
+                    twitter,
+                    db,
+                    [f"user{u}" for u in fixture["twitter"]],
+                    0,
+                    executor,
+                    # 全ての対象ユーザを1回のrunで取得する
+                    scheduler=PollScheduler(budget=sys.maxsize, clock=clock),
+                    detector=ChangeDetector(clock=clock),
+                    jobs=JobQueue(clock=clock),
+                    notifier=Notifier([NotificationQueue(sink, sleep=clock.async_sleep)]),
+                )
+            await TwitterCog.diff_users_followings.coro(cog)
+            await cog.notifier.join()
+            recorder.end("send")
+
+        tracemalloc.start()
+        try:
+            with mock.patch.object(tasks.Loop, "start"), mock.patch.object(PHASE_SECONDS, "time", recorder.stage):
+                asyncio.run(tick())
+        finally:
+            tracemalloc.stop()
+            executor.shutdown()
+
+    changed = [u for u in fixture["twitter"] if set(fixture["twitter"][u]) - set(fixture["stored"].get(u, []))]
+    posted = "\n".join(channel.messages)
+    assert all(f"(@user{u})**" in posted for u in changed), "every target user with new followings must be posted"
+    return recorder.stages
+
+
+def total(stages: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+    keys = ["wall_ms", "api_requests", "db_ops", "rate_limit_wait_s"]
+    result = {k: sum(s[k] for s in stages.values()) for k in keys}
+    result["peak_kib"] = max((s["peak_kib"] for s in stages.values()), default=0.0)
+    return result
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = TOLERANCE) -> List[str]:
+    """
+    基準の結果と比べて、回帰したフェーズと値の説明のリストを返す
+    """
+    if result["config"] != baseline["config"]:
+        return [f"baseline was recorded with a different config: {baseline['config']}"]
+    regressions = []
+    for phase, expected in baseline["stages"].items():
+        actual = result["stages"].get(phase)
+        if actual is None:
+            regressions.append(f"{phase}: missing")
+            continue
+        for key in COUNTS:
+            if actual[key] > expected[key]:
+                regressions.append(f"{phase}: {key} {actual[key]:.0f} > {expected[key]:.0f}")
+        for key, slack in MIN_SLACK.items():
+            limit = max(expected[key] * (1 + tolerance), expected[key] + slack)
+            if actual[key] > limit:
+                regressions.append(f"{phase}: {key} {actual[key]:.1f} > {limit:.1f}")
+    return regressions
+
+
+def report(stages: Dict[str, Dict[str, float]]) -> None:
+    header = ["stage", "wall [ms]", "peak [KiB]", "api requests", "db ops", "rate wait [s]"]
+    print(" | ".join(f"{h:>13}" for h in header))
+    for phase, s in list(stages.items()) + [("total", total(stages))]:
+        print(
+            f"{phase:>13} | {s['wall_ms']:>13.1f} | {s['peak_kib']:>13.0f} | {s['api_requests']:>13.0f}"
+            f" | {s['db_ops']:>13.0f} | {s['rate_limit_wait_s']:>13.0f}"
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", type=int, default=TARGETS, help="number of synthetic target users")
+    parser.add_argument("--followings", type=int, default=FOLLOWINGS, help="followings per synthetic target user")
+    parser.add_argument("--change-rate", type=float, default=CHANGE_RATE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=["firestore", "sqlite"], default="firestore")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--fixture", help="run with a recorded fixture instead of a synthetic one")
+    parser.add_argument("--record", help="save the fixture used for this run")
+    parser.add_argument("--json", help="write the result as json")
+    parser.add_argument("--baseline", help="fail if the result regressed from this json result")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")  # レート制限の待機などは結果の表で分かる
+
+    if args.fixture:
+        fixture = load_fixture(args.fixture)
+        config: Dict[str, Any] = {"fixture": os.path.basename(args.fixture)}
+    else:
+        fixture = make_fixture(args.targets, args.followings, args.change_rate, args.seed)
+        config = {"targets": args.targets, "followings": args.followings, "change_rate": args.change_rate}
+    config.update(backend=args.backend, seed=args.seed, concurrency=args.concurrency)
+    if args.record:
+        save_fixture(args.record, fixture)
+
+    stages = run(fixture, args.backend, args.concurrency)
+    report(stages)
+    result = {"config": config, "stages": stages}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
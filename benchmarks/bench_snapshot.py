@@ -0,0 +1,62 @@
+"""
+Firestoreに保存するfollowingsのスナップショットの形式ごとの、サイズとエンコード/デコードの時間のベンチマーク
+
+followingsの件数ごとに、以前の形式(10進数の文字列の配列)と、差分+varintのバイト列(圧縮なし/zlib/zstd)を比べる
+サイズはFirestoreのドキュメントサイズの計算方法(文字列はUTF-8のバイト数+1、バイト列はそのバイト数)で数える
+
+    python -m benchmarks.bench_snapshot
+    python -m benchmarks.bench_snapshot --sizes 1000 100000 1000000
+"""
+import argparse
+import random
+import time
+from array import array
+from typing import Callable, List
+
+from influ_rader.codec import available_compressions, decode_ids, encode_ids
+from influ_rader.diff import Snapshot
+
+
+def make_ids(count: int, seed: int = 0) -> "array[int]":
+    """
+    実際のfollowingsに近いユーザID(6割は10桁以下の古いID、4割は19桁のSnowflakeのID)を作る
+    """
+    rng = random.Random(seed)
+    old = [rng.randrange(10**6, 3 * 10**9) for _ in range(count * 6 // 10)]
+    new = [rng.randrange(7 * 10**17, 16 * 10**17) for _ in range(count - len(old))]
+    return Snapshot.from_ids(old + new).ids
+
+
+def measure(func: Callable[[], object], repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f"{'followings':>10} {'format':<14} {'KiB':>10} {'ratio':>7} {'encode ms':>10} {'decode ms':>10}")
+    for size in args.sizes:
+        ids = make_ids(size)
+        strings: List[str] = [str(i) for i in ids]
+        legacy = sum(len(s) + 1 for s in strings)
+        encode_ms = measure(lambda: [str(i) for i in ids])
+        decode_ms = measure(lambda: Snapshot.from_ids(int(s) for s in strings))
+        print(f"{size:>10} {'string-array':<14} {legacy / 1024:>10.1f} {1:>7.2f} {encode_ms:>10.1f} {decode_ms:>10.1f}")
+        for compression in available_compressions():
+            data = encode_ids(ids, compression)
+            assert decode_ids(data) == ids
+            encode_ms = measure(lambda: encode_ids(ids, compression))
+            decode_ms = measure(lambda: Snapshot(decode_ids(data)))
+            kib, ratio = len(data) / 1024, len(data) / legacy
+            print(f"{size:>10} {compression:<14} {kib:>10.1f} {ratio:>7.2f} {encode_ms:>10.1f} {decode_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Twitter APIへのHTTP接続の使い回しと圧縮のベンチマーク
+
+ローカルで起動したスタブサーバ(followingの1ページ分のJSONを返す)に、複数のスレッドからBearer Tokenを順番に使って
+リクエストし、接続の張り方ごとにスループット・新しく張った接続の数・レスポンスボディの転送量を出力する
+
+    python -m benchmarks.bench_transport
+    python -m benchmarks.bench_transport --requests 2000 --threads 8 --tokens 4 --connect-delay 0.05
+
+- per-request: リクエストごとに新しい接続を張る
+- per-token: tweepyのデフォルト(Bearer Tokenごとのクライアントが、それぞれrequests.Sessionを持つ)
+- shared: 全てのBearer TokenでTransportのSessionを共有する
+- shared-identity: sharedで圧縮を使わない
+
+スタブサーバはTLSを使わないので、新しい接続ごとに--connect-delay秒待ってTLSのハンドシェイクの往復を模擬する
+"""
+import argparse
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List
+
+import requests
+
+from influ_rader.transport import Transport
+
+
+def following_page(users: int = 1000) -> bytes:
+    """
+    following取得のレスポンス1ページ分(max_results=1000)と同じ形のJSON
+    """
+    data = [{"id": str(10**17 + i), "name": f"ユーザー{i}", "username": f"user{i}"} for i in range(users)]
+    meta = {"result_count": users, "next_token": "7140dibdnow9c7btw3w29n4v"}
+    return json.dumps({"data": data, "meta": meta}).encode()
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    keep-aliveに対応し(HTTP/1.1)、Accept-Encodingにgzipが含まれていればgzipで圧縮して返すスタブサーバ
+    connections: 受け付けた接続の数
+    body_bytes: 送ったレスポンスボディのバイト数
+    """
+
+    daemon_threads = True
+
+    def __init__(self, connect_delay: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.connect_delay = connect_delay
+        self.body = following_page()
+        self.gzipped = gzip.compress(self.body)
+        self.connections = 0
+        self.body_bytes = 0
+        self.lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode()
+        return f"http://{host}:{port}/2/users/1/following"
+
+    def __enter__(self) -> "StubServer":
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.connections = 0
+            self.body_bytes = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # ヘッダとボディを分けて書き込むので、Nagleアルゴリズムと遅延ACKでkeep-aliveした接続が待たされないようにする
+    disable_nagle_algorithm = True
+    server: StubServer
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.connect_delay)
+
+    def do_GET(self) -> None:
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = self.server.gzipped if gzipped else self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.body_bytes += len(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def scenarios(url: str, tokens: int, threads: int) -> Dict[str, Callable[[], Callable[[int], requests.Response]]]:
+    """
+    接続の張り方ごとに、i番目のリクエストを(i % tokens番目のBearer Tokenで)送る関数を作る関数
+    """
+
+    def headers(i: int) -> Dict[str, str]:
+        return {"Authorization": f"Bearer token{i % tokens}"}
+
+    def per_request() -> Callable[[int], requests.Response]:
+        return lambda i: requests.get(url, headers=headers(i))
+
+    def per_token() -> Callable[[int], requests.Response]:
+        sessions = [requests.Session() for _ in range(tokens)]
+        return lambda i: sessions[i % tokens].get(url, headers=headers(i))
+
+    def shared(compress: bool) -> Callable[[], Callable[[int], requests.Response]]:
+        def create() -> Callable[[int], requests.Response]:
+            session = Transport(pool_size=threads, compress=compress).session
+            return lambda i: session.get(url, headers=headers(i))
+
+        return create
+
+    return {
+        "per-request": per_request,
+        "per-token": per_token,
+        "shared": shared(True),
+        "shared-identity": shared(False),
+    }
+
+
+def run(server: StubServer, send: Callable[[int], requests.Response], count: int, threads: int) -> Dict[str, float]:
+    server.reset()
+
+    def request(i: int) -> None:
+        res = send(i)
+        res.raise_for_status()
+        assert len(res.content) == len(server.body)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(request, range(count)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests_per_s": count / elapsed,
+        "connections": server.connections,
+        "body_kib": server.body_bytes / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=3)
+    parser.add_argument("--connect-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    with StubServer(args.connect_delay) as server:
+        for name, create in scenarios(server.url, args.tokens, args.threads).items():
+            results.append({"scenario": name, **run(server, create(), args.requests, args.threads)})
+
+    print(f"{'scenario':<16} {'req/s':>10} {'connections':>12} {'body KiB':>12}")
+    for r in results:
+        print(f"{r['scenario']:<16} {r['requests_per_s']:>10.0f} {r['connections']:>12} {r['body_kib']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,6 @@
+import time
+
+# 起動時間の計測の起点(python -m influ_rader.mainでは、mainの重いモジュールのimportより前にパッケージが読み込まれる)
+STARTED_AT = time.perf_counter()
+
 __version__ = "0.1.0"
@@ -0,0 +1,88 @@
+import asyncio
+import functools
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+from influ_rader.diff import Snapshot
+from influ_rader.storage import FetchedFollowings, Storage, UsersFollowings
+from influ_rader.twitter import Twitter, User
+
+T = TypeVar("T")
+
+
+class BoundedExecutor:
+    """
+    ブロッキングするI/O処理をスレッドプールで実行し、イベントループ(Discordのgateway)を止めないようにするクラス
+    同時に実行される処理の数はmax_workersで制限する
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self.max_workers = max_workers
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="influ_rader")
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        self.__executor.shutdown(wait=False)
+
+
+class AsyncTwitter:
+    """
+    Twitterクラスのasyncioラッパー
+    レート制限による待機もスレッドプール内で行われるので、イベントループはブロックされない
+    待機している間はワーカを占有するので、DBなどへの処理とは別のBoundedExecutorを渡す
+    """
+
+    def __init__(self, twitter: Twitter, executor: BoundedExecutor) -> None:
+        self.twitter = twitter
+        self.executor = executor
+
+    async def get_users_by_ids(self, user_ids: List[int]) -> List[User]:
+        return await self.executor.run(self.twitter.get_users_by_ids, user_ids)
+
+    async def get_users(self, usernames: List[str]) -> List[User]:
+        return await self.executor.run(self.twitter.get_users, usernames)
+
+    async def save_cache(self) -> None:
+        await self.executor.run(self.twitter.save_cache)
+
+    async def get_user_id_following(self, user_id: int) -> "array[int]":
+        return await self.executor.run(self.twitter.get_user_id_following, user_id)
+
+    async def get_user_id_following_since(
+        self, user_id: int, known: Snapshot, expected_new: int
+    ) -> Tuple["array[int]", int]:
+        return await self.executor.run(self.twitter.get_user_id_following_since, user_id, known, expected_new)
+
+    async def get_following_counts(self, user_ids: List[int]) -> Dict[int, int]:
+        return await self.executor.run(self.twitter.get_following_counts, user_ids)
+
+    async def get_users_id_following(self, user_ids: List[int]) -> dict[int, "array[int]"]:
+        """
+        複数ユーザのfollowingを並行して取得する
+        同時に取得するユーザ数はexecutorのワーカ数まで、レート制限はTwitterクラスのRateLimiterで共有される
+        """
+        results = await asyncio.gather(*[self.get_user_id_following(user_id) for user_id in user_ids])
+        return dict(zip(user_ids, results))
+
+
+class AsyncDb:
+    """
+    Storage(Firestore/SQLite)のasyncioラッパー
+    """
+
+    def __init__(self, db: Storage, executor: BoundedExecutor) -> None:
+        self.db = db
+        self.executor = executor
+
+    async def get_snapshots(self, user_ids: List[int]) -> Dict[int, Snapshot]:
+        return await self.executor.run(self.db.get_snapshots, user_ids)
+
+    async def diff_users_followings(self, from_twitter: FetchedFollowings) -> Tuple[UsersFollowings, UsersFollowings]:
+        return await self.executor.run(self.db.diff_users_followings, from_twitter)
+
+    async def save_users_followings(self, added: UsersFollowings, removed: UsersFollowings) -> None:
+        await self.executor.run(self.db.save_users_followings, added, removed)
@@ -1,18 +1,106 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
-from cogs.twitter_cog import TwitterCog
-from db import Db
 from discord.ext import commands
 from loguru import logger
-from twitter import Twitter
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.history_cog import HistoryCog
+from influ_rader.cogs.targets_cog import TargetsCog
+from influ_rader.cogs.twitter_cog import TwitterCog
+from influ_rader.enrich import Enricher
+from influ_rader.error import DbInitializeError
+from influ_rader.history import FollowHistory
+from influ_rader.jobs import JobQueue
+from influ_rader.metrics import RunProfiler, StartupTimer
+from influ_rader.notify import build_notifier
+from influ_rader.precheck import ChangeDetector
+from influ_rader.schedule import PollScheduler
+from influ_rader.shard import ShardedCrawler
+from influ_rader.storage import Storage
+from influ_rader.targets import TargetRegistry
+from influ_rader.trending import TrendIndex
+from influ_rader.twitter import Twitter
 
 
 class Bot(commands.Bot):
     EXTENSIONS = ["cogs.twitter_cog"]
 
-    def __init__(self, db: Db, twitter: Twitter, targets: List[str], channel: int, command_prefix="!") -> None:
+    def __init__(
+        self,
+        db: Storage,
+        twitter: Twitter,
+        targets: List[str],
+        channel: int,
+        concurrency: int = 4,
+        crawler: Optional[ShardedCrawler] = None,
+        jobs: Optional[JobQueue] = None,
+        scheduler: Optional[PollScheduler] = None,
+        detector: Optional[ChangeDetector] = None,
+        profiler: Optional[RunProfiler] = None,
+        notify_sinks: Optional[List[Dict[str, Any]]] = None,
+        notify_concurrency: int = 4,
+        history: Optional[FollowHistory] = None,
+        trends: Optional[TrendIndex] = None,
+        registry: Optional[TargetRegistry] = None,
+        startup: Optional[StartupTimer] = None,
+        measure_startup: bool = False,
+        enricher: Optional[Enricher] = None,
+        command_prefix="!",
+    ) -> None:
         super().__init__(command_prefix=command_prefix)
-        self.add_cog(TwitterCog(self, twitter, db, targets, channel))
+        executor = BoundedExecutor(concurrency)
+        # following取得はレート制限で待つことがあるので、DBへの処理やコマンドとはスレッドプールを分ける
+        fetch_executor = BoundedExecutor(concurrency)
+        # 起動時間を計測し、準備完了の後でTwitter/Firestoreのクライアントを裏で初期化する
+        self.startup = startup or StartupTimer()
+        self.measure_startup = measure_startup
+        self.__warm_ups = [("twitter", twitter.warm_up), ("storage", db.warm_up)]
+        self.__executor = executor
+        if measure_startup:
+            # 計測だけを行うモードでは、following取得などのコマンドやループを登録しない
+            return
+        with self.startup.phase("cogs"):
+            notifier = build_notifier(self, channel, notify_sinks, notify_concurrency)
+            registry = registry or TargetRegistry()
+            self.add_cog(
+                TwitterCog(
+                    self,
+                    twitter,
+                    db,
+                    targets,
+                    channel,
+                    executor,
+                    crawler,
+                    jobs,
+                    scheduler,
+                    detector,
+                    profiler,
+                    notifier,
+                    history,
+                    trends,
+                    registry,
+                    enricher,
+                    fetch_executor,
+                )
+            )
+            self.add_cog(TargetsCog(self, twitter, registry, executor))
+            if history is not None:
+                self.add_cog(HistoryCog(self, twitter, history, executor))
 
     async def on_ready(self):
         logger.info(f"{self.user.name} is ready!!")
+        if self.startup.ready_at is None:  # 再接続した場合もon_readyが呼ばれる
+            self.startup.ready()
+            logger.info(f"Startup time until ready:\n{self.startup.report()}")
+            self.loop.create_task(self.__warm_up())
+
+    async def __warm_up(self) -> None:
+        for name, warm_up in self.__warm_ups:
+            try:
+                with self.startup.phase(f"warm_up_{name}"):
+                    await self.__executor.run(warm_up)
+            except DbInitializeError:
+                logger.error(f"Failed to warm up {name}. It will be initialized on first use.")
+        logger.info(f"Startup time including warm up:\n{self.startup.report()}")
+        if self.measure_startup:
+            await self.close()
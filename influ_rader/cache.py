@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+
+from loguru import logger
+
+from influ_rader.rate_limit import Clock
+
+
+class UserCache:
+    """
+    Twitterのユーザ情報をユーザIDごとに保持するキャッシュ
+    エントリ数がmax_sizeを超えたら最も使われていないものから削除し(LRU)、ttl秒経ったエントリは無効とする
+    pathを指定すると、ファイルに保存して再起動後も使えるようにする
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 24 * 60 * 60,
+        path: Optional[str] = None,
+        clock: Optional[Clock] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock or Clock()
+        self.hits = 0
+        self.misses = 0
+        # ユーザID -> (ユーザ情報, 有効期限)
+        self.__entries: "OrderedDict[int, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        # ユーザ名(小文字) -> ユーザID
+        self.__usernames: Dict[str, int] = {}
+        self.__lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key: Union[int, str]) -> Optional[Dict[str, Any]]:
+        """
+        ユーザID(int) or ユーザ名(str)からユーザ情報を取得する
+        """
+        with self.__lock:
+            user_id = key if isinstance(key, int) else self.__usernames.get(key.lower())
+            entry = self.__entries.get(user_id) if user_id is not None else None
+            if user_id is None or entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= self.clock.time():
+                self.__remove(user_id)
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, data: Dict[str, Any]) -> None:
+        with self.__lock:
+            user_id = int(data["id"])
+            if user_id in self.__entries:
+                self.__remove(user_id)
+            self.__entries[user_id] = (data, self.clock.time() + self.ttl)
+            if "username" in data:
+                self.__usernames[str(data["username"]).lower()] = user_id
+            while len(self.__entries) > self.max_size:
+                self.__remove(next(iter(self.__entries)))
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.__entries), "hits": self.hits, "misses": self.misses}
+
+    def load(self) -> None:
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            logger.exception(f"Failed to load user cache from `{self.path}`")
+            return
+        now = self.clock.time()
+        with self.__lock:
+            for data, expires_at in entries:
+                if expires_at > now:
+                    user_id = int(data["id"])
+                    self.__entries[user_id] = (data, expires_at)
+                    if "username" in data:
+                        self.__usernames[str(data["username"]).lower()] = user_id
+            while len(self.__entries) > self.max_size:
+                self.__remove(next(iter(self.__entries)))
+        logger.info(f"Loaded {len(self.__entries)} users from user cache `{self.path}`")
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self.__lock:
+            entries = list(self.__entries.values())
+        try:
+            # 書き込み途中で落ちてもキャッシュが壊れないよう、一時ファイルに書いてから置き換える
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False, default=str)
+            os.replace(tmp, self.path)
+        except OSError:
+            logger.exception(f"Failed to save user cache to `{self.path}`")
+
+    def __remove(self, user_id: int) -> None:
+        data, _ = self.__entries.pop(user_id)
+        username = str(data.get("username", "")).lower()
+        if self.__usernames.get(username) == user_id:
+            del self.__usernames[username]
@@ -0,0 +1,41 @@
+import threading
+from array import array
+from typing import Dict, Optional, Tuple
+
+from influ_rader.diff import ids_array
+
+
+class Checkpoint:
+    """
+    following取得(ページネーション)の途中経過を保持するクラス
+    次に取得するページのトークンと、それまでに取得したユーザIDを対象ユーザごとに保持し、
+    取得が途中で失敗しても、次回は最後に取得できたページの続きから再開できるようにする
+
+    このクラスはメモリ上に保持するので、同じプロセス内でのリトライでのみ再開できる
+    """
+
+    def __init__(self) -> None:
+        self.__progress: Dict[int, Tuple[str, "array[int]"]] = {}
+        self.__lock = threading.Lock()
+
+    def load(self, user_id: int) -> Optional[Tuple[str, "array[int]"]]:
+        """
+        (次のページのトークン, 取得済みのユーザID)を返す
+        途中経過がなければNoneを返す
+        """
+        with self.__lock:
+            progress = self.__progress.get(user_id)
+            return (progress[0], ids_array(progress[1])) if progress is not None else None
+
+    def save_page(self, user_id: int, next_token: str, page: "array[int]") -> None:
+        """
+        取得できたページのユーザIDと、次のページのトークンを記録する
+        """
+        with self.__lock:
+            _, ids = self.__progress.get(user_id, ("", ids_array()))
+            ids.extend(page)
+            self.__progress[user_id] = (next_token, ids)
+
+    def clear(self, user_id: int) -> None:
+        with self.__lock:
+            self.__progress.pop(user_id, None)
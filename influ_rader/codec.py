@@ -0,0 +1,99 @@
+import operator
+import sys
+import zlib
+from array import array
+from itertools import accumulate, chain
+from typing import Any, List
+
+from influ_rader.diff import ids_array
+
+FORMAT_VERSION = 1
+# 圧縮形式とヘッダに書き込むID(zstdはzstandardがインストールされている場合のみ使える)
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2}
+WIDTH = 8  # 差分1つあたりのバイト数(64bit整数)
+
+
+def _zstd() -> Any:
+    import zstandard
+
+    return zstandard
+
+
+def available_compressions() -> List[str]:
+    """
+    この環境でエンコードに使える圧縮形式を返す
+    """
+    try:
+        _zstd()
+    except ImportError:
+        return [c for c in COMPRESSIONS if c != "zstd"]
+    return list(COMPRESSIONS)
+
+
+def encode_ids(ids: "array[int]", compression: str = "zlib") -> bytes:
+    """
+    ソート済みのユーザIDの配列を、コンパクトなバイト列にする
+
+    形式: バージョン(1バイト) + 圧縮形式(1バイト) + 本体(圧縮形式で圧縮)
+    本体: 1つ前のIDとの差分(最初のIDは0との差分)を64bitのリトルエンディアンで並べ、バイトの桁ごとに並べ替えたもの
+    (全ての差分の1バイト目、全ての差分の2バイト目、...の順)
+
+    ソート済みのIDの差分は上位のバイトがほとんど0なので、桁ごとに並べると0が連続して圧縮が効く
+    varintと比べて圧縮後のサイズは同じかより小さく、1バイトずつPythonで処理しない分エンコード/デコードが速い
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression `{compression}`")
+    deltas = ids_array(map(operator.sub, ids, chain((0,), ids)))
+    if deltas and min(deltas) < 0:
+        raise ValueError("User ids must be sorted and non-negative")
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    raw = deltas.tobytes()
+    body = b"".join(raw[k::WIDTH] for k in range(WIDTH))
+    if compression == "zlib":
+        payload = zlib.compress(body)
+    elif compression == "zstd":
+        payload = _zstd().ZstdCompressor().compress(body)
+    else:
+        payload = body
+    if len(payload) >= len(body):
+        # 件数が少ないと圧縮した方が大きくなるので、圧縮せずに保存する
+        compression, payload = "none", body
+    return bytes([FORMAT_VERSION, COMPRESSIONS[compression]]) + payload
+
+
+def decode_ids(data: bytes) -> "array[int]":
+    """
+    encode_idsで作ったバイト列を、ソート済みのユーザIDの配列に戻す
+    形式が壊れている場合はValueErrorを投げる
+    """
+    if len(data) < 2 or data[0] != FORMAT_VERSION:
+        raise ValueError("Unsupported snapshot format")
+    compression = data[1]
+    payload = data[2:]
+    if compression == COMPRESSIONS["zlib"]:
+        try:
+            body = zlib.decompress(payload)
+        except zlib.error as e:
+            raise ValueError("Broken snapshot payload") from e
+    elif compression == COMPRESSIONS["zstd"]:
+        zstandard = _zstd()
+        try:
+            body = zstandard.ZstdDecompressor().decompress(payload)
+        except zstandard.ZstdError as e:
+            raise ValueError("Broken snapshot payload") from e
+    elif compression == COMPRESSIONS["none"]:
+        body = bytes(payload)
+    else:
+        raise ValueError(f"Unknown compression id `{compression}`")
+    if len(body) % WIDTH:
+        raise ValueError("Broken snapshot payload")
+    count = len(body) // WIDTH
+    raw = bytearray(len(body))
+    for k in range(WIDTH):
+        raw[k::WIDTH] = body[k * count : (k + 1) * count]
+    deltas = ids_array()
+    deltas.frombytes(raw)
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return ids_array(accumulate(deltas))
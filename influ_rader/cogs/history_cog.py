@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from discord.ext import commands
+from loguru import logger
+
+from influ_rader.aio import AsyncTwitter, BoundedExecutor
+from influ_rader.error import DbOperationError, TwitterRequestError
+from influ_rader.history import FollowHistory
+from influ_rader.notify import TWITTER_URL, pack_messages
+from influ_rader.twitter import Twitter, User
+
+
+def parse_time(value: str) -> float:
+    """
+    ISO 8601形式の日付または日時をUNIX時刻にする
+    日付だけの場合はその日の終わり、タイムゾーンがない場合はUTCとみなす
+    """
+    at = datetime.fromisoformat(value)
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    if len(value) == len("YYYY-MM-DD"):
+        at += timedelta(days=1, microseconds=-1)
+    return at.timestamp()
+
+
+class HistoryCog(commands.Cog):
+    """
+    フォロー/フォロー解除の履歴を問い合わせるコマンド
+    """
+
+    SHOWN_USERS = 50  # 1回のコマンドで表示するアカウントの数の上限
+
+    def __init__(self, bot: commands.Bot, twitter: Twitter, history: FollowHistory, executor: BoundedExecutor) -> None:
+        super().__init__()
+        self.bot = bot
+        self.executor = executor
+        self.twitter = AsyncTwitter(twitter, executor)
+        self.history = history
+
+    @commands.command(name="cofollowed")
+    async def co_followed(self, ctx: commands.Context, days: float = 7, min_targets: int = 3) -> None:
+        """
+        直近days日間にmin_targets人以上の対象ユーザがフォローしたアカウントを表示する
+        """
+        header = f"**直近{days:g}日間に{min_targets}人以上の対象ユーザがフォローしたアカウント**"
+        since = self.history.clock.time() - days * 24 * 60 * 60
+        try:
+            rows = await self.executor.run(self.history.co_followed, since, min_targets, self.SHOWN_USERS)
+        except DbOperationError:
+            await ctx.send("履歴の取得に失敗しました")
+            return
+        users = await self.__lookup([user_id for user_id, _ in rows])
+        lines = [f"{TWITTER_URL}{users[u].username} ({count}人)" for u, count in rows if u in users]
+        await self.__send(ctx, header, lines)
+
+    @commands.command(name="followings")
+    async def followings_at(self, ctx: commands.Context, username: str, date: str) -> None:
+        """
+        対象ユーザがdate(YYYY-MM-DDまたはISO 8601形式の日時)の時点でフォローしていたアカウントを表示する
+        """
+        try:
+            at = parse_time(date)
+        except ValueError:
+            await ctx.send("日時は`YYYY-MM-DD`または`YYYY-MM-DDTHH:MM:SS+09:00`の形式で指定してください")
+            return
+        target = await self.__target(ctx, username)
+        if target is None:
+            return
+        try:
+            followings = await self.executor.run(self.history.followings_at, int(target.id), at)
+        except DbOperationError:
+            await ctx.send("履歴の取得に失敗しました")
+            return
+        users = await self.__lookup(followings[: self.SHOWN_USERS])
+        header = f"**@{target.username}が{date}の時点でフォローしていたアカウント({len(followings)}件)**"
+        await self.__send(ctx, header, [f"{TWITTER_URL}{users[u].username}" for u in followings if u in users])
+
+    @commands.command(name="history")
+    async def events(self, ctx: commands.Context, username: str, days: float = 7) -> None:
+        """
+        対象ユーザの直近days日間のフォロー(+)/フォロー解除(-)を表示する
+        """
+        target = await self.__target(ctx, username)
+        if target is None:
+            return
+        since = self.history.clock.time() - days * 24 * 60 * 60
+        try:
+            events = await self.executor.run(self.history.events, int(target.id), since)
+        except DbOperationError:
+            await ctx.send("履歴の取得に失敗しました")
+            return
+        events = events[-self.SHOWN_USERS :]
+        users = await self.__lookup([e.followed_id for e in events])
+        lines = [
+            f"{datetime.fromtimestamp(e.at, timezone.utc):%Y-%m-%d %H:%M} "
+            f"{'+' if e.kind == FollowHistory.FOLLOW else '-'} {TWITTER_URL}{users[e.followed_id].username}"
+            for e in events
+            if e.followed_id in users
+        ]
+        await self.__send(ctx, f"**@{target.username}の直近{days:g}日間のフォロー(+)/フォロー解除(-)**", lines)
+
+    async def __target(self, ctx: commands.Context, username: str) -> Optional[User]:
+        try:
+            users = await self.twitter.get_users([username])
+        except TwitterRequestError:
+            logger.exception(f"Failed to get user `{username}` from Twitter API")
+            users = []
+        if not users:
+            await ctx.send(f"ユーザ`{username}`が見つかりません")
+            return None
+        return users[0]
+
+    async def __lookup(self, user_ids: List[int]) -> Dict[int, User]:
+        if not user_ids:
+            return {}
+        try:
+            return {int(u.id): u for u in await self.twitter.get_users_by_ids(user_ids)}
+        except TwitterRequestError:
+            logger.exception("Failed to get users info from Twitter API")
+            return {}
+
+    async def __send(self, ctx: commands.Context, header: str, lines: List[str]) -> None:
+        for message in pack_messages([(header, lines)]) or [f"{header}\nなし"]:
+            await ctx.send(message)
@@ -0,0 +1,93 @@
+from typing import List, Sequence
+
+from discord.ext import commands
+
+from influ_rader.aio import AsyncTwitter, BoundedExecutor
+from influ_rader.error import DbOperationError
+from influ_rader.notify import TWITTER_URL, pack_messages
+from influ_rader.targets import USERNAME_PATTERN, TargetRegistry
+from influ_rader.twitter import Twitter
+
+
+class TargetsCog(commands.Cog):
+    """
+    Botを再起動せずに対象ユーザを追加/削除するコマンド
+    """
+
+    def __init__(
+        self, bot: commands.Bot, twitter: Twitter, registry: TargetRegistry, executor: BoundedExecutor
+    ) -> None:
+        super().__init__()
+        self.bot = bot
+        self.executor = executor
+        self.twitter = AsyncTwitter(twitter, executor)
+        self.__lookup_users = twitter.lookup_users
+        self.registry = registry
+
+    @commands.command(name="targets")
+    async def list_targets(self, ctx: commands.Context) -> None:
+        """
+        対象ユーザの一覧を、解決できていない(pending)/見つからない(quarantined)ものと一緒に表示する
+        """
+        try:
+            entries = await self.executor.run(self.registry.entries)
+        except DbOperationError:
+            await ctx.send("対象ユーザの取得に失敗しました")
+            return
+        lines = [
+            f"{TWITTER_URL}{e.username}" + ("" if e.status == TargetRegistry.ACTIVE else f" ({e.status})")
+            for e in entries
+        ]
+        for message in pack_messages([(f"**対象ユーザ({len(entries)}人)**", lines)]) or ["対象ユーザはいません"]:
+            await ctx.send(message)
+
+    @commands.command(name="addtarget")
+    async def add_targets(self, ctx: commands.Context, *usernames: str) -> None:
+        """
+        対象ユーザを追加する(追加したユーザ名だけをすぐにユーザIDに解決し、次のループから取得する)
+        """
+        usernames = tuple(u.lstrip("@") for u in usernames)
+        if not usernames:
+            await ctx.send("ユーザ名を指定してください")
+            return
+        try:
+            added = await self.executor.run(self.registry.add, usernames)
+            resolved, quarantined = await self.executor.run(self.registry.resolve, self.__lookup_users)
+        except DbOperationError:
+            await ctx.send("対象ユーザの追加に失敗しました")
+            return
+        if resolved:
+            await self.twitter.save_cache()
+        await ctx.send(self.__summary(usernames, added, resolved, quarantined))
+
+    @commands.command(name="removetarget")
+    async def remove_targets(self, ctx: commands.Context, *usernames: str) -> None:
+        """
+        対象ユーザを削除する(次のループから取得しない)
+        """
+        usernames = tuple(u.lstrip("@") for u in usernames)
+        try:
+            removed = await self.executor.run(self.registry.remove, usernames)
+        except DbOperationError:
+            await ctx.send("対象ユーザの削除に失敗しました")
+            return
+        await ctx.send(f"削除しました: {', '.join(removed)}" if removed else "削除する対象ユーザがいません")
+
+    @staticmethod
+    def __summary(usernames: Sequence[str], added: List[str], resolved: List[str], quarantined: List[str]) -> str:
+        lines = []
+        if resolved:
+            lines.append(f"追加しました: {', '.join(resolved)}")
+        if quarantined:
+            lines.append(f"見つからないユーザは保留しました: {', '.join(quarantined)}")
+        # 解決も隔離もされなかったユーザ名は、問い合わせに失敗したので次のループで確認し直す
+        unconfirmed = [u for u in added if u not in resolved and u not in quarantined]
+        if unconfirmed:
+            lines.append(f"追加しました。ユーザの確認に失敗したので、次のループで確認し直します: {', '.join(unconfirmed)}")
+        invalid = [u for u in usernames if not USERNAME_PATTERN.match(u)]
+        if invalid:
+            lines.append(f"ユーザ名が正しくないので保留しました: {', '.join(invalid)}")
+        existing = [u for u in (u.lower() for u in usernames) if u not in added and USERNAME_PATTERN.match(u)]
+        if existing:
+            lines.append(f"すでに対象ユーザです: {', '.join(existing)}")
+        return "\n".join(lines) or "追加する対象ユーザがいません"
@@ -1,186 +1,311 @@
-from http.client import HTTPException
-from typing import List
+import asyncio
+import math
+from array import array
+from typing import Dict, List, Optional, Sequence, Union
 
-from db import Db
 from discord.ext import commands, tasks
-from error import BotError, DbOperationError, TwitterRequestError
 from loguru import logger
-from twitter import Twitter
+
+from influ_rader.aio import AsyncDb, AsyncTwitter, BoundedExecutor
+from influ_rader.enrich import Enricher
+from influ_rader.error import DbOperationError, TwitterRequestError
+from influ_rader.history import FollowHistory
+from influ_rader.jobs import JobQueue
+from influ_rader.metrics import CRAWL_JOBS, PHASE_SECONDS, RunProfiler
+from influ_rader.notify import Diff, Notifier, Trend, build_notifier
+from influ_rader.precheck import ChangeDetector
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.schedule import PollScheduler
+from influ_rader.shard import ShardedCrawler
+from influ_rader.storage import Storage, UsersFollowings
+from influ_rader.targets import TargetRegistry
+from influ_rader.trending import CoFollow, TrendIndex
+from influ_rader.twitter import Twitter
 
 
 class TwitterCog(commands.Cog):
-    def __init__(self, bot: commands.Bot, twitter: Twitter, db: Db, target_users: List[str], channel: int) -> None:
+    RETRY_INTERVAL = 60  # 失敗したジョブを再実行できるか確認する間隔(秒)
+
+    def __init__(
+        self,
+        bot: commands.Bot,
+        twitter: Twitter,
+        db: Storage,
+        target_users: List[str],
+        channel: int,
+        executor: Optional[BoundedExecutor] = None,
+        crawler: Optional[ShardedCrawler] = None,
+        jobs: Optional[JobQueue] = None,
+        scheduler: Optional[PollScheduler] = None,
+        detector: Optional[ChangeDetector] = None,
+        profiler: Optional[RunProfiler] = None,
+        notifier: Optional[Notifier] = None,
+        history: Optional[FollowHistory] = None,
+        trends: Optional[TrendIndex] = None,
+        registry: Optional[TargetRegistry] = None,
+        enricher: Optional[Enricher] = None,
+        fetch_executor: Optional[BoundedExecutor] = None,
+    ) -> None:
         super().__init__()
         self.bot = bot
-        self.twitter = twitter
-        self.db = db
-        self.channel_id = channel
-        try:
-            self.target_user_ids = [u.id for u in self.twitter.get_users(target_users)]
-        except TwitterRequestError:
-            logger.exception("Failed to get user ids.")
-            raise
+        # Twitter/DBへのリクエストはスレッドプールで実行して、Discordのイベントループをブロックしないようにする
+        self.executor = executor or BoundedExecutor()
+        # Twitterへのリクエストはレート制限で最大15分待つことがあるので、DBやジョブの記録とは別のスレッドプールで実行する
+        # 指定しなければ、executorと同じワーカ数のスレッドプールを作る
+        self.fetch_executor = fetch_executor or BoundedExecutor(self.executor.max_workers)
+        self.twitter = AsyncTwitter(twitter, self.fetch_executor)
+        self.db = AsyncDb(db, self.executor)
+        # crawlerを指定した場合、followingの取得は対象ユーザを分割して複数のワーカプロセスで行う
+        self.crawler = crawler
+        # 対象ユーザごとのfollowing取得をジョブとして記録し、失敗した対象ユーザだけを再実行する
+        self.jobs = jobs or JobQueue()
+        # 対象ユーザごとの取得間隔は、過去の差分の頻度から決める
+        self.scheduler = scheduler or PollScheduler()
+        # フォロー数が変わっていない対象ユーザはfollowingの取得を省略する
+        self.detector = detector or ChangeDetector()
+        # ディレクトリを指定した場合、runごとにcProfileの結果を保存する
+        self.profiler = profiler or RunProfiler()
+        # 差分は通知先ごとのキューに入れて別のタスクで送り、差分を取るループを止めないようにする
+        # 指定しなければ、channelのチャンネルに全ての対象ユーザの差分を投稿する
+        self.notifier = notifier or build_notifier(bot, channel)
+        # 指定した場合、保存した差分をフォロー/フォロー解除のイベントとして記録する
+        self.history = history
+        # 指定した場合、複数の対象ユーザが短期間にフォローしたユーザをまとめて通知する
+        self.trends = trends
+        if trends is not None and history is not None:
+            try:
+                trends.load(history.targets(), history.changes(trends.clock.time() - trends.window))
+            except DbOperationError:
+                logger.error("Failed to load follow events. Trends start from scratch.")
+        # 対象ユーザはコマンドで追加/削除できる。ユーザIDの解決はループの中で行い、Botの起動を待たせない
+        self.registry = registry or TargetRegistry()
+        self.registry.seed(target_users)
+        # 指定した場合、新しくフォローされたユーザの詳細を別のタスクで取得してから通知する
+        self.enricher = enricher
+        self.__lookup_users = twitter.lookup_users
+        self.__lock = asyncio.Lock()
         self.diff_users_followings.start()
+        self.retry_crawl_jobs.start()
 
-    @tasks.loop(hours=24)  # 1日に1回実行する
+    @tasks.loop(seconds=RateLimiter.WINDOW)  # レート制限のウィンドウごとに、取得時刻を迎えた対象ユーザを取得する
     async def diff_users_followings(self) -> None:
+        """
+        取得時刻を迎えた対象ユーザのfollowing取得ジョブを作って実行する
+        前回のrunが終わっていなければ(再起動した場合など)、終わっていないジョブだけを続きから実行する
+        """
+        # 想定していない例外でtasks.loopが止まる(以降取得しなくなる)ことがないように、ログに残して次のループを待つ
         try:
-            result_twitter = self.__get_users_following_from_twitter(self.target_user_ids)
-            result_db = self.__get_users_followings_from_db(self.target_user_ids)
-        except TwitterRequestError:
-            logger.error("Failed to get results via Twitter API...")
-            return
+            with self.profiler.profile("diff_users_followings"):
+                await self.__diff_users_followings()
+        except Exception:
+            logger.exception("Some problem occurred on diffing users followings...")
+
+    async def __diff_users_followings(self) -> None:
+        with PHASE_SECONDS.time(phase="resolve"):
+            await self.resolve_targets()
+        try:
+            with PHASE_SECONDS.time(phase="schedule"):
+                target_user_ids = await self.executor.run(self.registry.active_ids)
+                due_user_ids = await self.executor.run(self.scheduler.due, target_user_ids)
+            with PHASE_SECONDS.time(phase="precheck"):
+                crawl_user_ids = await self.__precheck(due_user_ids)
+            await self.executor.run(self.jobs.start_run, crawl_user_ids)
         except DbOperationError:
-            logger.error("Failed to get results via Database API...")
+            logger.error("Failed to start crawl jobs...")
             return
-        except Exception:
-            logger.error("Some problem occurred on getting results...")
+        await self.__run_jobs()
+        logger.info(f"Pre-check saved {self.detector.take_saved_requests()} following requests")
+
+    async def resolve_targets(self) -> None:
+        """
+        まだユーザIDを解決していない対象ユーザだけをまとめて解決する
+        見つからないユーザ名は隔離し、リクエストに失敗したバッチは次のループで解決し直す
+        """
+        try:
+            resolved, _ = await self.fetch_executor.run(self.registry.resolve, self.__lookup_users)
+        except DbOperationError:
+            logger.error("Failed to update target users...")
             return
-        diff_twitter_db = await self.diff_users_followings_twitter_db(result_twitter, result_db)
-        await self.diff_users_followings_db_twitter(result_db, result_twitter)
+        if resolved:
+            logger.info(f"Resolved target users `{resolved}`")
+            await self.twitter.save_cache()
 
+    @tasks.loop(seconds=RETRY_INTERVAL)
+    async def retry_crawl_jobs(self) -> None:
+        """
+        失敗したジョブを、待ち時間が過ぎたものから再実行する
+        """
         try:
-            await self.__display(diff_twitter_db)
-        except BotError:
-            logger.error("Failed to post results to the discord...")
-
-    async def diff_users_followings_twitter_db(
-        self, from_twitter: dict[str, List[str]], from_db: dict[str, List[str]]
-    ) -> dict[str, List[str]]:
-        diff = self.__diff_users_followings_twitter_db(from_twitter, from_db)
-        self.__add_users_followings(diff)
-        return diff
-
-    async def diff_users_followings_db_twitter(
-        self, from_db: dict[str, List[str]], from_twitter: dict[str, List[str]]
-    ) -> None:
-        diff = self.__diff_users_followings_db_twitter(from_db, from_twitter)
-        self.__remove_users_followings(diff)
+            if not await self.executor.run(self.jobs.has_open_run):
+                return
+        except DbOperationError:
+            logger.error("Failed to get crawl jobs...")
+            return
+        try:
+            await self.__run_jobs()
+        except Exception:
+            logger.exception("Some problem occurred on retrying crawl jobs...")
 
     @diff_users_followings.before_loop
+    @retry_crawl_jobs.before_loop
     async def before_diff_user_following(self) -> None:
         logger.info("Waiting for the bot to be ready...")
         await self.bot.wait_until_ready()
 
-    def __get_user_followings_from_twitter(self, user_id: int) -> List[str]:
-        try:
-            following = self.twitter.get_user_id_following(user_id)
-        except TwitterRequestError:
-            logger.exception("Failed to get user following.")
-            raise
-        return [str(f) for f in following]
-
-    def __get_users_following_from_twitter(self, user_ids: List[int]) -> dict[str, List[str]]:
-        users_following: dict[str, List[str]] = {}
+    async def __precheck(self, user_ids: List[int]) -> List[int]:
+        """
+        対象ユーザのフォロー数をまとめて取得し、followingを取得する必要がある対象ユーザだけを返す
+        フォロー数が前回から変わっていない対象ユーザは、変化なしとして次の取得時刻を決める
+        """
+        if not user_ids:
+            return user_ids
         try:
-            for user_id in user_ids:
-                following = self.__get_user_followings_from_twitter(user_id)
-                if following is not None:
-                    users_following[str(user_id)] = following
+            counts = await self.twitter.get_following_counts(user_ids)
         except TwitterRequestError:
-            logger.exception("Failed to get users following from Twitter")
-            raise
-        return users_following
-
-    def __get_user_followings_from_db(self, user_id: str) -> List[str]:
-        user = self.db.get(user_id)
-        if user is None or "followings" not in user:
-            return []
-        return user["followings"]
-
-    def __get_users_followings_from_db(self, user_ids: List[str]) -> dict[str, List[str]]:
-        users_following: dict[str, List[str]] = {}
-        try:
-            for user_id in user_ids:
-                following = self.__get_user_followings_from_db(str(user_id))
-                if following:
-                    users_following[str(user_id)] = following
-        except DbOperationError:
-            logger.exception("Failed to get users following from DB")
-            raise
-        return users_following
-
-    def __diff_list(self, src: List[str], dst: List[str]) -> List[str]:
-        return list(set(src) - set(dst))
-
-    def __diff_user_followings_twitter_db(self, from_twitter: List[str], from_db: List[str]) -> List[str]:
-        return self.__diff_list(from_twitter, from_db)
+            logger.warning("Failed to get following counts. Crawl all due target users.")
+            counts = {}
+        plans = await self.executor.run(self.detector.plan, counts, user_ids)
+        skipped = [u for u in user_ids if plans[u] == ChangeDetector.SKIP]
+        for user_id in skipped:
+            pages = max(math.ceil(counts[user_id] / Twitter.FOLLOWING_MAX_RESULTS), 1)
+            self.detector.add_saved_requests(pages)
+            await self.executor.run(self.scheduler.record, user_id, 0, pages)
+            await self.executor.run(self.detector.update, user_id)
+        if skipped:
+            logger.info(f"Skip crawling user ids `{skipped}` whose following count did not change")
+        return [u for u in user_ids if plans[u] != ChangeDetector.SKIP]
 
-    def __diff_user_followings_db_twitter(self, from_db: List[str], from_twitter: List[str]) -> List[str]:
-        return self.__diff_list(from_db, from_twitter)
-
-    def __diff_users_followings_twitter_db(
-        self, from_twitter: dict[str, List[str]], from_db: dict[str, List[str]]
-    ) -> dict[str, List[str]]:
+    async def __run_jobs(self) -> None:
         """
-        Twitterからのレスポンスに含まれていて、DBに保存されていないfollowingsを抽出する
-        対象のユーザが新たにフォローした人を抽出できる想定
+        実行できるジョブの対象ユーザのfollowingを取得し、取得できた対象ユーザの分だけ差分を取って保存・投稿する
+        一部の対象ユーザで失敗しても、他の対象ユーザの結果は捨てずにジョブを完了させる
         """
-        return {
-            k: self.__diff_user_followings_twitter_db(v, from_db[k]) if k in from_db else v
-            for k, v in from_twitter.items()
-        }
-
-    def __diff_users_followings_db_twitter(
-        self, from_db: dict[str, List[str]], from_twitter: dict[str, List[str]]
-    ) -> dict[str, List[str]]:
+        async with self.__lock:
+            try:
+                user_ids = await self.executor.run(self.jobs.runnable)
+                if not user_ids:
+                    return
+                await self.executor.run(self.jobs.start, user_ids)
+                with PHASE_SECONDS.time(phase="crawl"):
+                    result_twitter = await self.__get_users_following_from_twitter(user_ids)
+                if not result_twitter:
+                    return
+                try:
+                    with PHASE_SECONDS.time(phase="diff"):
+                        added, removed = await self.db.diff_users_followings(result_twitter)
+                    with PHASE_SECONDS.time(phase="save"):
+                        await self.db.save_users_followings(added, removed)
+                except DbOperationError:
+                    logger.error("Failed to save results to the database...")
+                    await self.executor.run(self.jobs.fail, list(result_twitter), "Failed to save results")
+                    CRAWL_JOBS.inc(len(result_twitter), result="failed")
+                    return
+                await self.executor.run(self.jobs.complete, list(result_twitter))
+                CRAWL_JOBS.inc(len(result_twitter), result="done")
+            except DbOperationError:
+                logger.error("Failed to update crawl jobs...")
+                return
+            with PHASE_SECONDS.time(phase="reschedule"):
+                await self.__reschedule(result_twitter, added, removed)
+            if self.history is not None:
+                # 記録に失敗しても差分は保存済みなので、ジョブは失敗にしない
+                try:
+                    with PHASE_SECONDS.time(phase="history"):
+                        await self.executor.run(self.history.record, result_twitter, added, removed)
+                except DbOperationError:
+                    logger.error("Failed to record follow events...")
+            logger.info(f"Add followings for user ids `{[k for k, v in added.items() if v]}`")
+            logger.info(f"Remove followings for user ids `{[k for k, v in removed.items() if v]}`")
+
+            co_follows: List[CoFollow] = []
+            if self.trends is not None:
+                with PHASE_SECONDS.time(phase="trending"):
+                    co_follows = self.trends.apply(result_twitter, added, removed)
+            with PHASE_SECONDS.time(phase="notify"):
+                await self.__notify(added, co_follows)
+            await self.twitter.save_cache()
+
+    async def __reschedule(
+        self, result_twitter: Dict[int, "array[int]"], added: UsersFollowings, removed: UsersFollowings
+    ) -> None:
         """
-        DBに保存されていて、Twitterからのレスポンスに含まれていないfollowingsを抽出する
-        対象のユーザがフォロー解除した人を抽出できる想定
+        取得できた対象ユーザの変化数から、次に取得する時刻を決める
         """
-        return {
-            k: self.__diff_user_followings_db_twitter(v, from_twitter[k]) if k in from_twitter else v
-            for k, v in from_db.items()
-        }
-
-    def __add_user_followings(self, key: str, value: List[str]) -> None:
         try:
-            if self.db.has_record(key):
-                self.db.add_to_array(key, "followings", value)
-            else:
-                self.db.add(key, {"followings": value})
+            for user_id, following in result_twitter.items():
+                changes = len(added.get(user_id, [])) + len(removed.get(user_id, []))
+                pages = math.ceil(len(following) / Twitter.FOLLOWING_MAX_RESULTS)
+                await self.executor.run(self.scheduler.record, user_id, changes, pages)
+                await self.executor.run(self.detector.update, user_id)
         except DbOperationError:
+            logger.error("Failed to update poll schedules...")
             return
+        logger.info(f"Detection latency: `{self.scheduler.detection_latency()}`")
+
+    async def __get_users_following_from_twitter(self, user_ids: List[int]) -> Dict[int, "array[int]"]:
+        """
+        対象ユーザごとにfollowingを取得し、取得できた対象ユーザの分だけを返す
+        失敗した対象ユーザのジョブは失敗として記録する(途中までのページはcheckpointに残る)
+        crawlerを指定した場合は、全ての対象ユーザを1回で渡してシャードに分割させ、対象ユーザごとの結果を受け取る
+        """
+        results: Sequence[Union["array[int]", BaseException]]
+        if self.crawler is not None:
+            crawled = await self.crawler.get_users_id_following(user_ids)
+            results = [crawled[u] for u in user_ids]
         else:
-            logger.info(f"Add followings for user id `{key}`")
+            results = await asyncio.gather(*[self.__get_user_following(u) for u in user_ids], return_exceptions=True)
+        fetched: Dict[int, "array[int]"] = {}
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, BaseException):
+                logger.opt(exception=result).error(f"Failed to get following of user id `{user_id}` from Twitter")
+                await self.executor.run(self.jobs.fail, [user_id], repr(result))
+                CRAWL_JOBS.inc(result="failed")
+            else:
+                fetched[user_id] = result
+        return fetched
 
-    def __add_users_followings(self, diffs: dict[str, List[str]]) -> None:
-        for k, v in diffs.items():
-            if v:  # MEMO: 差分があるときだけ実行する
-                self.__add_user_followings(k, v)
+    async def __get_user_following(self, user_id: int) -> "array[int]":
+        expected_new = self.detector.expected_new(user_id)
+        if expected_new is not None:
+            # フォロー数が増えただけなら、新しくフォローしたユーザが含まれる先頭のページだけを取得する
+            known = (await self.db.get_snapshots([user_id]))[user_id]
+            following, pages = await self.twitter.get_user_id_following_since(user_id, known, expected_new)
+            saved = math.ceil(len(following) / Twitter.FOLLOWING_MAX_RESULTS) - pages
+            if saved > 0:
+                self.detector.crawled_partially(user_id)
+                self.detector.add_saved_requests(saved)
+            return following
+        return await self.twitter.get_user_id_following(user_id)
 
-    def __remove_user_followings(self, key: str, value: List[str]) -> None:
-        if not self.db.has_record(key):
+    async def __notify(self, diffs: UsersFollowings, co_follows: List[CoFollow]) -> None:
+        # 新しくフォローしたユーザがいる対象ユーザと、フォローされたユーザをまとめて取得する
+        diffs = {k: v for k, v in diffs.items() if v}
+        lookup_ids = list(diffs.keys()) + [v for following_user_ids in diffs.values() for v in following_user_ids]
+        # トレンドの対象ユーザには、今回の差分にない対象ユーザも含まれる
+        lookup_ids += [t for c in co_follows for t in c.target_ids if t not in diffs]
+        if not lookup_ids:
             return
         try:
-            self.db.remove_from_array(key, "followings", value)
-        except DbOperationError:
+            users = {u.id: u for u in await self.twitter.get_users_by_ids(lookup_ids)}
+        except TwitterRequestError:
+            logger.exception("Failed to get users info from Twitter API")
             return
-        else:
-            logger.info(f"Remove followings for user id `{key}`")
-
-    def __remove_users_followings(self, diffs: dict[str, List[str]]) -> None:
-        for k, v in diffs.items():
-            if v:  # MEMO: 差分があるときだけ実行する
-                self.__remove_user_followings(k, v)
-
-    async def __display(self, diffs: dict[str, List[str]]) -> None:
-        url = "https://twitter.com/"
-        channel = self.bot.get_channel(self.channel_id)
-        if channel is None:
-            logger.error(f"Failed to get a channel with id `{self.channel_id}`")
-            raise BotError
 
+        notifications: List[Diff] = []
         for target_user_id, following_user_ids in diffs.items():
-            try:
-                target_user = self.twitter.get_user(int(target_user_id))
-                user_ids = [int(v) for v in following_user_ids]
-                usernames = [f"{url}{v.username}" for v in self.twitter.get_users_by_ids(user_ids)]
-            except TwitterRequestError:
+            target_user = users.get(target_user_id)
+            if target_user is None:
                 continue
-            if usernames:
-                try:
-                    message = f"**{target_user.name}(@{target_user.username})**が新しくフォローしたアカウント\n" + "\n".join(usernames)
-                    await channel.send(message)
-                except HTTPException:
-                    logger.exception("Cannot send message to the discord channel.")
+            followings = [users[v] for v in following_user_ids if v in users]
+            if followings:
+                notifications.append(Diff(target_user, followings))
+        trends = [
+            Trend(users[c.user_id], [users[t] for t in c.target_ids if t in users])
+            for c in co_follows
+            if c.user_id in users
+        ]
+        if self.enricher is not None:
+            # 詳細の取得は待たずに戻り、取得できたら(できなくても)Enricherが通知先に振り分ける
+            self.enricher.submit(notifications, trends, self.notifier.publish)
+        else:
+            self.notifier.publish(notifications, trends)
@@ -1,9 +1,12 @@
+import json
 import os
-from typing import List
+from typing import Any, Dict, List, Optional
 
-from error import ReadEnvError
 from loguru import logger
 
+from influ_rader.codec import available_compressions
+from influ_rader.error import ReadEnvError
+
 
 class Config:
     GOOGLE = "GOOGLE_APPLICATION_CREDENTIALS"
@@ -11,17 +14,97 @@ class Config:
     DISCORD = "DISCORD_BOT_TOKEN"
     CHANNEL = "DISCORD_CHANNEL_ID"
     TARGETS = "TARGET_USERS"
-    ENVIRONMENTAL_VARIABLES = [GOOGLE, TWITTER, DISCORD, CHANNEL, TARGETS]
+    ENVIRONMENTAL_VARIABLES = [TWITTER, DISCORD, CHANNEL, TARGETS]
+    # 以下は任意の環境変数
+    CONCURRENCY = "FETCH_CONCURRENCY"
+    DEFAULT_CONCURRENCY = 4
+    STORAGE = "STORAGE_BACKEND"
+    STORAGE_BACKENDS = ["firestore", "sqlite"]
+    SQLITE = "SQLITE_PATH"
+    SNAPSHOT_COMPRESSION = "SNAPSHOT_COMPRESSION"
+    DEFAULT_SNAPSHOT_COMPRESSION = "zlib"
+    DEFAULT_SQLITE_PATH = "influ_rader.sqlite3"
+    USER_CACHE_PATH = "USER_CACHE_PATH"
+    USER_CACHE_SIZE = "USER_CACHE_SIZE"
+    DEFAULT_USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = "USER_CACHE_TTL"
+    DEFAULT_USER_CACHE_TTL = 24 * 60 * 60  # 1日
+    SHARDS = "CRAWL_SHARDS"
+    DEFAULT_SHARDS = 1
+    JOB_DB_PATH = "JOB_DB_PATH"
+    DEFAULT_JOB_DB_PATH = "influ_rader_jobs.sqlite3"
+    JOB_MAX_ATTEMPTS = "JOB_MAX_ATTEMPTS"
+    DEFAULT_JOB_MAX_ATTEMPTS = 5
+    POLL_MIN_INTERVAL = "POLL_MIN_INTERVAL"
+    DEFAULT_POLL_MIN_INTERVAL = 60 * 60  # 1時間
+    POLL_MAX_INTERVAL = "POLL_MAX_INTERVAL"
+    DEFAULT_POLL_MAX_INTERVAL = 7 * 24 * 60 * 60  # 1週間
+    FULL_CRAWL_INTERVAL = "FULL_CRAWL_INTERVAL"
+    DEFAULT_FULL_CRAWL_INTERVAL = 7 * 24 * 60 * 60  # 1週間
+    METRICS_PORT = "METRICS_PORT"
+    METRICS_HOST = "METRICS_HOST"
+    DEFAULT_METRICS_HOST = "127.0.0.1"
+    PROFILE_DIR = "PROFILE_DIR"
+    HISTORY_DB_PATH = "HISTORY_DB_PATH"
+    DEFAULT_HISTORY_DB_PATH = "influ_rader_history.sqlite3"
+    NOTIFY_SINKS = "NOTIFY_SINKS"
+    NOTIFY_SINK_TYPES = {"discord": [], "webhook": ["url"], "file": ["path"]}  # 通知先の種類ごとの必須のキー
+    NOTIFY_CONCURRENCY = "NOTIFY_CONCURRENCY"
+    DEFAULT_NOTIFY_CONCURRENCY = 4
+    TRENDING_WINDOW = "TRENDING_WINDOW"
+    DEFAULT_TRENDING_WINDOW = 7 * 24 * 60 * 60  # 1週間
+    TRENDING_MIN_TARGETS = "TRENDING_MIN_TARGETS"
+    DEFAULT_TRENDING_MIN_TARGETS = 3
+    MEASURE_STARTUP = "MEASURE_STARTUP"
+    RECORD_ARCHIVE = "RECORD_ARCHIVE"
+    ENRICH_USER_FIELDS = "ENRICH_USER_FIELDS"
+    DEFAULT_ENRICH_USER_FIELDS = ["description", "public_metrics", "created_at", "verified"]
+    # users lookupで指定できるuser.fields
+    USER_FIELDS = [
+        "created_at",
+        "description",
+        "entities",
+        "location",
+        "pinned_tweet_id",
+        "profile_image_url",
+        "protected",
+        "public_metrics",
+        "url",
+        "verified",
+        "withheld",
+    ]
+    ENRICH_WORKERS = "ENRICH_WORKERS"
+    DEFAULT_ENRICH_WORKERS = 2
+    ENRICH_BUDGET = "ENRICH_BUDGET"
+    DEFAULT_ENRICH_BUDGET = 100
+    ENRICH_CACHE_TTL = "ENRICH_CACHE_TTL"
+    DEFAULT_ENRICH_CACHE_TTL = 7 * 24 * 60 * 60  # 1週間
 
     def __init__(self) -> None:
         self.__load_environmental_variable()
 
     def __load_environmental_variable(self) -> None:
+        self.storage_backend = os.environ.get(self.STORAGE) or self.STORAGE_BACKENDS[0]
+        if self.storage_backend not in self.STORAGE_BACKENDS:
+            logger.error(f"Storage backend should be one of `{self.STORAGE_BACKENDS}`")
+            raise ReadEnvError
         if not self.__validate_environmental_variables():
             raise ReadEnvError
-        self.google_credential = os.environ.get(self.GOOGLE)
-        self.twitter_barear_token = os.environ.get(self.TWITTER)
-        self.discord_bot_token = os.environ.get(self.DISCORD)
+        # Firestoreを使う場合のみGoogleの認証情報が必要
+        self.google_credential = os.environ.get(self.GOOGLE, "")
+        self.sqlite_path = os.environ.get(self.SQLITE) or self.DEFAULT_SQLITE_PATH
+        # Firestoreに保存するスナップショットの圧縮形式(zstdはzstandardがインストールされている場合のみ)
+        self.snapshot_compression = os.environ.get(self.SNAPSHOT_COMPRESSION) or self.DEFAULT_SNAPSHOT_COMPRESSION
+        if self.snapshot_compression not in available_compressions():
+            logger.error(f"`{self.SNAPSHOT_COMPRESSION}` should be one of `{available_compressions()}`")
+            raise ReadEnvError
+        # カンマ区切りで複数のBearer Tokenを指定できる(リクエストごとに振り分けるか、シャードごとに使い分ける)
+        self.twitter_barear_tokens = [t for t in os.environ[self.TWITTER].replace(" ", "").split(",") if t]
+        if not self.twitter_barear_tokens:
+            logger.error(f"`{self.TWITTER}` should contain at least one token")
+            raise ReadEnvError
+        self.twitter_barear_token = self.twitter_barear_tokens[0]
+        self.discord_bot_token = os.environ[self.DISCORD]
         try:
             self.discord_channel_id = int(os.environ.get(self.CHANNEL) or "")
         except ValueError:
@@ -35,9 +118,90 @@ class Config:
         except ReadEnvError:
             logger.exception("Target users should be more than one")
             raise
+        self.fetch_concurrency = self.__load_positive_int(self.CONCURRENCY, self.DEFAULT_CONCURRENCY)
+        self.user_cache_path = os.environ.get(self.USER_CACHE_PATH) or None
+        self.user_cache_size = self.__load_positive_int(self.USER_CACHE_SIZE, self.DEFAULT_USER_CACHE_SIZE)
+        self.user_cache_ttl = self.__load_positive_int(self.USER_CACHE_TTL, self.DEFAULT_USER_CACHE_TTL)
+        self.crawl_shards = self.__load_positive_int(self.SHARDS, self.DEFAULT_SHARDS)
+        self.job_db_path = os.environ.get(self.JOB_DB_PATH) or self.DEFAULT_JOB_DB_PATH
+        self.job_max_attempts = self.__load_positive_int(self.JOB_MAX_ATTEMPTS, self.DEFAULT_JOB_MAX_ATTEMPTS)
+        self.poll_min_interval = self.__load_positive_int(self.POLL_MIN_INTERVAL, self.DEFAULT_POLL_MIN_INTERVAL)
+        self.poll_max_interval = self.__load_positive_int(self.POLL_MAX_INTERVAL, self.DEFAULT_POLL_MAX_INTERVAL)
+        self.full_crawl_interval = self.__load_positive_int(self.FULL_CRAWL_INTERVAL, self.DEFAULT_FULL_CRAWL_INTERVAL)
+        # 指定した場合のみ、メトリクスを`/metrics`で公開する
+        self.metrics_port: Optional[int] = None
+        if os.environ.get(self.METRICS_PORT):
+            self.metrics_port = self.__load_positive_int(self.METRICS_PORT, 0)
+        self.metrics_host = os.environ.get(self.METRICS_HOST) or self.DEFAULT_METRICS_HOST
+        self.profile_dir = os.environ.get(self.PROFILE_DIR) or None
+        self.history_db_path = os.environ.get(self.HISTORY_DB_PATH) or self.DEFAULT_HISTORY_DB_PATH
+        self.notify_sinks = self.__load_notify_sinks()
+        self.notify_concurrency = self.__load_positive_int(self.NOTIFY_CONCURRENCY, self.DEFAULT_NOTIFY_CONCURRENCY)
+        self.trending_window = self.__load_positive_int(self.TRENDING_WINDOW, self.DEFAULT_TRENDING_WINDOW)
+        self.trending_min_targets = self.__load_positive_int(
+            self.TRENDING_MIN_TARGETS, self.DEFAULT_TRENDING_MIN_TARGETS
+        )
+        # 有効にすると、準備完了とクライアントの初期化までの時間を計測して終了する
+        self.measure_startup = os.environ.get(self.MEASURE_STARTUP, "").lower() in ("1", "true", "yes")
+        # 指定した場合、APIのレスポンスとストレージの状態をこのファイルに記録する(python -m influ_rader.replayで再生する)
+        self.record_archive = os.environ.get(self.RECORD_ARCHIVE) or None
+        # 新しくフォローされたユーザの詳細として取得するフィールド(noneを指定すると詳細を取得しない)
+        self.enrich_user_fields = self.__load_enrich_user_fields()
+        self.enrich_workers = self.__load_positive_int(self.ENRICH_WORKERS, self.DEFAULT_ENRICH_WORKERS)
+        self.enrich_budget = self.__load_positive_int(self.ENRICH_BUDGET, self.DEFAULT_ENRICH_BUDGET)
+        self.enrich_cache_ttl = self.__load_positive_int(self.ENRICH_CACHE_TTL, self.DEFAULT_ENRICH_CACHE_TTL)
+        if self.poll_min_interval > self.poll_max_interval:
+            logger.error(f"`{self.POLL_MIN_INTERVAL}` should not be greater than `{self.POLL_MAX_INTERVAL}`")
+            raise ReadEnvError
+
+    def __load_positive_int(self, name: str, default: int) -> int:
+        try:
+            value = int(os.environ.get(name) or default)
+            if value < 1:
+                raise ValueError
+        except ValueError:
+            logger.exception(f"`{name}` should be positive integer value")
+            raise ReadEnvError
+        return value
+
+    def __load_enrich_user_fields(self) -> List[str]:
+        value = os.environ.get(self.ENRICH_USER_FIELDS)
+        if not value:
+            return list(self.DEFAULT_ENRICH_USER_FIELDS)
+        if value.strip().lower() == "none":
+            return []
+        fields = [f for f in value.replace(" ", "").split(",") if f]
+        unknown = [f for f in fields if f not in self.USER_FIELDS]
+        if unknown:
+            logger.error(f"`{self.ENRICH_USER_FIELDS}` should be `none` or some of `{self.USER_FIELDS}`: `{unknown}`")
+            raise ReadEnvError
+        return fields
+
+    def __load_notify_sinks(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        通知先の設定(JSONの配列)を読み込む
+        例: [{"type": "discord", "channel_id": 123, "targets": ["username1"]}, {"type": "file", "path": "diffs.jsonl"}]
+        """
+        value = os.environ.get(self.NOTIFY_SINKS)
+        if not value:
+            return None
+        try:
+            sinks = json.loads(value)
+            if not isinstance(sinks, list) or not sinks:
+                raise ValueError
+            for sink in sinks:
+                required = self.NOTIFY_SINK_TYPES[sink["type"]]
+                if any(k not in sink for k in required) or not isinstance(sink.get("targets", []), list):
+                    raise ValueError
+        except (ValueError, TypeError, KeyError):
+            types = list(self.NOTIFY_SINK_TYPES)
+            logger.exception(f"`{self.NOTIFY_SINKS}` should be a json array of sinks of type `{types}`")
+            raise ReadEnvError
+        return sinks
 
     def __validate_environmental_variables(self) -> bool:
-        unset_variables = [v for v in self.ENVIRONMENTAL_VARIABLES if os.environ.get(v) is None]
+        required = self.ENVIRONMENTAL_VARIABLES + ([self.GOOGLE] if self.storage_backend == "firestore" else [])
+        unset_variables = [v for v in required if os.environ.get(v) is None]
         if unset_variables:
             logger.error(f"Failed to read these environmental variables: `{unset_variables}`")
             return False
@@ -0,0 +1,138 @@
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from loguru import logger
+
+from influ_rader.error import TwitterRequestError
+from influ_rader.metrics import CREDENTIAL_REQUESTS, RATE_LIMIT_WAIT_SECONDS, RATE_LIMIT_WAITS
+from influ_rader.rate_limit import Clock, RateLimiter
+from influ_rader.transport import Transport
+
+# Bearer Tokenからtweepy.Client(と同じメソッドを持つオブジェクト)を作る関数
+ClientFactory = Callable[[str], Any]
+
+
+def create_client(bearer_token: str, transport: Optional[Transport] = None) -> Any:
+    """
+    tweepyのクライアントを作る(tweepyの読み込みに時間がかかるので、最初に使う時に読み込む)
+    transportを指定すると、そのHTTP接続を他のクライアントと共有する
+    """
+    from influ_rader.twitter_client import Client
+
+    return Client(bearer_token=bearer_token, session=transport.session if transport is not None else None)
+
+
+class Credential:
+    """
+    Bearer Token1つ分のクライアント、エンドポイントごとのレート制限と利用状況
+    name: ログやメトリクスに出す名前(Bearer Tokenそのものは出さない)
+    disabled_until: 無効になった(401が返された)Bearer Tokenを、ローテーションに戻して確認し直す時刻
+    stats: リクエストの結果(ok/error/rate_limited/unauthorized)ごとの回数
+    """
+
+    def __init__(self, name: str, bearer_token: str, rate_limiter: RateLimiter, client_factory: ClientFactory) -> None:
+        self.name = name
+        self.rate_limiter = rate_limiter
+        self.disabled_until: Optional[float] = None
+        self.stats: Counter[str] = Counter()
+        self.__bearer_token = bearer_token
+        self.__client_factory = client_factory
+        self.__client: Optional[Any] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def client(self) -> Any:
+        with self.__lock:
+            if self.__client is None:
+                self.__client = self.__client_factory(self.__bearer_token)
+            return self.__client
+
+    def record(self, endpoint: str, result: str) -> None:
+        self.stats[result] += 1
+        CREDENTIAL_REQUESTS.inc(credential=self.name, endpoint=endpoint, result=result)
+
+
+class CredentialPool:
+    """
+    複数のBearer Tokenにリクエストを振り分けるクラス
+
+    リクエストごとに、そのエンドポイントの残りリクエスト数が最も多いBearer Tokenを選ぶ
+    全てのBearer Tokenの枠を使い切っていれば、最も早くリセットされるBearer Tokenのリセット時刻まで待機する
+    429が返されたBearer Tokenは、そのエンドポイントの枠がリセットされるまで選ばれない
+    401が返された(失効した)Bearer Tokenはローテーションから外し、revoked_interval秒後に戻して確認し直す
+    """
+
+    REVOKED_INTERVAL = 60 * 60  # 失効したBearer Tokenを確認し直すまでの時間(1時間)
+
+    def __init__(
+        self,
+        bearer_tokens: Sequence[str],
+        rate_limiter: Optional[RateLimiter] = None,
+        client_factory: Optional[ClientFactory] = None,
+        revoked_interval: float = REVOKED_INTERVAL,
+    ) -> None:
+        """
+        rate_limiter: 最初のBearer Tokenのレート制限(2つ目以降のBearer Tokenは、同じ時計と上限で別に管理する)
+        """
+        tokens = list(dict.fromkeys(bearer_tokens))
+        if not tokens:
+            raise ValueError("At least one bearer token is required")
+        rate_limiter = rate_limiter or RateLimiter()
+        self.clock: Clock = rate_limiter.clock
+        self.revoked_interval = revoked_interval
+        self.credentials: List[Credential] = [
+            Credential(
+                f"token{i + 1}",
+                token,
+                rate_limiter if i == 0 else rate_limiter.clone(),
+                client_factory or create_client,
+            )
+            for i, token in enumerate(tokens)
+        ]
+        self.__lock = threading.Lock()
+
+    def acquire(self, endpoint: str) -> Credential:
+        """
+        エンドポイントの枠が最も残っているBearer Tokenを選び、枠を1つ確保して返す
+        全てのBearer Tokenが失効している場合はTwitterRequestErrorを投げる
+        """
+        while True:
+            with self.__lock:
+                candidates = self.__enabled()
+                if not candidates:
+                    logger.error("All bearer tokens are revoked. Recheck them later.")
+                    raise TwitterRequestError()
+                remaining = [(c, *c.rate_limiter.remaining(endpoint)) for c in candidates]
+                credential, left, _ = max(remaining, key=lambda r: r[1])
+                if left > 0 and credential.rate_limiter.try_acquire(endpoint) <= 0:
+                    return credential
+                wait = min(w for _, _, w in remaining)
+            logger.warning(f"Twitter API request limit reached for `{endpoint}` on all tokens. Wait {wait:.0f}s.")
+            RATE_LIMIT_WAITS.inc(endpoint=endpoint)
+            RATE_LIMIT_WAIT_SECONDS.inc(wait, endpoint=endpoint)
+            self.clock.sleep(wait)
+
+    def revoke(self, credential: Credential) -> None:
+        """
+        401が返されたBearer Tokenをrevoked_interval秒間ローテーションから外す
+        """
+        with self.__lock:
+            credential.disabled_until = self.clock.time() + self.revoked_interval
+        logger.error(f"Bearer token `{credential.name}` was rejected. Recheck it in {self.revoked_interval:.0f}s.")
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Bearer Tokenごとの、リクエストの結果ごとの回数(とローテーションから外れているかどうか)を返す
+        """
+        with self.__lock:
+            enabled = self.__enabled()
+            return {c.name: {**c.stats, "disabled": int(c not in enabled)} for c in self.credentials}
+
+    def __enabled(self) -> List[Credential]:
+        now = self.clock.time()
+        for c in self.credentials:
+            if c.disabled_until is not None and c.disabled_until <= now:
+                logger.info(f"Recheck bearer token `{c.name}`")
+                c.disabled_until = None
+        return [c for c in self.credentials if c.disabled_until is None]
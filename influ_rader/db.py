@@ -1,33 +1,171 @@
 import json
-from typing import Any, List, Optional
+import threading
+from typing import Any, Iterator, List, Optional, Tuple
 
-import firebase_admin
-from error import DbInitializeError, DbOperationError
-from firebase_admin import credentials, firestore
 from loguru import logger
-from requests import JSONDecodeError
 
+from influ_rader.codec import decode_ids, encode_ids
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.metrics import DB_OPERATION_SECONDS, DB_RPCS, timed_method
+from influ_rader.storage import Storage, UsersFollowings
 
-class Db:
-    def __init__(self, credential: str) -> None:
+
+def _firestore() -> Any:
+    """
+    firebase_admin.firestoreモジュールを返す
+    Firestoreのクライアントライブラリ(gRPCなど)の読み込みには時間がかかるので、最初に使う時に読み込む
+    """
+    from firebase_admin import firestore
+
+    return firestore
+
+
+class WriteBatch:
+    """
+    複数ドキュメントへの書き込みをまとめて、1回のコミットでアトミックに反映するクラス
+    """
+
+    MAX_WRITES = 500  # Firestoreで1つのバッチに含められる書き込み数の上限
+    MAX_BYTES = 9 * 1024 * 1024  # 1回のコミットに含める書き込みのバイト数(Firestoreのリクエストの上限10MiBに余裕を持たせる)
+
+    def __init__(self, client: Any, collection: str) -> None:
+        self.__client = client
+        self.__collection = collection
+        # (コレクション, ドキュメントID, 書き込むフィールド(削除する場合はNone))のグループ
+        # コミットを分ける場合も、1つのグループの書き込みは同じコミットに含める
+        self.__groups: List[List[Tuple[str, str, Optional[dict[str, Any]]]]] = [[]]
+
+    def __len__(self) -> int:
+        return sum(len(g) for g in self.__groups)
+
+    def set(self, doc_id: str, data: dict[str, Any], collection: Optional[str] = None) -> None:
+        """
+        ドキュメントがなければ作成した上で、フィールドを更新する(merge)
+        collection: 書き込むコレクション(指定しなければバッチを作った時のコレクション)
+        """
+        self.__groups[-1].append((collection or self.__collection, doc_id, data))
+
+    def delete(self, doc_id: str, collection: Optional[str] = None) -> None:
+        self.__groups[-1].append((collection or self.__collection, doc_id, None))
+
+    def end_group(self) -> None:
+        """
+        ここまでの書き込みを1つのグループにする(以降の書き込みとは別のコミットに分けてよい)
+        """
+        if self.__groups[-1]:
+            self.__groups.append([])
+
+    def commit(self) -> None:
+        """
+        書き込みをコミットする
+        書き込み数かバイト数がFirestoreの上限を超える場合は、グループの区切りで上限ごとに分けてコミットする
+        (1つのグループだけで上限を超える場合は、そのグループも分ける)
+        """
         try:
-            info = self.__parse_credential_string(credential)
-            cred = self.__initialize_credential(info)
-            self.__initialize_firebase_app(cred)
-            self.__initialize_firestore()
-        except DbInitializeError:
-            raise
+            for writes in self.__split():
+                batch = self.__client.batch()
+                for collection, doc_id, data in writes:
+                    ref = self.__client.collection(collection).document(doc_id)
+                    if data is None:
+                        batch.delete(ref)
+                    else:
+                        batch.set(ref, data, merge=True)
+                DB_RPCS.inc(rpc="commit")
+                batch.commit()
+        except Exception:
+            logger.exception("Failed to commit a write batch")
+            raise DbOperationError
+        self.__groups = [[]]
+
+    def __split(self) -> Iterator[List[Tuple[str, str, Optional[dict[str, Any]]]]]:
+        writes: List[Tuple[str, str, Optional[dict[str, Any]]]] = []
+        size = 0
+        for group in self.__groups:
+            group_size = sum(_write_size(*w) for w in group)
+            if writes and (len(writes) + len(group) > self.MAX_WRITES or size + group_size > self.MAX_BYTES):
+                yield writes
+                writes, size = [], 0
+            for write in group:
+                write_size = _write_size(*write)
+                if writes and (len(writes) + 1 > self.MAX_WRITES or size + write_size > self.MAX_BYTES):
+                    logger.warning("A group of writes exceeds the commit limit. Split it into multiple commits.")
+                    yield writes
+                    writes, size = [], 0
+                writes.append(write)
+                size += write_size
+        if writes:
+            yield writes
+
+
+def _write_size(collection: str, doc_id: str, data: Optional[dict[str, Any]]) -> int:
+    """
+    書き込み1件のおおよそのバイト数(ドキュメントのパスと、フィールド名と値の大きさの合計)
+    bytes/str以外の値(数値やタイムスタンプ、削除の指定など)は1つ32バイトとみなす
+    """
+    size = len(collection) + len(doc_id) + 32
+    for key, value in (data or {}).items():
+        size += len(key) + (len(value) if isinstance(value, (bytes, str)) else 32)
+    return size
+
+
+class Db(Storage):
+    """
+    Firestoreにfollowingsを保存するストレージ
+    対象ユーザごとに`influencers`コレクションのドキュメントを作り、followingsのスナップショットを保存する
+
+    スナップショットはソート済みのユーザIDの差分を8バイト固定長で並べ、バイトの桁ごとに並べ替えて圧縮したバイト列(codec.encode_ids)で、
+    `snapshot`フィールドに保存する(10進数の文字列の配列と比べてドキュメントが小さく、読み込みも軽い)
+    chunk_sizeバイトを超える場合は分割し、2つ目以降は`influencer_snapshot_chunks`コレクションの
+    `{ユーザID}_{番号}`のドキュメントに保存して、分割数を`snapshot_chunks`に記録する
+    以前の形式(`followings`フィールドの文字列の配列)のドキュメントも読み込め、次に差分を保存する時に新しい形式に移す
+
+    認証情報の形式は作成時に確認するが、firebase_adminの読み込みとFirestoreのクライアントの初期化は
+    最初にFirestoreを使う時(またはwarm_upを呼び出した時)に行い、Botの起動を待たせない
+    """
+
+    CHUNK_SIZE = 512 * 1024  # 1ドキュメントに保存するスナップショットのバイト数(ドキュメントの上限は1MiB)
+
+    def __init__(self, credential: str, compression: str = "zlib", chunk_size: int = CHUNK_SIZE) -> None:
+        super().__init__()
+        self.__info = self.__parse_credential_string(credential)
+        self.__client: Optional[Any] = None
+        self.__client_lock = threading.Lock()
         self.__collection = "influencers"
+        self.__chunk_collection = "influencer_snapshot_chunks"
+        self.compression = compression
+        self.chunk_size = chunk_size
+        # 対象ユーザごとの、保存されているスナップショットの分割数(不要になった分割を消すのに使う)
+        self.__chunk_counts: dict[int, int] = {}
+
+    @property
+    def client(self) -> Any:
+        if self.__client is not None:
+            return self.__client
+        with self.__client_lock:
+            if self.__client is None:
+                cred = self.__initialize_credential(self.__info)
+                self.__initialize_firebase_app(cred)
+                self.__client = self.__initialize_firestore()
+            return self.__client
+
+    @client.setter
+    def client(self, client: Any) -> None:
+        self.__client = client
+
+    def warm_up(self) -> None:
+        self.client
 
     def __parse_credential_string(self, credential: str) -> Any:
         try:
             info = json.loads(credential)
-        except (JSONDecodeError, TypeError):
+        except (json.JSONDecodeError, TypeError):
             logger.exception("Failed to parse json string credential")
             raise DbInitializeError
         return info
 
-    def __initialize_credential(self, credential_info: Any) -> credentials.Certificate:
+    def __initialize_credential(self, credential_info: Any) -> Any:
+        from firebase_admin import credentials
+
         try:
             cred = credentials.Certificate(credential_info)
         except (IOError, ValueError):
@@ -35,33 +173,26 @@ class Db:
             raise DbInitializeError
         return cred
 
-    def __initialize_firebase_app(self, credential: credentials.Certificate) -> None:
+    def __initialize_firebase_app(self, credential: Any) -> None:
+        import firebase_admin
+
         try:
             firebase_admin.initialize_app(credential)
         except ValueError:
             logger.exception("Failed to initialize firebase app")
             raise DbInitializeError
 
-    def __initialize_firestore(self) -> None:
+    def __initialize_firestore(self) -> Any:
         try:
-            client = firestore.client()
+            return _firestore().client()
         except ValueError:
             logger.exception("Failed to initialize firestore")
             raise DbInitializeError
-        self.client = client
-
-    def has_record(self, doc_id: str) -> bool:
-        try:
-            doc_ref = self.client.collection(self.__collection).document(doc_id)
-            doc = doc_ref.get()
-        except Exception:
-            logger.exception("Failed to get a document")
-            raise DbOperationError
-        return True if doc.exists else False
 
     def get(self, doc_id: str) -> Optional[dict[str, Any]]:
         try:
             doc_ref = self.client.collection(self.__collection).document(doc_id)
+            DB_RPCS.inc(rpc="get")
             doc = doc_ref.get()
         except Exception:
             logger.exception("Failed to get a document")
@@ -72,9 +203,28 @@ class Db:
             return None
         return doc.to_dict()
 
+    def get_many(self, doc_ids: List[str]) -> dict[str, dict[str, Any]]:
+        """
+        複数のドキュメントを1回のリクエスト(get_all)でまとめて取得する
+        存在しないドキュメントは結果に含めない
+        """
+        try:
+            refs = [self.client.collection(self.__collection).document(doc_id) for doc_id in doc_ids]
+            if refs:
+                DB_RPCS.inc(rpc="get_all")
+            docs = list(self.client.get_all(refs)) if refs else []
+        except Exception:
+            logger.exception("Failed to get documents")
+            raise DbOperationError
+        return {doc.id: doc.to_dict() for doc in docs if doc.exists}
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self.client, self.__collection)
+
     def add(self, doc_id: str, data: dict[str, Any]) -> None:
         try:
             doc_ref = self.client.collection(self.__collection).document(doc_id)
+            DB_RPCS.inc(rpc="set")
             result = doc_ref.set(data)
         except Exception:
             logger.exception("Failed to save a document")
@@ -83,27 +233,95 @@ class Db:
             logger.warning("Saving document might be failed")
 
     def update(self, doc_id: str, data: dict[str, Any]) -> None:
-        pass
-
-    def delete(self, doc_id: str) -> None:
-        pass
-
-    def add_to_array(self, doc_id: str, field_name: str, array: List[Any]) -> None:
         try:
             doc_ref = self.client.collection(self.__collection).document(doc_id)
-            result = doc_ref.update({field_name: firestore.ArrayUnion(array)})
+            DB_RPCS.inc(rpc="update")
+            result = doc_ref.update(data)
         except Exception:
-            logger.exception("Failed to update array on the database")
+            logger.exception("Failed to update a document")
             raise DbOperationError
         if "update_time" not in result:
             logger.warning("Saving document might be failed")
 
-    def remove_from_array(self, doc_id: str, field_name: str, array: List[Any]) -> None:
+    def delete(self, doc_id: str) -> None:
         try:
-            doc_ref = self.client.collection(self.__collection).document(doc_id)
-            result = doc_ref.update({field_name: firestore.ArrayRemove(array)})
+            DB_RPCS.inc(rpc="delete")
+            self.client.collection(self.__collection).document(doc_id).delete()
         except Exception:
-            logger.exception("Failed to update array on the database")
+            logger.exception("Failed to delete a document")
             raise DbOperationError
-        if "update_time" not in result:
-            logger.warning("Saving document might be failed")
+
+    @timed_method(DB_OPERATION_SECONDS)
+    def get_users_followings(self, user_ids: List[int]) -> UsersFollowings:
+        """
+        対象ユーザのドキュメントを1回のget_allで取得し、分割されたスナップショットがあれば残りをもう1回のget_allで取得する
+        """
+        docs = self.get_many([str(u) for u in user_ids])
+        counts = {int(k): int(v.get("snapshot_chunks", 1)) for k, v in docs.items() if "snapshot" in v}
+        chunks = self.__get_chunks(counts)
+        followings: UsersFollowings = {}
+        for k, v in docs.items():
+            user_id = int(k)
+            if user_id in counts:
+                pieces = [v["snapshot"]] + [chunks.get(f"{user_id}_{i}") for i in range(1, counts[user_id])]
+                try:
+                    if any(p is None for p in pieces):
+                        raise ValueError("Missing snapshot chunks")
+                    ids = decode_ids(b"".join(pieces)).tolist()
+                except (ValueError, ImportError):
+                    logger.exception(f"Failed to decode the snapshot of user id `{user_id}`")
+                    raise DbOperationError
+                self.__chunk_counts[user_id] = counts[user_id]
+            else:
+                ids = [int(f) for f in v.get("followings") or []]
+            if ids:
+                followings[user_id] = ids
+        return followings
+
+    @timed_method(DB_OPERATION_SECONDS)
+    def save_users_followings(self, added: UsersFollowings, removed: UsersFollowings) -> None:
+        """
+        差分があった対象ユーザについて、差分を反映したスナップショットを1つのバッチにまとめて書き込む
+        (書き込み数かバイト数がコミットの上限を超える場合は、対象ユーザの区切りでコミットを分ける)
+        以前の形式の`followings`フィールドは消し、差分を反映した時刻を`added_at`/`removed_at`に記録する
+        """
+        firestore = _firestore()
+        snapshots = self._next_snapshots(added, removed)
+        batch = self.batch()
+        counts: dict[int, int] = {}
+        for user_id, snapshot in snapshots.items():
+            data = encode_ids(snapshot.ids, self.compression)
+            pieces = [data[i : i + self.chunk_size] for i in range(0, len(data), self.chunk_size)]
+            doc = {"snapshot": pieces[0], "snapshot_chunks": len(pieces), "followings": firestore.DELETE_FIELD}
+            if added.get(user_id):
+                doc["added_at"] = firestore.SERVER_TIMESTAMP
+            if removed.get(user_id):
+                doc["removed_at"] = firestore.SERVER_TIMESTAMP
+            batch.set(str(user_id), doc)
+            for i, piece in enumerate(pieces[1:], start=1):
+                batch.set(f"{user_id}_{i}", {"data": piece}, collection=self.__chunk_collection)
+            for i in range(len(pieces), self.__chunk_counts.get(user_id, 1)):
+                batch.delete(f"{user_id}_{i}", collection=self.__chunk_collection)
+            # コミットを分ける場合も、対象ユーザのスナップショットの分割は同じコミットで書き込む
+            batch.end_group()
+            counts[user_id] = len(pieces)
+        if len(batch) != 0:
+            batch.commit()
+        self.__chunk_counts.update(counts)
+        self._update_snapshots(added, removed, snapshots)
+
+    def __get_chunks(self, counts: dict[int, int]) -> dict[str, bytes]:
+        refs = [
+            self.client.collection(self.__chunk_collection).document(f"{user_id}_{i}")
+            for user_id, count in counts.items()
+            for i in range(1, count)
+        ]
+        if not refs:
+            return {}
+        try:
+            DB_RPCS.inc(rpc="get_all")
+            docs = list(self.client.get_all(refs))
+        except Exception:
+            logger.exception("Failed to get snapshot chunks")
+            raise DbOperationError
+        return {doc.id: doc.to_dict()["data"] for doc in docs if doc.exists}
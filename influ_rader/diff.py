@@ -0,0 +1,124 @@
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, Tuple
+
+
+def ids_array(ids: Iterable[int] = ()) -> "array[int]":
+    return array("q", ids)
+
+
+class Snapshot:
+    """
+    あるユーザのfollowingsを、重複のないソート済みの64bit整数の配列として保持するクラス
+    Pythonのint/strのリストやsetと比べて1要素あたり8バイトで済み、差分は線形のマージで取れる
+    """
+
+    __slots__ = ("ids",)
+
+    def __init__(self, ids: "array[int] | None" = None) -> None:
+        self.ids = ids if ids is not None else ids_array()
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "Snapshot":
+        return cls(ids_array(sorted(set(ids))))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __contains__(self, user_id: object) -> bool:
+        i = bisect_left(self.ids, user_id)  # type: ignore
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Snapshot) and self.ids == other.ids
+
+    def diff(self, new: "Snapshot") -> Tuple["array[int]", "array[int]"]:
+        """
+        このスナップショットから新しいスナップショットへの差分を取る
+        戻り値は(newにだけ含まれるID, selfにだけ含まれるID)のタプルで、いずれもソート済み
+        """
+        return diff_sorted(self.ids, new.ids)
+
+    def apply(self, added: Iterable[int], removed: Iterable[int]) -> "Snapshot":
+        """
+        差分を反映した新しいスナップショットを返す
+        """
+        removing = set(removed)
+        adding = ids_array(sorted(set(added)))
+        kept = ids_array(i for i in self.ids if i not in removing) if removing else self.ids
+        return Snapshot(merge_sorted(kept, adding))
+
+
+def diff_sorted(old: "array[int]", new: "array[int]") -> Tuple["array[int]", "array[int]"]:
+    """
+    ソート済みで重複のない2つの配列の差分を線形のマージで取る
+    戻り値は(newにだけ含まれる要素, oldにだけ含まれる要素)のタプル
+    """
+    if old == new:
+        return ids_array(), ids_array()
+    added, removed = ids_array(), ids_array()
+    i, j, n, m = 0, 0, len(old), len(new)
+    while i < n and j < m:
+        a, b = old[i], new[j]
+        if a == b:
+            k = _common_prefix(old, new, i, j)
+            i += k
+            j += k
+        elif a < b:
+            k = bisect_left(old, b, i)
+            removed.extend(old[i:k])
+            i = k
+        else:
+            k = bisect_left(new, a, j)
+            added.extend(new[j:k])
+            j = k
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return added, removed
+
+
+def _common_prefix(a: "array[int]", b: "array[int]", i: int, j: int) -> int:
+    """
+    a[i:]とb[j:]の先頭から一致している要素数を返す
+    差分は全体のごく一部であることがほとんどなので、一致する区間は長さを倍々にしながら
+    C実装のスライス比較でまとめて読み飛ばす
+    """
+    n = min(len(a) - i, len(b) - j)
+    length, step = 0, 1
+    while length + step <= n and a[i + length : i + length + step] == b[j + length : j + length + step]:
+        length += step
+        step *= 2
+    while step > 1:
+        step //= 2
+        if length + step <= n and a[i + length : i + length + step] == b[j + length : j + length + step]:
+            length += step
+    return length
+
+
+def merge_sorted(a: "array[int]", b: "array[int]") -> "array[int]":
+    """
+    ソート済みで重複のない2つの配列をマージする
+    """
+    if not b:
+        return ids_array(a)
+    merged = ids_array()
+    i, j, n, m = 0, 0, len(a), len(b)
+    while i < n and j < m:
+        if a[i] < b[j]:
+            # 次にbの要素が入る位置までaをまとめてコピーする
+            k = bisect_left(a, b[j], i)
+            merged.extend(a[i:k])
+            i = k
+        elif a[i] > b[j]:
+            merged.append(b[j])
+            j += 1
+        else:
+            merged.append(a[i])
+            i += 1
+            j += 1
+    merged.extend(a[i:])
+    merged.extend(b[j:])
+    return merged
@@ -0,0 +1,154 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cache import UserCache
+from influ_rader.error import TwitterRequestError
+from influ_rader.metrics import ENRICHED_USERS
+from influ_rader.notify import Diff, Trend
+from influ_rader.rate_limit import Clock, RateLimiter
+from influ_rader.twitter import Twitter
+
+# ユーザIDごとの、user_fieldsに指定したフィールドのユーザ情報
+Profiles = Dict[int, Dict[str, Any]]
+# 詳細を添えた差分とトレンドを通知先に振り分ける関数(Notifier.publish)
+Publish = Callable[[Sequence[Diff], Sequence[Trend]], None]
+Job = Tuple[Sequence[Diff], Sequence[Trend], Publish]
+
+
+class Enricher:
+    """
+    新しくフォローされたユーザの詳細(自己紹介・フォロワー数・作成日時・認証済みかどうかなど)を取得して、通知に添えるクラス
+
+    submitは差分をキューに入れてすぐに返り、別のタスクが詳細を取得してから通知先に振り分ける
+    (following取得のループは詳細の取得を待たない)
+    - 取得は専用のスレッドプール(workers)で行い、following取得などのスレッドを使わない
+    - users lookupのリクエストはBearer Tokenの枠とは別にウィンドウあたりbudget回までに抑え、他の取得に使う枠を残す
+    - 取得した詳細はキャッシュし、同じユーザは有効期限が切れるまで取得し直さない
+    - timeout秒以内に取得できなかった場合や取得に失敗した場合は、詳細なしで通知する
+    """
+
+    USER_FIELDS = ["description", "public_metrics", "created_at", "verified"]
+    BUDGET = 100  # ウィンドウあたりのusers lookupのリクエスト数(アプリ認証の上限の1/3)
+
+    def __init__(
+        self,
+        twitter: Twitter,
+        user_fields: Sequence[str] = USER_FIELDS,
+        workers: int = 2,
+        budget: int = BUDGET,
+        cache: Optional[UserCache] = None,
+        timeout: float = 60.0,
+        max_size: int = 1000,
+        clock: Optional[Clock] = None,
+    ) -> None:
+        self.twitter = twitter
+        self.user_fields = list(user_fields)
+        self.timeout = timeout
+        self.max_size = max_size
+        self.clock = clock or Clock()
+        self.executor = BoundedExecutor(workers)
+        self.rate_limiter = RateLimiter(self.clock, {"get_users": budget})
+        self.cache = cache or UserCache(clock=self.clock)
+        # キューとワーカのタスクは、最初にsubmitされた時のイベントループで作る
+        self.__queue: Optional["asyncio.Queue[Job]"] = None
+        self.__worker: Optional["asyncio.Task[None]"] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def submit(self, diffs: Sequence[Diff], trends: Sequence[Trend], publish: Publish) -> None:
+        """
+        差分とトレンドの詳細を取得してからpublishに渡すように、キューに入れる(イベントループの中から呼び出すこと)
+        キューが溢れている場合は、待たせずに詳細なしで通知する
+        """
+        if not diffs and not trends:
+            return
+        queue = self.__ensure_worker()
+        if queue.full():
+            logger.warning("Enrichment queue is full. Notify without user details.")
+            publish(diffs, trends)
+            return
+        queue.put_nowait((diffs, trends, publish))
+
+    async def join(self) -> None:
+        """
+        キューに入っている差分を全て通知先に振り分けるまで待つ
+        """
+        if self.__queue is not None and self.__loop is asyncio.get_running_loop():
+            await self.__queue.join()
+
+    async def enrich(self, diffs: Sequence[Diff], trends: Sequence[Trend]) -> Tuple[List[Diff], List[Trend]]:
+        """
+        差分とトレンドの、新しくフォローされたユーザの詳細を取得して添える
+        """
+        profiles = await self.profiles([u.id for d in diffs for u in d.followings] + [t.user.id for t in trends])
+        return (
+            [d._replace(profiles={u.id: profiles[u.id] for u in d.followings if u.id in profiles}) for d in diffs],
+            [t._replace(profile=profiles.get(t.user.id)) for t in trends],
+        )
+
+    async def profiles(self, user_ids: List[int]) -> Profiles:
+        """
+        ユーザごとの詳細を、キャッシュになければ最大100件ずつ並行して取得する
+        見つからなかった/凍結されているユーザは結果に含めない
+        """
+        profiles: Profiles = {}
+        missing: List[int] = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = self.cache.get(user_id)
+            if cached is not None:
+                profiles[user_id] = {k: v for k, v in cached.items() if k != "id"}
+            else:
+                missing.append(user_id)
+        ENRICHED_USERS.inc(len(profiles), result="cached")
+        limit = Twitter.USERS_LOOKUP_LIMIT
+        chunks = [missing[i : i + limit] for i in range(0, len(missing), limit)]
+        fetched = 0
+        for result in await asyncio.gather(*[self.executor.run(self.__fetch, chunk) for chunk in chunks]):
+            profiles.update(result)
+            fetched += len(result)
+        ENRICHED_USERS.inc(fetched, result="fetched")
+        ENRICHED_USERS.inc(len(missing) - fetched, result="missing")
+        return profiles
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+    def __fetch(self, user_ids: List[int]) -> Profiles:
+        # タイムアウトしても取得した詳細は捨てないように、取得したスレッドでキャッシュに入れる
+        self.rate_limiter.acquire("get_users")
+        profiles: Profiles = {}
+        for user in self.twitter.get_users_with_fields(user_ids, self.user_fields):
+            profile = {f: user.data[f] for f in self.user_fields if f in user.data}
+            self.cache.put({"id": user.id, **profile})
+            profiles[user.id] = profile
+        return profiles
+
+    def __ensure_worker(self) -> "asyncio.Queue[Job]":
+        loop = asyncio.get_running_loop()
+        if self.__queue is None or self.__loop is not loop:
+            self.__queue = asyncio.Queue(self.max_size)
+            self.__loop = loop
+            self.__worker = None
+        if self.__worker is None or self.__worker.done():
+            self.__worker = loop.create_task(self.__work(self.__queue))
+        return self.__queue
+
+    async def __work(self, queue: "asyncio.Queue[Job]") -> None:
+        while True:
+            diffs, trends, publish = await queue.get()
+            try:
+                diffs, trends = await asyncio.wait_for(self.enrich(diffs, trends), self.timeout)
+            except TwitterRequestError:
+                logger.exception("Failed to get user details. Notify without them.")
+            except asyncio.TimeoutError:
+                logger.warning(f"Could not get user details in {self.timeout} seconds. Notify without them.")
+            except Exception:
+                logger.exception("Unexpected error while getting user details. Notify without them.")
+            try:
+                publish(diffs, trends)
+            except Exception:
+                logger.exception("Unexpected error while publishing notifications")
+            finally:
+                queue.task_done()
@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 class AppError(Exception):
     """全ての例外クラスのベース"""
 
@@ -30,5 +33,13 @@ class DbOperationError(DbError):
     """DBへのCRUD操作でエラーが発生したことを表す例外クラス"""
 
 
-class BotError(AppError):
-    """Bot関連の例外クラス"""
+class NotifyError(AppError):
+    """通知先への送信に失敗したことを表す例外クラス"""
+
+
+class NotifyTemporaryError(NotifyError):
+    """再送すれば成功する見込みがある送信の失敗を表す例外クラス"""
+
+    def __init__(self, retry_after: Optional[float] = None) -> None:
+        super().__init__()
+        self.retry_after = retry_after
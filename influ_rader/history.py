@@ -0,0 +1,181 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+from loguru import logger
+
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.rate_limit import Clock
+from influ_rader.storage import UsersFollowings
+
+
+class FollowEvent(NamedTuple):
+    at: float
+    target_id: int
+    followed_id: int
+    kind: int
+
+
+class FollowHistory:
+    """
+    対象ユーザのフォロー/フォロー解除を、時刻付きのイベントとして追記だけするSQLiteのログ
+
+    ストレージには現在のfollowingsしか残らないので、過去のある時点のfollowingsや、期間内にフォローされたユーザの集計は
+    このログから求める
+    集計に使う列を全て含むインデックス(カバリングインデックス)を張り、テーブル本体を読まずにインデックスの範囲だけを走査する
+
+    ログを始めた時点のfollowingsは、実際にフォローした時刻が分からないのでBASELINEとして記録する
+    BASELINEは過去の状態の復元には使うが、期間内にフォローされたユーザの集計には含めない
+    """
+
+    FOLLOW = 1
+    UNFOLLOW = -1
+    BASELINE = 0
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS follow_events (
+        id INTEGER PRIMARY KEY,
+        at REAL NOT NULL,
+        target_id INTEGER NOT NULL,
+        followed_id INTEGER NOT NULL,
+        kind INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS follow_events_kind_at ON follow_events (kind, at, followed_id, target_id);
+    CREATE INDEX IF NOT EXISTS follow_events_target ON follow_events (target_id, followed_id, at, kind);
+    """
+
+    def __init__(self, path: str = ":memory:", clock: Optional[Clock] = None) -> None:
+        self.clock = clock or Clock()
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+        except sqlite3.Error:
+            logger.exception(f"Failed to initialize history database `{path}`")
+            raise DbInitializeError
+        self.__lock = threading.Lock()
+        # ログに記録済みの対象ユーザ(BASELINEを記録するかどうかの判定に使う)
+        self.__known: Optional[Set[int]] = None
+
+    def record(self, followings: Mapping[int, Iterable[int]], added: UsersFollowings, removed: UsersFollowings) -> None:
+        """
+        保存した差分をイベントとして追記する
+        初めて記録する対象ユーザは、取得したfollowings全体をBASELINEとして記録し、以降は差分だけを記録する
+        """
+        now = self.clock.time()
+        with self.__operation("record follow events"):
+            known = self.__known_targets()
+            rows: List[Tuple[float, int, int, int]] = []
+            for target_id, following in followings.items():
+                if target_id not in known:
+                    rows.extend((now, target_id, f, self.BASELINE) for f in following)
+                else:
+                    rows.extend((now, target_id, f, self.FOLLOW) for f in added.get(target_id, []))
+                rows.extend((now, target_id, f, self.UNFOLLOW) for f in removed.get(target_id, []))
+            self.connection.executemany(
+                "INSERT INTO follow_events (at, target_id, followed_id, kind) VALUES (?, ?, ?, ?)", rows
+            )
+        known.update(followings)
+
+    def co_followed(self, since: float, min_targets: int = 3, limit: int = 50) -> List[Tuple[int, int]]:
+        """
+        since以降にmin_targets人以上の対象ユーザがフォローしたユーザを、フォローした対象ユーザの数が多い順に返す
+        戻り値は(ユーザID, フォローした対象ユーザの数)のリスト
+        """
+        with self.__operation("query co-followed users"):
+            rows = self.connection.execute(
+                """
+                SELECT followed_id, COUNT(DISTINCT target_id) AS targets FROM follow_events
+                WHERE kind = ? AND at >= ?
+                GROUP BY followed_id HAVING targets >= ?
+                ORDER BY targets DESC, followed_id LIMIT ?
+                """,
+                (self.FOLLOW, since, min_targets, limit),
+            ).fetchall()
+        return [(int(r[0]), int(r[1])) for r in rows]
+
+    def followings_at(self, target_id: int, at: float) -> List[int]:
+        """
+        時刻atの時点で対象ユーザがフォローしていたユーザIDを昇順で返す
+        (ユーザごとに時刻at以前の最後のイベントがフォロー解除でなければ、フォローしていたとみなす)
+        """
+        with self.__operation(f"query followings of user id `{target_id}`"):
+            rows = self.connection.execute(
+                """
+                SELECT followed_id, kind, MAX(id) FROM follow_events
+                WHERE target_id = ? AND at <= ?
+                GROUP BY followed_id ORDER BY followed_id
+                """,
+                (target_id, at),
+            ).fetchall()
+        return [int(r[0]) for r in rows if r[1] != self.UNFOLLOW]
+
+    def events(self, target_id: int, since: float) -> List[FollowEvent]:
+        """
+        since以降の対象ユーザのフォロー/フォロー解除のイベントを時刻順に返す(BASELINEは含めない)
+        """
+        with self.__operation(f"query follow events of user id `{target_id}`"):
+            rows = self.connection.execute(
+                """
+                SELECT at, target_id, followed_id, kind FROM follow_events
+                WHERE target_id = ? AND at >= ? AND kind != ?
+                ORDER BY id
+                """,
+                (target_id, since, self.BASELINE),
+            ).fetchall()
+        return [FollowEvent(float(r[0]), int(r[1]), int(r[2]), int(r[3])) for r in rows]
+
+    def changes(self, since: float) -> List[FollowEvent]:
+        """
+        since以降の全ての対象ユーザのフォロー/フォロー解除のイベントを記録した順に返す(BASELINEは含めない)
+        """
+        with self.__operation("query follow events"):
+            rows = self.connection.execute(
+                """
+                SELECT at, target_id, followed_id, kind FROM follow_events
+                WHERE kind IN (?, ?) AND at >= ?
+                ORDER BY id
+                """,
+                (self.FOLLOW, self.UNFOLLOW, since),
+            ).fetchall()
+        return [FollowEvent(float(r[0]), int(r[1]), int(r[2]), int(r[3])) for r in rows]
+
+    def targets(self) -> Set[int]:
+        """
+        ログに記録済みの対象ユーザIDを返す
+        """
+        with self.__operation("query recorded targets"):
+            return set(self.__known_targets())
+
+    def counts(self) -> Dict[int, int]:
+        """
+        種類ごとのイベントの件数を返す
+        """
+        with self.__operation("count follow events"):
+            rows = self.connection.execute("SELECT kind, COUNT(*) FROM follow_events GROUP BY kind").fetchall()
+        return {int(r[0]): int(r[1]) for r in rows}
+
+    def __known_targets(self) -> Set[int]:
+        if self.__known is None:
+            rows = self.connection.execute("SELECT DISTINCT target_id FROM follow_events").fetchall()
+            self.__known = {int(r[0]) for r in rows}
+        return self.__known
+
+    @contextmanager
+    def __operation(self, description: str) -> Iterator[None]:
+        """
+        withブロック内の処理を1つのトランザクションにまとめ、SQLiteのエラーはDbOperationErrorにする
+        """
+        with self.__lock:
+            try:
+                self.connection.execute("BEGIN")
+                try:
+                    yield
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                logger.exception(f"Failed to {description} on history database")
+                raise DbOperationError
@@ -0,0 +1,288 @@
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from influ_rader.checkpoint import Checkpoint
+from influ_rader.diff import ids_array
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.rate_limit import Clock, RateLimiter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawl_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS crawl_jobs (
+    run_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (run_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS crawl_cursors (
+    user_id INTEGER PRIMARY KEY,
+    next_token TEXT NOT NULL,
+    ids BLOB NOT NULL,
+    saved_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    try:
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+    except sqlite3.Error:
+        logger.exception(f"Failed to initialize job database `{path}`")
+        raise DbInitializeError
+    return connection
+
+
+class JobQueue:
+    """
+    1回の差分取得(run)を、対象ユーザごとのfollowing取得ジョブとしてSQLiteに記録するクラス
+
+    ジョブの状態は pending -> running -> done と進み、失敗したら failed になって待ち時間(指数バックオフ)の後に再実行する
+    max_attempts回失敗したジョブは dead として諦める
+    全てのジョブが done/dead になるまでrunは終わらないので、再起動しても終わっていないジョブだけを続きから実行できる
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    DEAD = "dead"
+    OPEN_RUN = "SELECT id FROM crawl_runs WHERE finished_at IS NULL"
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        max_attempts: int = 5,
+        backoff: float = 60.0,
+        max_backoff: float = 60 * 60,
+        clock: Optional[Clock] = None,
+    ) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock or Clock()
+        self.connection = _connect(path)
+        # スレッドプールから呼び出されるので、コネクションへのアクセスを直列化する
+        self.__lock = threading.Lock()
+
+    def start_run(self, user_ids: List[int]) -> int:
+        """
+        終わっていないrunがあればそれを再開し、なければ新しいrunを作る
+        再開する場合、実行中のまま止まったジョブはpendingに戻し、新しく増えた対象ユーザのジョブを追加する
+        """
+        with self.__operation("start a crawl run"):
+            row = self.connection.execute(self.OPEN_RUN).fetchone()
+            if row is not None:
+                run_id = int(row[0])
+                self.connection.execute(
+                    "UPDATE crawl_jobs SET state = ? WHERE run_id = ? AND state = ?",
+                    (self.PENDING, run_id, self.RUNNING),
+                )
+                logger.info(f"Resume crawl run `{run_id}`")
+            else:
+                cursor = self.connection.execute("INSERT INTO crawl_runs (started_at) VALUES (?)", (self.clock.time(),))
+                run_id = int(cursor.lastrowid or 0)
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO crawl_jobs (run_id, user_id, state) VALUES (?, ?, ?)",
+                [(run_id, user_id, self.PENDING) for user_id in user_ids],
+            )
+        return run_id
+
+    def runnable(self) -> List[int]:
+        """
+        実行中のrunで、今すぐ実行できる(pending、または待ち時間を過ぎたfailedの)ジョブの対象ユーザIDを返す
+        """
+        with self.__operation("get runnable crawl jobs"):
+            rows = self.connection.execute(
+                """
+                SELECT j.user_id FROM crawl_jobs j JOIN crawl_runs r ON r.id = j.run_id
+                WHERE r.finished_at IS NULL AND j.state IN (?, ?) AND j.next_attempt_at <= ?
+                ORDER BY j.user_id
+                """,
+                (self.PENDING, self.FAILED, self.clock.time()),
+            ).fetchall()
+        return [int(r[0]) for r in rows]
+
+    def start(self, user_ids: List[int]) -> None:
+        self.__set_state(user_ids, self.RUNNING)
+
+    def complete(self, user_ids: List[int]) -> None:
+        self.__set_state(user_ids, self.DONE)
+
+    def fail(self, user_ids: List[int], error: str) -> None:
+        """
+        ジョブの失敗を記録し、backoff * 2^(失敗回数-1)秒(最大max_backoff秒)後に再実行できるようにする
+        """
+        now = self.clock.time()
+        with self.__operation("record failed crawl jobs"):
+            for user_id in user_ids:
+                row = self.connection.execute(
+                    f"SELECT attempts FROM crawl_jobs WHERE run_id = ({self.OPEN_RUN}) AND user_id = ?", (user_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                attempts = int(row[0]) + 1
+                state = self.DEAD if attempts >= self.max_attempts else self.FAILED
+                delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+                self.connection.execute(
+                    f"""
+                    UPDATE crawl_jobs SET state = ?, attempts = ?, next_attempt_at = ?, error = ?
+                    WHERE run_id = ({self.OPEN_RUN}) AND user_id = ?
+                    """,
+                    (state, attempts, now + delay, error, user_id),
+                )
+                if state == self.DEAD:
+                    logger.error(f"Give up crawling user id `{user_id}` after {attempts} attempts: {error}")
+                else:
+                    logger.warning(f"Retry crawling user id `{user_id}` in {delay:.0f} seconds: {error}")
+            self.__finish_run_if_done()
+
+    def states(self) -> dict[int, Tuple[str, int]]:
+        """
+        実行中(なければ最後)のrunの、対象ユーザIDごとの(状態, 失敗回数)を返す
+        """
+        with self.__operation("get crawl job states"):
+            rows = self.connection.execute(
+                """
+                SELECT user_id, state, attempts FROM crawl_jobs
+                WHERE run_id = (SELECT MAX(id) FROM crawl_runs)
+                """
+            ).fetchall()
+        return {int(r[0]): (str(r[1]), int(r[2])) for r in rows}
+
+    def has_open_run(self) -> bool:
+        with self.__operation("get a crawl run"):
+            return self.connection.execute(self.OPEN_RUN).fetchone() is not None
+
+    def __set_state(self, user_ids: List[int], state: str) -> None:
+        with self.__operation(f"mark crawl jobs as {state}"):
+            self.connection.executemany(
+                f"UPDATE crawl_jobs SET state = ? WHERE run_id = ({self.OPEN_RUN}) AND user_id = ?",
+                [(state, user_id) for user_id in user_ids],
+            )
+            self.__finish_run_if_done()
+
+    def __finish_run_if_done(self) -> None:
+        self.connection.execute(
+            """
+            UPDATE crawl_runs SET finished_at = ?
+            WHERE finished_at IS NULL AND NOT EXISTS (
+                SELECT 1 FROM crawl_jobs j WHERE j.run_id = crawl_runs.id AND j.state NOT IN (?, ?)
+            )
+            """,
+            (self.clock.time(), self.DONE, self.DEAD),
+        )
+
+    @contextmanager
+    def __operation(self, description: str) -> Iterator[None]:
+        """
+        withブロック内の処理を1つのトランザクションにまとめ、SQLiteのエラーはDbOperationErrorにする
+        """
+        with self.__lock:
+            try:
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    yield
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                logger.exception(f"Failed to {description} on job database")
+                raise DbOperationError
+
+
+class SqliteCheckpoint(Checkpoint):
+    """
+    following取得の途中経過をSQLiteに保存するCheckpoint
+    プロセスが再起動しても、最後に取得できたページの続きから再開できる
+    JobQueueと同じファイルを指定でき、シャードのワーカプロセスからも同じファイルを開いて使える
+
+    ページネーションのトークンはいつまでも使えるとは限らないので、max_age秒より前に保存した途中経過は捨てて最初から取得し直す
+    """
+
+    def __init__(
+        self, path: str = ":memory:", max_age: float = RateLimiter.WINDOW, clock: Optional[Clock] = None
+    ) -> None:
+        super().__init__()
+        self.max_age = max_age
+        self.clock = clock or Clock()
+        self.connection = _connect(path)
+        self.__lock = threading.Lock()
+        self.__migrate(path)
+
+    def __migrate(self, path: str) -> None:
+        """
+        saved_atを記録していなかった頃のファイルに列を追加する(既存の途中経過は古いものとして扱われる)
+        """
+        try:
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(crawl_cursors)")]
+            if "saved_at" not in columns:
+                self.connection.execute("ALTER TABLE crawl_cursors ADD COLUMN saved_at REAL NOT NULL DEFAULT 0")
+        except sqlite3.Error:
+            logger.exception(f"Failed to migrate checkpoints in job database `{path}`")
+            raise DbInitializeError
+
+    def load(self, user_id: int) -> Optional[Tuple[str, "array[int]"]]:
+        try:
+            with self.__lock:
+                row = self.connection.execute(
+                    "SELECT next_token, ids, saved_at FROM crawl_cursors WHERE user_id = ?", (user_id,)
+                ).fetchone()
+        except sqlite3.Error:
+            logger.exception(f"Failed to load checkpoint of user id `{user_id}`")
+            return None
+        if row is None:
+            return None
+        if self.clock.time() - float(row[2]) > self.max_age:
+            logger.info(f"Discard stale checkpoint of user id `{user_id}`")
+            self.clear(user_id)
+            return None
+        ids = ids_array()
+        ids.frombytes(row[1])
+        return str(row[0]), ids
+
+    def save_page(self, user_id: int, next_token: str, page: "array[int]") -> None:
+        """
+        取得済みのユーザIDの末尾にページを追記し、次のページのトークンと保存した時刻を更新する
+        """
+        try:
+            with self.__lock:
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self.connection.execute(
+                        "SELECT ids FROM crawl_cursors WHERE user_id = ?", (user_id,)
+                    ).fetchone()
+                    ids = (bytes(row[0]) if row is not None else b"") + page.tobytes()
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO crawl_cursors (user_id, next_token, ids, saved_at) VALUES (?, ?, ?, ?)",
+                        (user_id, next_token, ids, self.clock.time()),
+                    )
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+                self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            # 途中経過を保存できなくても取得自体は続けられる(失敗した場合は最初から取得し直す)
+            logger.exception(f"Failed to save checkpoint of user id `{user_id}`")
+
+    def clear(self, user_id: int) -> None:
+        try:
+            with self.__lock:
+                self.connection.execute("DELETE FROM crawl_cursors WHERE user_id = ?", (user_id,))
+        except sqlite3.Error:
+            logger.exception(f"Failed to clear checkpoint of user id `{user_id}`")
@@ -1,14 +1,120 @@
-from bot import Bot
-from config import Config
-from db import Db
-from twitter import Twitter
+import functools
+
+from influ_rader import STARTED_AT
+from influ_rader.bot import Bot
+from influ_rader.cache import UserCache
+from influ_rader.config import Config
+from influ_rader.credentials import create_client
+from influ_rader.db import Db
+from influ_rader.enrich import Enricher
+from influ_rader.history import FollowHistory
+from influ_rader.jobs import JobQueue, SqliteCheckpoint
+from influ_rader.metrics import MetricsServer, RunProfiler, StartupTimer
+from influ_rader.precheck import ChangeDetector
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.replay import Archive, RecordingStorage, recording_client_factory
+from influ_rader.schedule import PollScheduler
+from influ_rader.shard import ShardedCrawler
+from influ_rader.sqlite_db import SqliteDb
+from influ_rader.storage import Storage
+from influ_rader.targets import TargetRegistry
+from influ_rader.transport import Transport
+from influ_rader.trending import TrendIndex
+from influ_rader.twitter import Twitter
 
 
 def main() -> None:
-    config = Config()
-    twitter = Twitter(config.twitter_barear_token)
-    db = Db(config.google_credential)
-    bot = Bot(db, twitter, config.target_users, config.discord_channel_id)
+    # Firestore/tweepyのクライアントは最初に使う時(または準備完了の後で裏で)初期化するので、ここでは作らない
+    # パッケージを読み込んだ時刻から計測し、モジュールのimportにかかった時間もimportsのフェーズとして記録する
+    startup = StartupTimer(started_at=STARTED_AT)
+    startup.mark("imports")
+    with startup.phase("config"):
+        config = Config()
+        if config.metrics_port is not None:
+            MetricsServer(config.metrics_port, config.metrics_host).start()
+    with startup.phase("twitter"):
+        cache = UserCache(config.user_cache_size, config.user_cache_ttl, config.user_cache_path)
+        # following取得の途中経過はジョブと同じSQLiteに保存し、再起動しても続きから取得する
+        jobs = JobQueue(config.job_db_path, max_attempts=config.job_max_attempts)
+        checkpoint = SqliteCheckpoint(config.job_db_path)
+        # Bot内のリクエストは、枠が最も残っているBearer Tokenに振り分ける
+        # HTTPの接続プールは全てのBearer Tokenで共有し、同時にリクエストするスレッドの数だけ接続を使い回す
+        transport = Transport(pool_size=max(Transport.POOL_SIZE, config.fetch_concurrency))
+        # 記録モードでは、Bot内のAPIのレスポンスとストレージの状態をアーカイブに記録する(シャードのプロセスは記録しない)
+        archive = Archive(config.record_archive) if config.record_archive is not None else None
+        client_factory = None
+        if archive is not None:
+            archive.append("targets", users=config.target_users)
+            client_factory = recording_client_factory(functools.partial(create_client, transport=transport), archive)
+        twitter = Twitter(
+            config.twitter_barear_tokens,
+            cache=cache,
+            checkpoint=checkpoint,
+            client_factory=client_factory,
+            transport=transport,
+        )
+    with startup.phase("storage"):
+        db: Storage = (
+            SqliteDb(config.sqlite_path)
+            if config.storage_backend == "sqlite"
+            else Db(config.google_credential, config.snapshot_compression)
+        )
+        if archive is not None:
+            db = RecordingStorage(db, archive)
+    with startup.phase("stores"):
+        # シャードが1つの場合は、これまで通りBotのプロセス内でfollowingを取得する
+        crawler = (
+            ShardedCrawler(config.twitter_barear_tokens, config.crawl_shards, checkpoint_path=config.job_db_path)
+            if config.crawl_shards > 1
+            else None
+        )
+        # following取得に使えるリクエスト数は、ウィンドウあたりの上限 x 使うBearer Tokenの数
+        # (シャードが1つの場合は全てのBearer Tokenに振り分け、複数の場合はシャードごとに1つずつ使う)
+        tokens = len(config.twitter_barear_tokens)
+        if crawler is not None:
+            tokens = min(config.crawl_shards, tokens)
+        scheduler = PollScheduler(
+            config.job_db_path,
+            min_interval=config.poll_min_interval,
+            max_interval=config.poll_max_interval,
+            budget=RateLimiter.LIMITS["get_users_following"] * tokens,
+        )
+        detector = ChangeDetector(config.job_db_path, full_crawl_interval=config.full_crawl_interval)
+        history = FollowHistory(config.history_db_path)
+        # 対象ユーザの一覧とユーザIDの対応もジョブと同じSQLiteに保存し、再起動しても解決し直さない
+        registry = TargetRegistry(config.job_db_path)
+        # 新しくフォローされたユーザの詳細は、専用のスレッドとリクエストの枠で取得してキャッシュする
+        enricher = (
+            Enricher(
+                twitter,
+                config.enrich_user_fields,
+                workers=config.enrich_workers,
+                budget=config.enrich_budget,
+                cache=UserCache(config.user_cache_size, config.enrich_cache_ttl),
+            )
+            if config.enrich_user_fields
+            else None
+        )
+    bot = Bot(
+        db,
+        twitter,
+        config.target_users,
+        config.discord_channel_id,
+        config.fetch_concurrency,
+        crawler,
+        jobs,
+        scheduler,
+        detector,
+        RunProfiler(config.profile_dir),
+        config.notify_sinks,
+        config.notify_concurrency,
+        history,
+        TrendIndex(config.trending_window, config.trending_min_targets),
+        registry,
+        startup,
+        config.measure_startup,
+        enricher,
+    )
     bot.run(config.discord_bot_token)
 
 
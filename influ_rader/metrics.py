@@ -0,0 +1,404 @@
+import cProfile
+import functools
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+
+
+class Registry:
+    """
+    メトリクスをまとめて保持し、Prometheusのテキスト形式で出力するクラス
+
+    enabledがFalseの間はカウンタやヒストグラムへの記録を何もせずに返すので、計測しない場合のオーバーヘッドは
+    属性を1つ読むだけで済む
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.__metrics: List["Metric"] = []
+        self.__lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> "Counter":
+        return self.__register(Counter(self, name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Optional[Sequence[float]] = None,
+        always: bool = False,
+    ) -> "Histogram":
+        return self.__register(Histogram(self, name, documentation, labelnames, buckets, always))
+
+    def __register(self, metric: "M") -> "M":
+        with self.__lock:
+            self.__metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics)
+        return "".join(m.render() for m in metrics)
+
+    def reset(self) -> None:
+        with self.__lock:
+            for metric in self.__metrics:
+                metric.reset()
+
+
+class Metric(ABC):
+    TYPE = ""
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: Sequence[str]) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + ([extra] if extra is not None else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        return f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.TYPE}\n" + self._render_samples()
+
+    @abstractmethod
+    def _render_samples(self) -> str:
+        """
+        HELPとTYPEの行に続く、サンプルの行を出力する
+        """
+
+    @abstractmethod
+    def reset(self) -> None:
+        """
+        記録した値を全て消す
+        """
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: Sequence[str]) -> None:
+        super().__init__(registry, name, documentation, labelnames)
+        self.__values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self.__values.get(self._key(labels), 0.0)
+
+    def _render_samples(self) -> str:
+        with self._lock:
+            values = sorted(self.__values.items())
+        return "".join(f"{self.name}{self._labels(k)} {_format(v)}\n" for k, v in values)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.__values.clear()
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        buckets: Optional[Sequence[float]] = None,
+        always: bool = False,
+    ) -> None:
+        """
+        always: Trueの場合、registryが無効でも記録する(起動時間のように、記録する回数が少ないものに使う)
+        """
+        super().__init__(registry, name, documentation, labelnames)
+        self.always = always
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS)) + (math.inf,)
+        # ラベルごとの(バケットごとの件数, 合計, 件数)
+        self.__values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        if not (self.always or self.registry.enabled):
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self.__values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.__values[key] = (counts, total + value, count + 1)
+
+    def time(self, **labels: Any) -> ContextManager[None]:
+        """
+        withブロックの実行時間(秒)を記録する
+        """
+        if not self.registry.enabled:
+            return nullcontext()
+        return self.__time(labels)
+
+    @contextmanager
+    def __time(self, labels: Dict[str, Any]) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: Any) -> int:
+        with self._lock:
+            values = self.__values.get(self._key(labels))
+        return values[2] if values is not None else 0
+
+    def _render_samples(self) -> str:
+        with self._lock:
+            values = sorted((k, (list(c), s, n)) for k, (c, s, n) in self.__values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = "+Inf" if math.isinf(bound) else _format(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, ('le', le))} {cumulative}\n")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_format(total)}\n")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}\n")
+        return "".join(lines)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.__values.clear()
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def timed_method(histogram: Histogram) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """
+    メソッドの実行時間を、クラス名(backend)とメソッド名(method)のラベルを付けてhistogramに記録するデコレータ
+    """
+
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(self: Any, *args: Any, **kwargs: Any) -> T:
+            if not histogram.registry.enabled:
+                return func(self, *args, **kwargs)
+            with histogram.time(backend=type(self).__name__, method=func.__name__):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = REGISTRY.histogram(
+    "influ_rader_phase_seconds", "Time spent in each phase of the crawl/diff/notify pipeline.", ["phase"]
+)
+TWITTER_REQUESTS = REGISTRY.counter(
+    "influ_rader_twitter_requests_total", "Twitter API requests by endpoint and result.", ["endpoint", "result"]
+)
+CREDENTIAL_REQUESTS = REGISTRY.counter(
+    "influ_rader_credential_requests_total",
+    "Twitter API requests by bearer token, endpoint and result.",
+    ["credential", "endpoint", "result"],
+)
+TWITTER_REQUEST_SECONDS = REGISTRY.histogram(
+    "influ_rader_twitter_request_seconds", "Latency of Twitter API requests.", ["endpoint"]
+)
+FOLLOWING_PAGES = REGISTRY.counter("influ_rader_following_pages_total", "Following pages fetched from Twitter.")
+RATE_LIMIT_WAITS = REGISTRY.counter(
+    "influ_rader_rate_limit_waits_total", "Times a request waited for the rate limit window.", ["endpoint"]
+)
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.counter(
+    "influ_rader_rate_limit_wait_seconds_total", "Seconds spent waiting for the rate limit window.", ["endpoint"]
+)
+DB_OPERATION_SECONDS = REGISTRY.histogram(
+    "influ_rader_db_operation_seconds", "Latency of storage operations.", ["backend", "method"]
+)
+DB_RPCS = REGISTRY.counter("influ_rader_db_rpcs_total", "Firestore RPCs by kind.", ["rpc"])
+CRAWL_JOBS = REGISTRY.counter("influ_rader_crawl_jobs_total", "Finished crawl jobs by result.", ["result"])
+SAVED_REQUESTS = REGISTRY.counter(
+    "influ_rader_precheck_saved_requests_total", "Following requests saved by the following_count pre-check."
+)
+NOTIFICATIONS = REGISTRY.counter(
+    "influ_rader_notifications_total",
+    "Notifications by sink and result (sent, retried or dropped).",
+    ["sink", "result"],
+)
+ENRICHED_USERS = REGISTRY.counter(
+    "influ_rader_enriched_users_total",
+    "Users looked up for notification details by result (cached, fetched or missing).",
+    ["result"],
+)
+DETECTION_LATENCY_SECONDS = REGISTRY.histogram(
+    "influ_rader_detection_latency_seconds",
+    "Upper bound of the time between a follow change and its detection.",
+    buckets=[hours * 60 * 60 for hours in (0.25, 1, 3, 6, 12, 24, 3 * 24, 7 * 24)],
+)
+
+STARTUP_SECONDS = REGISTRY.histogram(
+    "influ_rader_startup_seconds",
+    "Time spent in each startup phase, until the bot is ready and the clients are warmed up.",
+    ["phase"],
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+    # メトリクスのサーバは起動の途中で始まる(METRICS_PORTを指定しなければ始まらない)ので、起動時間は常に記録する
+    always=True,
+)
+
+
+class MetricsServer:
+    """
+    `GET /metrics`でメトリクスを返すHTTPサーバ
+    Discordのイベントループとは別のスレッドで動かす
+    """
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> None:
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.__thread = threading.Thread(target=self.server.serve_forever, name="influ_rader_metrics", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return int(self.server.server_address[1])
+
+    def start(self) -> None:
+        self.registry.enabled = True
+        self.__thread.start()
+        logger.info(f"Serving metrics on port {self.port}")
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RunProfiler:
+    """
+    1回の実行(run)をcProfileで計測し、directoryに`<name>-<時刻>.prof`として保存するクラス
+    directoryを指定しなければ何もしない
+
+    計測するのはイベントループのスレッドだけで、スレッドプールで実行されるI/Oの待ち時間は各フェーズの時間に含まれる
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        self.directory = directory
+
+    def profile(self, name: str) -> ContextManager[None]:
+        if self.directory is None:
+            return nullcontext()
+        return self.__profile(self.directory, name)
+
+    @contextmanager
+    def __profile(self, directory: str, name: str) -> Iterator[None]:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d%H%M%S')}.prof")
+            try:
+                os.makedirs(directory, exist_ok=True)
+                profiler.dump_stats(path)
+                logger.info(f"Saved a profile of `{name}` to `{path}`")
+            except OSError:
+                logger.exception(f"Failed to save a profile to `{path}`")
+
+
+class StartupTimer:
+    """
+    プロセスの起動からBotの準備完了(ready)までにかかった時間を、フェーズごとに記録するクラス
+    準備完了の後で裏で行うクライアントの初期化(warm up)も、準備完了までの時間とは別に記録する
+    started_at: 起動の時刻(timerと同じ時計の値)。指定しなければ、このクラスを作った時刻から計測する
+    """
+
+    def __init__(self, timer: Callable[[], float] = time.perf_counter, started_at: Optional[float] = None) -> None:
+        self.timer = timer
+        self.started_at = started_at if started_at is not None else self.timer()
+        self.ready_at: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.__last = self.started_at
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = self.timer()
+        try:
+            yield
+        finally:
+            self.__record(name, start)
+
+    def mark(self, name: str) -> None:
+        """
+        直前のフェーズの終わりから今までを、nameのフェーズとして記録する
+        """
+        self.__record(name, self.__last)
+
+    def ready(self) -> None:
+        """
+        直前のフェーズの終わりからBotの準備完了までを、connectのフェーズとして記録する
+        """
+        self.mark("connect")
+        self.ready_at = self.timer()
+
+    def report(self) -> str:
+        total = (self.ready_at or self.timer()) - self.started_at
+        lines = [f"{'phase':>16} | {'seconds':>8} | {'share':>6}"]
+        for name, seconds in self.phases.items():
+            share = f"{seconds / total:>6.1%}" if total > 0 else f"{'-':>6}"
+            lines.append(f"{name:>16} | {seconds:>8.3f} | {share}")
+        lines.append(f"{'ready':>16} | {total:>8.3f} |")
+        return "\n".join(lines)
+
+    def __record(self, name: str, start: float) -> None:
+        end = self.timer()
+        self.phases[name] = self.phases.get(name, 0.0) + end - start
+        self.__last = max(self.__last, end)
+        STARTUP_SECONDS.observe(end - start, phase=name)
@@ -0,0 +1,518 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import aiohttp
+import discord
+from discord.ext import commands
+from loguru import logger
+
+from influ_rader.error import NotifyError, NotifyTemporaryError
+from influ_rader.metrics import NOTIFICATIONS
+from influ_rader.rate_limit import Clock
+from influ_rader.twitter import User
+
+MESSAGE_LIMIT = 2000  # Discordのメッセージ1件あたりの文字数の上限
+TWITTER_URL = "https://twitter.com/"
+DESCRIPTION_LIMIT = 80  # 通知に添える自己紹介の文字数の上限
+
+# 見出しと、その下に並べる行のリスト
+Block = Tuple[str, Sequence[str]]
+
+Sleep = Callable[[float], Awaitable[Any]]
+
+
+class Diff(NamedTuple):
+    """
+    対象ユーザが新しくフォローしたユーザ
+    """
+
+    target: User
+    followings: List[User]
+    # Enricherが取得した、フォローしたユーザのユーザIDごとの詳細(取得していなければ空)
+    profiles: Mapping[int, Dict[str, Any]] = {}
+
+
+class Trend(NamedTuple):
+    """
+    複数の対象ユーザが短期間にフォローしたユーザと、フォローした対象ユーザ
+    """
+
+    user: User
+    targets: List[User]
+    # Enricherが取得した、フォローされたユーザの詳細
+    profile: Optional[Dict[str, Any]] = None
+
+
+def describe_profile(profile: Optional[Mapping[str, Any]]) -> str:
+    """
+    ユーザの詳細を、通知の1行に添える短い説明にする(詳細がなければ空文字列)
+    例: " (フォロワー1,234人, 2012-03-04作成, 認証済み) 自己紹介"
+    """
+    if not profile:
+        return ""
+    parts = []
+    metrics = profile.get("public_metrics") or {}
+    if "followers_count" in metrics:
+        parts.append(f"フォロワー{int(metrics['followers_count']):,}人")
+    if profile.get("created_at"):
+        parts.append(f"{str(profile['created_at'])[:10]}作成")
+    if profile.get("verified"):
+        parts.append("認証済み")
+    text = f" ({', '.join(parts)})" if parts else ""
+    description = " ".join(str(profile.get("description") or "").split())
+    if len(description) > DESCRIPTION_LIMIT:
+        description = description[: DESCRIPTION_LIMIT - 1] + "…"
+    return f"{text} {description}" if description else text
+
+
+def pack_messages(blocks: Sequence[Block], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    見出し付きの行のまとまり(ブロック)を、limit文字以内のメッセージにできるだけ少なく詰める
+    複数のブロックを1つのメッセージにまとめ、1つのメッセージに収まらないブロックは見出しを付け直して分割する
+    limit文字を超える行は切り詰める
+    """
+    messages: List[str] = []
+    lines: List[str] = []
+    size = 0
+
+    def flush() -> None:
+        nonlocal lines, size
+        if lines:
+            messages.append("\n".join(lines))
+        lines, size = [], 0
+
+    for header, body in blocks:
+        header = header[:limit]
+        with_header = True
+        for line in body:
+            line = line[: limit - len(header) - 1]
+            text = f"{header}\n{line}" if with_header else line
+            if lines and size + 1 + len(text) > limit:
+                flush()
+                text = f"{header}\n{line}"
+            lines.append(text)
+            size += len(text) + (1 if size else 0)
+            with_header = False
+    flush()
+    return messages
+
+
+def format_messages(diffs: Sequence[Diff], limit: int = MESSAGE_LIMIT) -> List[str]:
+    return pack_messages(
+        [
+            (
+                f"**{d.target.name}(@{d.target.username})**が新しくフォローしたアカウント",
+                [f"{TWITTER_URL}{u.username}{describe_profile(d.profiles.get(u.id))}" for u in d.followings],
+            )
+            for d in diffs
+        ],
+        limit,
+    )
+
+
+def format_trends(trends: Sequence[Trend], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    トレンドを、対象ユーザごとの差分とは別の1つのまとめ(ダイジェスト)にする
+    """
+    if not trends:
+        return []
+    return pack_messages(
+        [
+            (
+                "**複数の対象ユーザがフォローしたアカウント**",
+                [
+                    f"{TWITTER_URL}{t.user.username} ({len(t.targets)}人: "
+                    f"{', '.join(f'@{u.username}' for u in t.targets)}){describe_profile(t.profile)}"
+                    for t in trends
+                ],
+            )
+        ],
+        limit,
+    )
+
+
+class Pacer:
+    """
+    送信先ごとのレート制限(window秒にlimit件)を超えないように、送信の間隔を空けるクラス
+    """
+
+    def __init__(self, limit: int, window: float, clock: Optional[Clock] = None, sleep: Sleep = asyncio.sleep) -> None:
+        self.limit = limit
+        self.window = window
+        self.clock = clock or Clock()
+        self.sleep = sleep
+        self.__sent: Dict[Any, Deque[float]] = {}
+
+    async def wait(self, key: Any = None) -> None:
+        """
+        直近window秒間にlimit件送っていれば、一番古い送信からwindow秒経つまで待つ
+        """
+        sent = self.__sent.setdefault(key, deque(maxlen=self.limit))
+        if len(sent) >= self.limit:
+            wait = sent[0] + self.window - self.clock.time()
+            if wait > 0:
+                await self.sleep(wait)
+        sent.append(self.clock.time())
+
+
+class Sink(ABC):
+    """
+    差分の通知先のインターフェース
+
+    通知は、差分を送信単位(payload)に変換するrenderと、payloadを1つずつ送るdeliverの2段階で行う
+    deliverが失敗した場合は、そのpayloadだけをNotificationQueueが再送する
+    targetsを指定した場合は、そのユーザ名の対象ユーザの差分だけを通知する
+    """
+
+    def __init__(self, name: str, targets: Optional[Iterable[str]] = None) -> None:
+        self.name = name
+        self.targets: Optional[Set[str]] = {t.lower() for t in targets} if targets is not None else None
+
+    def accepts(self, diff: Diff) -> bool:
+        return self.targets is None or str(diff.target.username).lower() in self.targets
+
+    def accepts_trend(self, trend: Trend) -> bool:
+        """
+        targetsを指定した場合は、そのいずれかがフォローしたトレンドだけを通知する
+        """
+        return self.targets is None or any(str(u.username).lower() in self.targets for u in trend.targets)
+
+    @abstractmethod
+    def render(self, diffs: Sequence[Diff]) -> List[Any]:
+        """
+        差分を送信単位のリストに変換する
+        """
+
+    @abstractmethod
+    async def deliver(self, payload: Any) -> None:
+        """
+        送信単位を1つ送る
+        再送すれば成功する見込みがある失敗はNotifyTemporaryErrorを、それ以外の失敗はNotifyErrorを投げること
+        """
+
+    def render_trends(self, trends: Sequence[Trend]) -> List[Any]:
+        """
+        トレンドを送信単位のリストに変換する
+        """
+        return format_trends(trends)
+
+    async def close(self) -> None:
+        pass
+
+
+class DiscordChannelSink(Sink):
+    """
+    BotのGateway接続で、Discordのチャンネルに投稿する通知先
+    チャンネルごとのレート制限(5秒に5件)を超えないように投稿の間隔を空ける
+    """
+
+    def __init__(
+        self,
+        bot: commands.Bot,
+        channel_id: int,
+        targets: Optional[Iterable[str]] = None,
+        clock: Optional[Clock] = None,
+        sleep: Sleep = asyncio.sleep,
+    ) -> None:
+        super().__init__(f"discord:{channel_id}", targets)
+        self.bot = bot
+        self.channel_id = channel_id
+        self.pacer = Pacer(5, 5.0, clock, sleep)
+
+    def render(self, diffs: Sequence[Diff]) -> List[Any]:
+        return format_messages(diffs)
+
+    async def deliver(self, payload: Any) -> None:
+        channel = self.bot.get_channel(self.channel_id)
+        if channel is None:
+            logger.error(f"Failed to get a channel with id `{self.channel_id}`")
+            raise NotifyError
+        await self.pacer.wait(self.channel_id)
+        try:
+            await channel.send(payload)
+        except discord.HTTPException as e:
+            if e.status == 429 or e.status >= 500:
+                raise NotifyTemporaryError from e
+            raise NotifyError from e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise NotifyTemporaryError from e
+
+
+class WebhookSink(Sink):
+    """
+    DiscordのWebhookに投稿する通知先
+    Webhookごとのレート制限(2秒に5件)を超えないように投稿の間隔を空け、429が返されたらretry_after秒後に再送する
+    """
+
+    def __init__(
+        self,
+        url: str,
+        targets: Optional[Iterable[str]] = None,
+        timeout: float = 10.0,
+        clock: Optional[Clock] = None,
+        sleep: Sleep = asyncio.sleep,
+    ) -> None:
+        super().__init__(f"webhook:{url.rsplit('/', 2)[-2] if url.count('/') >= 2 else url}", targets)
+        self.url = url
+        self.timeout = timeout
+        self.pacer = Pacer(5, 2.0, clock, sleep)
+        self.__session: Optional[aiohttp.ClientSession] = None
+
+    def render(self, diffs: Sequence[Diff]) -> List[Any]:
+        return format_messages(diffs)
+
+    async def deliver(self, payload: Any) -> None:
+        if self.__session is None or self.__session.closed:
+            self.__session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        await self.pacer.wait()
+        try:
+            async with self.__session.post(self.url, json={"content": payload}) as response:
+                if response.status == 429:
+                    body = await response.json(content_type=None)
+                    raise NotifyTemporaryError(retry_after=float(body.get("retry_after", 0)))
+                if response.status >= 500:
+                    raise NotifyTemporaryError
+                if response.status >= 400:
+                    logger.error(f"Webhook `{self.name}` returned {response.status}: {await response.text()}")
+                    raise NotifyError
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise NotifyTemporaryError from e
+
+    async def close(self) -> None:
+        if self.__session is not None:
+            await self.__session.close()
+
+
+class FileSink(Sink):
+    """
+    差分を1行1件のJSON(JSON Lines)としてファイルに追記する通知先
+    """
+
+    def __init__(self, path: str, targets: Optional[Iterable[str]] = None, clock: Optional[Clock] = None) -> None:
+        super().__init__(f"file:{path}", targets)
+        self.path = path
+        self.clock = clock or Clock()
+
+    def render(self, diffs: Sequence[Diff]) -> List[Any]:
+        detected_at = self.clock.time()
+        lines = [
+            json.dumps(
+                {
+                    "detected_at": detected_at,
+                    "target": _user_dict(d.target),
+                    "followings": [_user_dict(u, d.profiles.get(u.id)) for u in d.followings],
+                },
+                ensure_ascii=False,
+            )
+            for d in diffs
+        ]
+        return ["".join(f"{line}\n" for line in lines)] if lines else []
+
+    def render_trends(self, trends: Sequence[Trend]) -> List[Any]:
+        detected_at = self.clock.time()
+        lines = [
+            json.dumps(
+                {
+                    "detected_at": detected_at,
+                    "trend": _user_dict(t.user, t.profile),
+                    "targets": [_user_dict(u) for u in t.targets],
+                },
+                ensure_ascii=False,
+            )
+            for t in trends
+        ]
+        return ["".join(f"{line}\n" for line in lines)] if lines else []
+
+    async def deliver(self, payload: Any) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.__append, payload)
+        except OSError as e:
+            logger.exception(f"Failed to write notifications to `{self.path}`")
+            raise NotifyTemporaryError from e
+
+    def __append(self, text: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(text)
+
+
+def _user_dict(user: User, profile: Optional[Mapping[str, Any]] = None) -> Dict[str, Any]:
+    data = {"id": int(user.id), "username": user.username, "name": user.name}
+    if profile:
+        data["profile"] = dict(profile)
+    return data
+
+
+class NotificationQueue:
+    """
+    1つの通知先への送信をキューに入れ、別のタスクで順番に送るクラス
+    putはすぐに返るので、followingの差分を取るループは送信の完了を待たない
+
+    - キューにはmax_size件までしか溜めず、溢れた場合は古いものから捨てる(遅い通知先が際限なくメモリを使わないように)
+    - NotifyTemporaryErrorで失敗した送信は、待ち時間を倍々に延ばしながらmax_retries回まで再送する
+    - それ以外の失敗は再送しても成功しないので捨てる
+    """
+
+    def __init__(
+        self,
+        sink: Sink,
+        max_size: int = 1000,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        sleep: Sleep = asyncio.sleep,
+    ) -> None:
+        self.sink = sink
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        # 同時に送信する数を、複数の通知先で共有して制限する(Notifierが設定する)
+        self.pool: Callable[[], asyncio.Semaphore] = lambda: asyncio.Semaphore(1)
+        # キューとワーカのタスクは、最初にputされた時のイベントループで作る
+        self.__queue: Optional["asyncio.Queue[Any]"] = None
+        self.__worker: Optional["asyncio.Task[None]"] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def put(self, diffs: Sequence[Diff], trends: Sequence[Trend] = ()) -> None:
+        """
+        通知先が受け付ける差分とトレンドをキューに入れる(イベントループの中から呼び出すこと)
+        """
+        diffs = [d for d in diffs if self.sink.accepts(d)]
+        trends = [t for t in trends if self.sink.accepts_trend(t)]
+        if not diffs and not trends:
+            return
+        queue = self.__ensure_worker()
+        for payload in (self.sink.render(diffs) if diffs else []) + self.sink.render_trends(trends):
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                logger.warning(f"Notification queue of `{self.sink.name}` is full. Drop the oldest notification.")
+                NOTIFICATIONS.inc(sink=self.sink.name, result="dropped")
+            queue.put_nowait(payload)
+
+    async def join(self) -> None:
+        """
+        キューに入っている送信を全て終える(または諦める)まで待つ
+        """
+        if self.__queue is not None and self.__loop is asyncio.get_running_loop():
+            await self.__queue.join()
+
+    def __ensure_worker(self) -> "asyncio.Queue[Any]":
+        loop = asyncio.get_running_loop()
+        if self.__queue is None or self.__loop is not loop:
+            self.__queue = asyncio.Queue(self.max_size)
+            self.__loop = loop
+            self.__worker = None
+        if self.__worker is None or self.__worker.done():
+            self.__worker = loop.create_task(self.__work(self.__queue))
+        return self.__queue
+
+    async def __work(self, queue: "asyncio.Queue[Any]") -> None:
+        while True:
+            payload = await queue.get()
+            try:
+                await self.__send(payload)
+            except Exception:
+                logger.exception(f"Unexpected error while sending a notification to `{self.sink.name}`")
+                NOTIFICATIONS.inc(sink=self.sink.name, result="dropped")
+            finally:
+                queue.task_done()
+
+    async def __send(self, payload: Any) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.pool():
+                    await self.sink.deliver(payload)
+                NOTIFICATIONS.inc(sink=self.sink.name, result="sent")
+                return
+            except NotifyTemporaryError as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Gave up sending a notification to `{self.sink.name}` after {attempt} retries.")
+                    break
+                wait = max(self.backoff * 2**attempt, e.retry_after or 0.0)
+                logger.warning(f"Failed to send a notification to `{self.sink.name}`. Retry in {wait} seconds.")
+                NOTIFICATIONS.inc(sink=self.sink.name, result="retried")
+                await self.sleep(wait)
+            except NotifyError:
+                logger.exception(f"Cannot send a notification to `{self.sink.name}`.")
+                break
+        NOTIFICATIONS.inc(sink=self.sink.name, result="dropped")
+
+
+class Notifier:
+    """
+    差分を全ての通知先のキューに振り分けるクラス
+    通知先ごとのキューとワーカで並行に送るので、遅い通知先が他の通知先や次のfollowing取得を遅らせることはない
+    同時に送信する数は、全ての通知先を合わせてconcurrencyまでに制限する
+    """
+
+    def __init__(self, queues: Sequence[NotificationQueue], concurrency: int = 4) -> None:
+        self.queues = list(queues)
+        self.concurrency = concurrency
+        self.__semaphores: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+        for queue in self.queues:
+            queue.pool = self.__pool
+
+    def publish(self, diffs: Sequence[Diff], trends: Sequence[Trend] = ()) -> None:
+        for queue in self.queues:
+            queue.put(diffs, trends)
+
+    async def join(self) -> None:
+        await asyncio.gather(*[queue.join() for queue in self.queues])
+
+    async def close(self) -> None:
+        await self.join()
+        await asyncio.gather(*[queue.sink.close() for queue in self.queues])
+
+    def __pool(self) -> asyncio.Semaphore:
+        # Semaphoreは作成したイベントループでしか使えないので、イベントループごとに作る
+        loop = asyncio.get_running_loop()
+        if loop not in self.__semaphores:
+            self.__semaphores = {loop: asyncio.Semaphore(self.concurrency)}
+        return self.__semaphores[loop]
+
+
+def build_notifier(
+    bot: commands.Bot, channel_id: int, specs: Optional[Sequence[Dict[str, Any]]] = None, concurrency: int = 4
+) -> Notifier:
+    """
+    通知先の設定から通知先ごとのキューを作る
+    設定がなければ、これまで通りchannel_idのチャンネルに全ての対象ユーザの差分を投稿する
+
+    設定は通知先ごとの辞書のリストで、typeに応じて以下のキーを指定する
+    - discord: channel_id(省略した場合はchannel_id)
+    - webhook: url
+    - file: path
+    いずれもtargets(通知する対象ユーザ名のリスト)と、キューの設定(max_size, max_retries, backoff)を指定できる
+    """
+    queues: List[NotificationQueue] = []
+    for spec in specs or [{"type": "discord"}]:
+        targets = spec.get("targets")
+        sink: Sink
+        if spec["type"] == "discord":
+            sink = DiscordChannelSink(bot, int(spec.get("channel_id", channel_id)), targets)
+        elif spec["type"] == "webhook":
+            sink = WebhookSink(spec["url"], targets)
+        elif spec["type"] == "file":
+            sink = FileSink(spec["path"], targets)
+        else:
+            raise ValueError(f"Unknown notification sink type `{spec['type']}`")
+        options = {k: spec[k] for k in ("max_size", "max_retries", "backoff") if k in spec}
+        queues.append(NotificationQueue(sink, **options))
+    return Notifier(queues, concurrency)
@@ -0,0 +1,144 @@
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.metrics import SAVED_REQUESTS
+from influ_rader.rate_limit import Clock
+
+
+class ChangeDetector:
+    """
+    following全体を取得する前に、フォロー数(following_count)から変化の有無を判定するクラス
+
+    前回followingを取得した時のフォロー数と取得時刻を指紋として保存し、users lookupで取得した現在のフォロー数と比べる
+    - フォロー数が変わっていなければ、followingの取得を省略する(SKIP)
+    - フォロー数が増えていれば、増えた分だけ先頭のページから取得する(PARTIAL)
+    - それ以外(減った、指紋がない、前回の全件取得から時間が経ちすぎている)は全件取得する(FULL)
+    フォローと解除が同数あるとフォロー数は変わらないので、full_crawl_intervalごとには必ず全件取得する
+    """
+
+    SKIP = "skip"
+    PARTIAL = "partial"
+    FULL = "full"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS following_fingerprints (
+        user_id INTEGER PRIMARY KEY,
+        following_count INTEGER NOT NULL,
+        full_crawled_at REAL NOT NULL
+    );
+    """
+
+    def __init__(
+        self, path: str = ":memory:", full_crawl_interval: float = 7 * 24 * 60 * 60, clock: Optional[Clock] = None
+    ) -> None:
+        self.full_crawl_interval = full_crawl_interval
+        self.clock = clock or Clock()
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+        except sqlite3.Error:
+            logger.exception(f"Failed to initialize fingerprint database `{path}`")
+            raise DbInitializeError
+        # 直近の判定で取得したフォロー数と、増えた分(部分取得する場合)
+        self.__counts: Dict[int, int] = {}
+        self.__expected_new: Dict[int, int] = {}
+        # 部分取得で済んだ(最後のページまで取得しなかった)対象ユーザ
+        self.__partial: Set[int] = set()
+        self.saved_requests = 0
+        self.__lock = threading.Lock()
+
+    def plan(self, counts: Dict[int, int], user_ids: List[int]) -> Dict[int, str]:
+        """
+        対象ユーザごとに、followingの取得方法(SKIP/PARTIAL/FULL)を決める
+        countsに含まれない(フォロー数を取得できなかった)対象ユーザは全件取得する
+        """
+        now = self.clock.time()
+        fingerprints = self.__load(user_ids)
+        plans: Dict[int, str] = {}
+        with self.__lock:
+            for user_id in user_ids:
+                count = counts.get(user_id)
+                fingerprint = fingerprints.get(user_id)
+                self.__expected_new.pop(user_id, None)
+                if count is None:
+                    self.__counts.pop(user_id, None)
+                    plans[user_id] = self.FULL
+                    continue
+                self.__counts[user_id] = count
+                if fingerprint is None or now - fingerprint[1] >= self.full_crawl_interval:
+                    plans[user_id] = self.FULL
+                elif count == fingerprint[0]:
+                    plans[user_id] = self.SKIP
+                elif count > fingerprint[0]:
+                    plans[user_id] = self.PARTIAL
+                    self.__expected_new[user_id] = count - fingerprint[0]
+                else:
+                    plans[user_id] = self.FULL
+        return plans
+
+    def expected_new(self, user_id: int) -> Optional[int]:
+        """
+        部分取得する対象ユーザなら新たにフォローしたと見込まれる件数を、そうでなければNoneを返す
+        """
+        with self.__lock:
+            return self.__expected_new.get(user_id)
+
+    def crawled_partially(self, user_id: int) -> None:
+        with self.__lock:
+            self.__partial.add(user_id)
+
+    def update(self, user_id: int) -> None:
+        """
+        followingを取得して保存できたら、判定に使ったフォロー数を指紋として保存する
+        全件取得した場合は全件取得した時刻も更新する
+        """
+        with self.__lock:
+            count = self.__counts.pop(user_id, None)
+            self.__expected_new.pop(user_id, None)
+            full = user_id not in self.__partial
+            self.__partial.discard(user_id)
+        if count is None:
+            return
+        try:
+            with self.__lock:
+                self.connection.execute(
+                    """
+                    INSERT INTO following_fingerprints (user_id, following_count, full_crawled_at) VALUES (?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET following_count = excluded.following_count,
+                        full_crawled_at = CASE WHEN ? THEN excluded.full_crawled_at ELSE full_crawled_at END
+                    """,
+                    (user_id, count, self.clock.time(), full),
+                )
+        except sqlite3.Error:
+            logger.exception(f"Failed to save fingerprint of user id `{user_id}`")
+            raise DbOperationError
+
+    def add_saved_requests(self, requests: int) -> None:
+        with self.__lock:
+            self.saved_requests += max(requests, 0)
+        SAVED_REQUESTS.inc(max(requests, 0))
+
+    def take_saved_requests(self) -> int:
+        """
+        省略できたfollowing取得のリクエスト数を返し、カウンタを0に戻す
+        """
+        with self.__lock:
+            saved, self.saved_requests = self.saved_requests, 0
+        return saved
+
+    def __load(self, user_ids: List[int]) -> Dict[int, Tuple[int, float]]:
+        try:
+            with self.__lock:
+                rows = self.connection.execute(
+                    f"SELECT * FROM following_fingerprints WHERE user_id IN ({','.join('?' * len(user_ids))})",
+                    user_ids,
+                ).fetchall()
+        except sqlite3.Error:
+            logger.exception("Failed to get fingerprints")
+            raise DbOperationError
+        return {int(r[0]): (int(r[1]), float(r[2])) for r in rows}
@@ -0,0 +1,149 @@
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from loguru import logger
+
+from influ_rader.metrics import RATE_LIMIT_WAIT_SECONDS, RATE_LIMIT_WAITS
+
+
+class Clock:
+    """
+    時刻の取得と待機を行うクラス
+    テストでは時刻を自由に進められるクラスに差し替える
+    """
+
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+
+class TokenBucket:
+    """
+    1エンドポイント分のレート制限の状態
+    remaining: 現在のウィンドウで残っているリクエスト数
+    reset_at: 現在のウィンドウがリセットされる時刻(UNIX時間)
+    """
+
+    def __init__(self, limit: int, window: float) -> None:
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at: Optional[float] = None
+
+    def wait_time(self, now: float) -> float:
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = None
+        if self.remaining > 0:
+            return 0.0
+        return self.reset_at - now if self.reset_at is not None else self.window
+
+    def consume(self, now: float) -> None:
+        if self.reset_at is None:
+            # レスポンスヘッダを受け取るまではウィンドウの開始時刻を推定しておく
+            self.reset_at = now + self.window
+        self.remaining -= 1
+
+    def update(self, remaining: int, reset_at: float) -> None:
+        self.remaining = remaining
+        self.reset_at = reset_at
+
+
+class RateLimiter:
+    """
+    Twitter APIのエンドポイントごとのレート制限を管理するクラス
+
+    リクエスト前に`acquire`を呼び出すと、残りリクエスト数がなければウィンドウがリセットされるまで待機する
+    レスポンスの`x-rate-limit-remaining`/`x-rate-limit-reset`ヘッダで残りリクエスト数とリセット時刻を補正する
+    """
+
+    WINDOW = 15 * 60  # 15分
+    # アプリ認証(Bearer Token)での15分あたりのリクエスト上限
+    LIMITS = {
+        "get_user": 300,
+        "get_users": 300,
+        "get_users_following": 15,
+    }
+    DEFAULT_LIMIT = 15
+
+    def __init__(self, clock: Optional[Clock] = None, limits: Optional[Dict[str, int]] = None) -> None:
+        self.clock = clock or Clock()
+        self.__limits = {**self.LIMITS, **(limits or {})}
+        self.__buckets: Dict[str, TokenBucket] = {}
+        self.__lock = threading.Lock()
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        if endpoint not in self.__buckets:
+            self.__buckets[endpoint] = TokenBucket(self.__limits.get(endpoint, self.DEFAULT_LIMIT), self.WINDOW)
+        return self.__buckets[endpoint]
+
+    def acquire(self, endpoint: str) -> None:
+        """
+        エンドポイントのリクエスト枠を1つ確保する
+        枠が残っていなければウィンドウのリセット時刻までちょうど待機する
+        """
+        while True:
+            wait = self.try_acquire(endpoint)
+            if wait <= 0:
+                return
+            logger.warning(f"Twitter API request limit reached for `{endpoint}`. Wait {wait:.0f} seconds.")
+            RATE_LIMIT_WAITS.inc(endpoint=endpoint)
+            RATE_LIMIT_WAIT_SECONDS.inc(wait, endpoint=endpoint)
+            self.clock.sleep(wait)
+
+    def try_acquire(self, endpoint: str) -> float:
+        """
+        枠が残っていれば1つ確保して0を返し、残っていなければ確保せずにリセットまでの待ち時間を返す
+        """
+        with self.__lock:
+            bucket = self.bucket(endpoint)
+            wait = bucket.wait_time(self.clock.time())
+            if wait <= 0:
+                bucket.consume(self.clock.time())
+            return wait
+
+    def remaining(self, endpoint: str) -> Tuple[int, float]:
+        """
+        現在のウィンドウで残っているリクエスト数と、枠が残っていない場合のリセットまでの待ち時間を返す(枠は確保しない)
+        """
+        with self.__lock:
+            bucket = self.bucket(endpoint)
+            wait = bucket.wait_time(self.clock.time())
+            return bucket.remaining, wait
+
+    def clone(self) -> "RateLimiter":
+        """
+        同じ時計と上限で、状態を共有しないRateLimiterを作る(Bearer Tokenごとにレート制限を管理するために使う)
+        """
+        return RateLimiter(self.clock, self.__limits)
+
+    def update(self, endpoint: str, headers: Optional[Mapping[str, Any]]) -> None:
+        """
+        レスポンスヘッダからエンドポイントの残りリクエスト数とリセット時刻を更新する
+        """
+        if not isinstance(headers, Mapping):
+            return
+        try:
+            remaining = int(headers["x-rate-limit-remaining"])
+            reset_at = float(headers["x-rate-limit-reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.__lock:
+            self.bucket(endpoint).update(remaining, reset_at)
+
+    def exhaust(self, endpoint: str, headers: Optional[Mapping[str, Any]], fallback: Optional[float] = None) -> None:
+        """
+        リクエスト上限に達した(429が返された)ことを記録する
+        ヘッダにリセット時刻が含まれていなければ、fallback秒(デフォルトはウィンドウ1つ分)待つ
+        """
+        reset_at = self.clock.time() + (fallback if fallback is not None else self.WINDOW)
+        if isinstance(headers, Mapping) and "x-rate-limit-reset" in headers:
+            try:
+                reset_at = float(headers["x-rate-limit-reset"])
+            except (TypeError, ValueError):
+                pass
+        with self.__lock:
+            self.bucket(endpoint).update(0, reset_at)
@@ -0,0 +1,489 @@
+"""
+Twitter APIのレスポンスとストレージの状態を記録し、記録したアーカイブを使ってdiffパイプラインをオフラインで再生する
+
+記録: 環境変数RECORD_ARCHIVEにパスを指定してBotを起動すると、全てのBearer Tokenのクライアントのレスポンス
+(レート制限のヘッダと429/401を含む)と、対象ユーザごとに最初に読み込んだ保存済みのfollowingsと、保存した差分を
+1行1件のJSON(JSON Lines)としてアーカイブに追記する(Bearer Token自体は記録せず、ハッシュの先頭だけを記録する)
+
+再生: 記録したレスポンスを本物のTwitter・Storage(一時ディレクトリのSQLite)・TwitterCogに流し、
+投稿はDiscordのチャンネルの代わりにメモリに(指定すればファイルにも)書き出す
+時計は記録を始めた時刻から始まる仮想の時計で、レート制限などの待機は時刻を進めるだけにして、
+24時間分のループ(15分ごとの取得と1分ごとの再実行)を実際には待たずに実行する
+
+    python -m influ_rader.replay archive.jsonl
+    python -m influ_rader.replay archive.jsonl --hours 6 --output diffs.jsonl --profile-dir profiles
+
+再生はジョブ・取得スケジュールなどのSQLiteが空の状態から始まるので、記録した時と同じリクエストになるとは限らない
+記録にないユーザ情報の取得は記録したユーザ情報から組み立て、それもできないリクエストはエラーのレスポンスを返して
+missとして数える(記録を始める時はJOB_DB_PATHを空のファイルにしておくと、再生とリクエストが揃いやすい)
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.twitter_cog import TwitterCog
+from influ_rader.credentials import ClientFactory
+from influ_rader.history import FollowHistory
+from influ_rader.jobs import JobQueue
+from influ_rader.metrics import RunProfiler
+from influ_rader.notify import DiscordChannelSink, FileSink, NotificationQueue, Notifier, Sink
+from influ_rader.precheck import ChangeDetector
+from influ_rader.rate_limit import Clock, RateLimiter
+from influ_rader.schedule import PollScheduler
+from influ_rader.sqlite_db import SqliteDb
+from influ_rader.storage import FetchedFollowings, Storage, UsersFollowings
+from influ_rader.trending import TrendIndex
+from influ_rader.twitter import Twitter
+
+if TYPE_CHECKING:
+    from influ_rader.diff import Snapshot
+
+# レスポンスにユーザ情報が含まれるエンドポイント(再生時に記録にないユーザ情報の取得を組み立てるのに使う)
+USER_ENDPOINTS = ["get_user", "get_users", "get_users_following"]
+
+
+def credential_label(bearer_token: str) -> str:
+    """
+    アーカイブに記録するBearer Tokenの名前(Bearer Token自体は記録しない)
+    """
+    return hashlib.sha256(bearer_token.encode()).hexdigest()[:8]
+
+
+def _key(endpoint: str, params: Dict[str, Any]) -> str:
+    return f"{endpoint}:{json.dumps(params, sort_keys=True)}"
+
+
+def _plain(value: Any) -> Any:
+    """
+    tweepyのレスポンス(モデルのオブジェクトを含む)を、JSONにできる値にする
+    """
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(getattr(value, "data", None), dict):  # tweepy.Userなどのモデル
+        return value.data
+    return value
+
+
+class Archive:
+    """
+    記録したAPIのレスポンスとストレージの状態(1件ごとの辞書)を保持するアーカイブ
+    pathを指定した場合はファイルに追記し(メモリには持たない)、指定しなければメモリに持つ
+
+    記録の種類(kind):
+    - targets: 起動時の対象ユーザ名(users)
+    - request: APIのリクエスト(endpoint, params, credential)とレスポンス(status, headers, response)
+    - stored: 対象ユーザごとに最初に読み込んだ保存済みのfollowings(followings)
+    - save: 保存した差分(added, removed)
+    """
+
+    def __init__(self, path: Optional[str] = None, clock: Optional[Clock] = None) -> None:
+        self.path = path
+        self.clock = clock or Clock()
+        self.records: List[Dict[str, Any]] = []
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "Archive":
+        """
+        ファイルに記録したアーカイブを読み込む(読み込んだアーカイブに追記してもファイルには書き込まない)
+        """
+        archive = cls()
+        with open(path, encoding="utf-8") as f:
+            archive.records = [json.loads(line) for line in f if line.strip()]
+        return archive
+
+    def append(self, kind: str, **fields: Any) -> None:
+        record = {"kind": kind, "at": self.clock.time(), **fields}
+        with self.__lock:
+            if self.path is None:
+                self.records.append(record)
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def of(self, kind: str) -> List[Dict[str, Any]]:
+        return [r for r in self.records if r["kind"] == kind]
+
+    def started_at(self) -> float:
+        return min((r["at"] for r in self.records), default=0.0)
+
+    def targets(self) -> List[str]:
+        """
+        最後に記録した起動時の対象ユーザ名
+        """
+        records = self.of("targets")
+        return list(records[-1]["users"]) if records else []
+
+    def credentials(self) -> List[str]:
+        return list(dict.fromkeys(r["credential"] for r in self.of("request")))
+
+    def stored(self) -> UsersFollowings:
+        """
+        対象ユーザごとに、最初に読み込んだ時点の保存済みのfollowings(記録を始めた時点のストレージの状態)
+        """
+        stored: UsersFollowings = {}
+        for record in self.of("stored"):
+            for user_id, followings in record["followings"].items():
+                stored.setdefault(int(user_id), followings)
+        return stored
+
+    def saved(self) -> Tuple[int, int]:
+        """
+        保存した差分の(追加されたfollowingsの件数, 解除されたfollowingsの件数)
+        """
+        saves = self.of("save")
+        added = sum(len(v) for r in saves for v in r["added"].values())
+        removed = sum(len(v) for r in saves for v in r["removed"].values())
+        return added, removed
+
+
+class RecordingClient:
+    """
+    Twitter APIのクライアント(tweepy.Client)のリクエストとレスポンスをアーカイブに記録するラッパー
+    """
+
+    def __init__(self, client: Any, archive: Archive, credential: str) -> None:
+        self.client = client
+        self.archive = archive
+        self.credential = credential
+
+    @property
+    def last_response_headers(self) -> Any:
+        return getattr(self.client, "last_response_headers", None)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+        return functools.partial(self.__call, name, attr)
+
+    def __call(self, endpoint: str, method: Callable[..., Any], **params: Any) -> Any:
+        from tweepy import TooManyRequests, Unauthorized
+
+        record = {"endpoint": endpoint, "params": params, "credential": self.credential}
+        try:
+            res = method(**params)
+        except (TooManyRequests, Unauthorized) as e:
+            headers = {k.lower(): v for k, v in e.response.headers.items()}
+            self.archive.append("request", **record, status=e.response.status_code, headers=headers, response=None)
+            raise
+        headers = {k.lower(): v for k, v in (self.last_response_headers or {}).items()}
+        self.archive.append("request", **record, status=200, headers=headers, response=_plain(res._asdict()))
+        return res
+
+
+def recording_client_factory(factory: ClientFactory, archive: Archive) -> ClientFactory:
+    """
+    Bearer Tokenからクライアントを作る関数を、レスポンスをアーカイブに記録するクライアントを作る関数にする
+    """
+    return lambda bearer_token: RecordingClient(factory(bearer_token), archive, credential_label(bearer_token))
+
+
+class RecordingStorage(Storage):
+    """
+    対象ユーザごとに最初に読み込んだ保存済みのfollowingsと、保存した差分をアーカイブに記録するストレージのラッパー
+    差分とスナップショットの保持はラップしたストレージに任せる
+    """
+
+    def __init__(self, storage: Storage, archive: Archive) -> None:
+        super().__init__()
+        self.storage = storage
+        self.archive = archive
+        self.__recorded: set[int] = set()
+        self.__lock = threading.Lock()
+
+    def get_users_followings(self, user_ids: List[int]) -> UsersFollowings:
+        return self.storage.get_users_followings(user_ids)
+
+    def save_users_followings(self, added: UsersFollowings, removed: UsersFollowings) -> None:
+        self.storage.save_users_followings(added, removed)
+        self.archive.append(
+            "save",
+            added={str(k): v for k, v in added.items() if v},
+            removed={str(k): v for k, v in removed.items() if v},
+        )
+
+    def warm_up(self) -> None:
+        self.storage.warm_up()
+
+    def diff_users_followings(self, from_twitter: FetchedFollowings) -> Tuple[UsersFollowings, UsersFollowings]:
+        # 差分を取る前に読み込まれるスナップショットを記録する(ラップしたストレージが保持するので読み込みは1回のまま)
+        self.get_snapshots(list(from_twitter))
+        return self.storage.diff_users_followings(from_twitter)
+
+    def get_snapshots(self, user_ids: List[int]) -> "dict[int, Snapshot]":
+        snapshots = self.storage.get_snapshots(user_ids)
+        with self.__lock:
+            new = {k: v for k, v in snapshots.items() if k not in self.__recorded}
+            self.__recorded.update(new)
+        if new:
+            self.archive.append("stored", followings={str(k): v.ids.tolist() for k, v in new.items()})
+        return snapshots
+
+
+class ReplayClock(Clock):
+    """
+    待機すると実際には待たずに時刻だけを進める仮想の時計(複数のスレッドから使える)
+    """
+
+    def __init__(self, now: float) -> None:
+        self.now = now
+        self.waited = 0.0
+        self.__lock = threading.Lock()
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        with self.__lock:
+            self.now += max(seconds, 0.0)
+            self.waited += max(seconds, 0.0)
+
+    async def async_sleep(self, seconds: float) -> None:
+        self.sleep(seconds)
+        await asyncio.sleep(0)
+
+    def advance_to(self, at: float) -> None:
+        with self.__lock:
+            self.now = max(self.now, at)
+
+
+class ReplayClient:
+    """
+    アーカイブに記録したレスポンスを返すTwitter APIのクライアント(tweepy.Clientの代わり)
+
+    同じエンドポイント・パラメータのリクエストには記録した順にレスポンスを返し、記録した429/401はそのまま例外にする
+    記録を使い切った後は最後に成功したレスポンスを返し続ける(アカウントの状態は変わっていないとみなす)
+    記録にないユーザ情報の取得は記録したユーザ情報から組み立て、それ以外はエラーのレスポンスを返す
+    """
+
+    def __init__(self, archive: Archive) -> None:
+        self.requests = 0
+        self.misses = 0
+        self.__responses: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        self.__last: Dict[str, Dict[str, Any]] = {}
+        # "id:ユーザID"と"username:ユーザ名(小文字)"からユーザ情報への索引(後に記録したものを優先する)
+        self.__users: Dict[str, Dict[str, Any]] = {}
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        for record in archive.of("request"):
+            self.__responses[_key(record["endpoint"], record["params"])].append(record)
+            if record["endpoint"] in USER_ENDPOINTS and record["response"] is not None:
+                data = record["response"]["data"]
+                for user in data if isinstance(data, list) else [data] if data else []:
+                    self.__users[f"id:{int(user['id'])}"] = user
+                    if "username" in user:
+                        self.__users[f"username:{user['username'].lower()}"] = user
+
+    @property
+    def last_response_headers(self) -> Optional[Dict[str, Any]]:
+        return getattr(self.__local, "headers", None)
+
+    def __getattr__(self, endpoint: str) -> Callable[..., Any]:
+        if endpoint.startswith("_"):
+            raise AttributeError(endpoint)
+        return functools.partial(self.__replay, endpoint)
+
+    def __replay(self, endpoint: str, **params: Any) -> Any:
+        import requests
+        from tweepy import Response, TooManyRequests, Unauthorized
+
+        key = _key(endpoint, params)
+        with self.__lock:
+            self.requests += 1
+            queue = self.__responses.get(key)
+            record = queue.popleft() if queue else self.__last.get(key)
+            if record is not None and record["status"] == 200:
+                self.__last[key] = record
+        self.__local.headers = record["headers"] if record is not None else None
+        if record is None:
+            return self.__compose(endpoint, params, key)
+        if record["status"] != 200:
+            res = requests.Response()
+            res.status_code = record["status"]
+            res.headers.update(record["headers"])
+            raise (TooManyRequests if record["status"] == 429 else Unauthorized)(res)
+        return Response(**record["response"])
+
+    def __compose(self, endpoint: str, params: Dict[str, Any], key: str) -> Any:
+        from tweepy import Response
+
+        if endpoint == "get_users":
+            keys = [f"id:{int(i)}" for i in params.get("ids") or []]
+            keys += [f"username:{u.lower()}" for u in params.get("usernames") or []]
+        elif endpoint == "get_user":
+            keys = [f"id:{int(params['id'])}" if "id" in params else f"username:{params['username'].lower()}"]
+        else:
+            keys = []
+        found = [self.__users[k] for k in keys if k in self.__users]
+        if keys and len(found) == len(keys):
+            return Response(data=found if endpoint == "get_users" else found[0], includes={}, errors=[], meta={})
+        with self.__lock:
+            self.misses += 1
+        logger.warning(f"No recorded response for `{key}`")
+        if found or endpoint == "get_users":
+            # users lookupは一部のユーザが見つからなくても、見つかったユーザとエラーを返す
+            errors = [{"value": k.split(":", 1)[1], "title": "Not Found Error"} for k in keys if k not in self.__users]
+            return Response(data=found or None, includes={}, errors=errors, meta={})
+        return Response(data=None, includes={}, errors=[{"title": "Not Recorded", "detail": key}], meta={})
+
+
+class ReplayChannel:
+    """
+    投稿したメッセージを記録するだけのDiscordのチャンネル
+    """
+
+    def __init__(self) -> None:
+        self.messages: List[str] = []
+
+    async def send(self, content: str) -> None:
+        self.messages.append(content)
+
+
+class ReplayBot:
+    """
+    再生に使うDiscordのBotの代わり
+    準備完了にならないので、TwitterCogが自分で始めるループは実行されない(再生側が仮想の時刻に合わせて実行する)
+    """
+
+    def __init__(self, channel: ReplayChannel) -> None:
+        self.channel = channel
+
+    def get_channel(self, channel_id: int) -> ReplayChannel:
+        return self.channel
+
+    async def wait_until_ready(self) -> None:
+        await asyncio.Event().wait()
+
+
+class ReplayResult(NamedTuple):
+    virtual_seconds: float  # 再生した仮想の時間
+    wall_seconds: float  # 再生にかかった実時間
+    runs: int  # 実行したdiff_users_followingsの回数
+    requests: int  # 再生したAPIのリクエスト数
+    misses: int  # 記録になかったリクエスト数
+    rate_limit_wait_seconds: float  # レート制限などで待ったはずの時間
+    messages: List[str]  # Discordに投稿したはずのメッセージ
+    recorded: Tuple[int, int]  # 記録した時に保存した差分の(追加, 解除)の件数
+    replayed: Tuple[int, int]  # 再生して保存した差分の(追加, 解除)の件数
+
+
+async def replay(
+    archive: Archive,
+    hours: float = 24.0,
+    targets: Optional[List[str]] = None,
+    output: Optional[str] = None,
+    concurrency: int = 1,
+    profile_dir: Optional[str] = None,
+) -> ReplayResult:
+    """
+    記録したアーカイブを使って、hours時間分のTwitterCogのループを仮想の時計で実行する
+    targets: 対象ユーザ名(指定しなければ記録した起動時の対象ユーザ)
+    output: 指定した場合、差分をJSON Linesで書き出すファイル
+    concurrency: 同時にリクエストするスレッドの数(1なら再生するたびに同じ順でリクエストする)
+    """
+    clock = ReplayClock(archive.started_at())
+    client = ReplayClient(archive)
+    tokens = archive.credentials() or ["replay"]
+    twitter = Twitter(tokens, rate_limiter=RateLimiter(clock=clock), client_factory=lambda _: client)
+    saves = Archive(clock=clock)
+    channel = ReplayChannel()
+    bot = ReplayBot(channel)
+    sinks: List[Sink] = [DiscordChannelSink(bot, 0, clock=clock, sleep=clock.async_sleep)]
+    if output is not None:
+        sinks.append(FileSink(output, clock=clock))
+    executor = BoundedExecutor(concurrency)
+    history = FollowHistory(clock=clock)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # 記録を始めた時点の保存済みのfollowingsを入れたSQLiteを、スナップショットを持たない別のインスタンスで開き直す
+        path = os.path.join(directory, "replay.sqlite3")
+        SqliteDb(path).save_users_followings(archive.stored(), {})
+        cog = TwitterCog(
+            bot,
+            twitter,
+            RecordingStorage(SqliteDb(path), saves),
+            targets or archive.targets(),
+            0,
+            executor,
+            jobs=JobQueue(clock=clock),
+            scheduler=PollScheduler(budget=RateLimiter.LIMITS["get_users_following"] * len(tokens), clock=clock),
+            detector=ChangeDetector(clock=clock),
+            profiler=RunProfiler(profile_dir),
+            notifier=Notifier([NotificationQueue(sink, sleep=clock.async_sleep) for sink in sinks]),
+            history=history,
+            trends=TrendIndex(clock=clock),
+        )
+        start = clock.time()
+        steps = int(hours * 60 * 60 // TwitterCog.RETRY_INTERVAL)
+        per_window = RateLimiter.WINDOW // TwitterCog.RETRY_INTERVAL
+        runs = 0
+        wall = time.perf_counter()
+        try:
+            for step in range(steps):
+                # 前のステップのレート制限の待機で時計が先に進んでいれば、そのまま次のステップを実行する
+                clock.advance_to(start + step * TwitterCog.RETRY_INTERVAL)
+                if step % per_window == 0:
+                    await TwitterCog.diff_users_followings.coro(cog)
+                    runs += 1
+                else:
+                    await TwitterCog.retry_crawl_jobs.coro(cog)
+            await cog.notifier.join()
+        finally:
+            cog.diff_users_followings.cancel()
+            cog.retry_crawl_jobs.cancel()
+            executor.shutdown()
+        wall = time.perf_counter() - wall
+
+    return ReplayResult(
+        virtual_seconds=clock.time() - start,
+        wall_seconds=wall,
+        runs=runs,
+        requests=client.requests,
+        misses=client.misses,
+        rate_limit_wait_seconds=clock.waited,
+        messages=channel.messages,
+        recorded=archive.saved(),
+        replayed=saves.saved(),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", help="archive recorded with RECORD_ARCHIVE")
+    parser.add_argument("--hours", type=float, default=24.0, help="virtual hours to replay")
+    parser.add_argument("--targets", nargs="+", help="target usernames (default: recorded targets)")
+    parser.add_argument("--output", help="write detected diffs as json lines")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--profile-dir", help="save cProfile results of each run")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    archive = Archive.load(args.archive)
+    result = asyncio.run(replay(archive, args.hours, args.targets, args.output, args.concurrency, args.profile_dir))
+    print(f"replayed {result.virtual_seconds / 3600:.1f}h in {result.wall_seconds:.2f}s ({result.runs} runs)")
+    print(f"api requests: {result.requests} (not recorded: {result.misses})")
+    print(f"rate limit wait: {result.rate_limit_wait_seconds:.0f}s")
+    print(f"discord messages: {len(result.messages)}")
+    print(f"saved followings (added, removed): recorded {result.recorded}, replayed {result.replayed}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
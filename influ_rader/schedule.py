@@ -0,0 +1,164 @@
+import math
+import sqlite3
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.metrics import DETECTION_LATENCY_SECONDS
+from influ_rader.rate_limit import Clock, RateLimiter
+
+
+class PollScheduler:
+    """
+    対象ユーザごとにfollowingを取得する間隔を、過去の差分から学習して決めるクラス
+
+    取得するたびに、前回からの変化数/経過時間の指数移動平均(変化率)を更新し、
+    次の取得は「1件変化すると見込まれる時間」後(min_interval〜max_interval)に行う
+    変化がなければ変化率が下がるので取得間隔は延び、頻繁にフォローする対象ユーザほど短い間隔で取得する
+
+    1回のtickで取得する対象ユーザは、following取得のリクエスト数(ページ数)の見込みがbudgetに収まるように選ぶ
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS poll_schedule (
+        user_id INTEGER PRIMARY KEY,
+        last_polled_at REAL NOT NULL,
+        next_poll_at REAL NOT NULL,
+        change_rate REAL,
+        pages INTEGER NOT NULL
+    );
+    """
+    SMOOTHING = 0.5  # 変化率の指数移動平均で、最新の観測に掛ける重み
+    LATENCY_SAMPLES = 1000  # 検出遅延を保持する件数
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        min_interval: float = 60 * 60,
+        max_interval: float = 7 * 24 * 60 * 60,
+        initial_interval: float = 24 * 60 * 60,
+        budget: int = RateLimiter.LIMITS["get_users_following"],
+        clock: Optional[Clock] = None,
+    ) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.budget = budget
+        self.clock = clock or Clock()
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+        except sqlite3.Error:
+            logger.exception(f"Failed to initialize schedule database `{path}`")
+            raise DbInitializeError
+        # 変化を検出した時の、前回の取得からの経過時間(検出遅延の上限)
+        self.__latencies: Deque[float] = deque(maxlen=self.LATENCY_SAMPLES)
+        self.__lock = threading.Lock()
+
+    def due(self, user_ids: List[int]) -> List[int]:
+        """
+        今取得すべき対象ユーザを、予定時刻を過ぎた割合が大きい順にbudgetの範囲で返す
+        一度も取得していない対象ユーザはすぐに取得する
+        budgetより多くのページがある対象ユーザでも取得できるよう、最初の1件は必ず含める
+        """
+        now = self.clock.time()
+        schedules = self.__load(user_ids)
+        candidates: List[Tuple[float, int, int]] = []
+        for user_id in user_ids:
+            schedule = schedules.get(user_id)
+            if schedule is None:
+                candidates.append((math.inf, user_id, 1))
+                continue
+            last_polled_at, next_poll_at, _, pages = schedule
+            if next_poll_at <= now:
+                overdue = (now - last_polled_at) / max(next_poll_at - last_polled_at, 1.0)
+                candidates.append((overdue, user_id, pages))
+        candidates.sort(key=lambda c: -c[0])
+        selected: List[int] = []
+        spent = 0
+        for _, user_id, pages in candidates:
+            if selected and spent + pages > self.budget:
+                continue
+            selected.append(user_id)
+            spent += pages
+        return selected
+
+    def record(self, user_id: int, changes: int, pages: int) -> float:
+        """
+        取得結果(変化したfollowingの数と、取得に使ったページ数)から変化率を更新し、次の取得予定時刻を返す
+        """
+        now = self.clock.time()
+        schedule = self.__load([user_id]).get(user_id)
+        rate: Optional[float] = None
+        if schedule is None:
+            # 初回は比較対象がないので変化率は分からない
+            interval = self.initial_interval
+        else:
+            last_polled_at, _, previous_rate, _ = schedule
+            elapsed = max(now - last_polled_at, 1.0)
+            observed = changes / elapsed
+            if previous_rate is not None:
+                rate = self.SMOOTHING * observed + (1 - self.SMOOTHING) * previous_rate
+            else:
+                rate = observed
+            interval = 1 / rate if rate > 0 else self.max_interval
+            if changes:
+                with self.__lock:
+                    self.__latencies.append(elapsed)
+                DETECTION_LATENCY_SECONDS.observe(elapsed)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        try:
+            with self.__lock:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO poll_schedule VALUES (?, ?, ?, ?, ?)",
+                    (user_id, now, now + interval, rate, max(pages, 1)),
+                )
+        except sqlite3.Error:
+            logger.exception(f"Failed to save poll schedule of user id `{user_id}`")
+            raise DbOperationError
+        return now + interval
+
+    def detection_latency(self) -> Dict[str, float]:
+        """
+        変化を検出するまでの遅延(前回の取得から変化を検出した取得までの時間)の統計を返す
+        実際にフォローした時刻は分からないので、遅延の上限値になる
+        """
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+        if not latencies:
+            return {"count": 0, "mean": 0.0, "p50": 0.0, "max": 0.0}
+        return {
+            "count": len(latencies),
+            "mean": sum(latencies) / len(latencies),
+            "p50": latencies[len(latencies) // 2],
+            "max": latencies[-1],
+        }
+
+    def intervals(self) -> Dict[int, float]:
+        """
+        対象ユーザごとの現在の取得間隔(秒)を返す
+        """
+        try:
+            with self.__lock:
+                rows = self.connection.execute(
+                    "SELECT user_id, next_poll_at - last_polled_at FROM poll_schedule"
+                ).fetchall()
+        except sqlite3.Error:
+            logger.exception("Failed to get poll schedules")
+            raise DbOperationError
+        return {int(r[0]): float(r[1]) for r in rows}
+
+    def __load(self, user_ids: List[int]) -> Dict[int, Tuple[float, float, Optional[float], int]]:
+        try:
+            with self.__lock:
+                rows = self.connection.execute(
+                    f"SELECT * FROM poll_schedule WHERE user_id IN ({','.join('?' * len(user_ids))})", user_ids
+                ).fetchall()
+        except sqlite3.Error:
+            logger.exception("Failed to get poll schedules")
+            raise DbOperationError
+        return {int(r[0]): (float(r[1]), float(r[2]), r[3], int(r[4])) for r in rows}
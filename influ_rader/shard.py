@@ -0,0 +1,145 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from influ_rader.credentials import ClientFactory
+from influ_rader.jobs import SqliteCheckpoint
+from influ_rader.twitter import FollowingResult, Twitter
+
+# ワーカプロセスごとに、Bearer TokenごとのTwitterクラスを保持する
+# レート制限の状態とfollowing取得のcheckpointは、同じプロセスで次に実行した時に引き継がれる
+_twitters: Dict[str, Twitter] = {}
+_twitters_lock = threading.Lock()
+
+
+def _twitter_for(bearer_token: str, checkpoint_path: Optional[str], client_factory: Optional[ClientFactory]) -> Twitter:
+    with _twitters_lock:
+        if bearer_token not in _twitters:
+            checkpoint = SqliteCheckpoint(checkpoint_path) if checkpoint_path is not None else None
+            _twitters[bearer_token] = Twitter(bearer_token, checkpoint=checkpoint, client_factory=client_factory)
+        return _twitters[bearer_token]
+
+
+def crawl_followings(
+    bearer_token: str,
+    user_ids: List[int],
+    checkpoint_path: Optional[str] = None,
+    client_factory: Optional[ClientFactory] = None,
+) -> Dict[int, FollowingResult]:
+    """
+    ワーカプロセスで実行される処理
+    担当する対象ユーザのfollowingを取得し、対象ユーザごとに64bit整数の配列か失敗した時の例外を返す
+    (配列はそのままpickleしてコーディネータに返す。一部の対象ユーザで失敗しても、他の対象ユーザの結果は返す)
+    checkpoint_pathを指定すると、取得の途中経過をSQLiteに保存してプロセスの再起動後も続きから取得できる
+    client_factoryは、プロセスで最初にそのBearer Tokenを使う時に1回だけ呼び出される
+    """
+    return _twitter_for(bearer_token, checkpoint_path, client_factory).get_users_id_following_results(user_ids)
+
+
+class HashRing:
+    """
+    コンシステントハッシュで対象ユーザをシャードに割り当てるクラス
+
+    各シャードをreplicas個の仮想ノードとしてリング上に配置し、キーのハッシュ値から時計回りに最初のノードを担当とする
+    ハッシュ値はプロセスをまたいでも変わらないようにmd5で計算する
+    シャード数を変えても、移動する対象ユーザは全体の1/シャード数程度で済む
+    """
+
+    def __init__(self, shards: Sequence[str], replicas: int = 100) -> None:
+        if not shards:
+            raise ValueError("HashRing needs at least one shard")
+        self.shards = list(shards)
+        self.replicas = replicas
+        ring = sorted((self.__hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(replicas))
+        self.__hashes = [h for h, _ in ring]
+        self.__nodes = [shard for _, shard in ring]
+
+    @staticmethod
+    def __hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get(self, key: object) -> str:
+        index = bisect.bisect(self.__hashes, self.__hash(str(key))) % len(self.__hashes)
+        return self.__nodes[index]
+
+    def partition(self, keys: Sequence[int]) -> Dict[str, List[int]]:
+        """
+        キーをシャードごとに分割する(各シャード内のキーは入力順)
+        """
+        partitions: Dict[str, List[int]] = {shard: [] for shard in self.shards}
+        for key in keys:
+            partitions[self.get(key)].append(key)
+        return partitions
+
+
+class ShardedCrawler:
+    """
+    対象ユーザをコンシステントハッシュで複数のワーカプロセスに分割し、followingを並列に取得するクラス
+
+    シャードiはi番目のBearer Token(トークン数で循環)を使い、専用のプロセスで実行される
+    シャード数がトークン数より多い場合、同じトークンを使うプロセス同士のレート制限は429が返された時に合わせる
+    同じ対象ユーザは常に同じプロセスが担当するので、レート制限とcheckpointの状態がプロセス内で引き継がれる
+    Discordへの接続と差分の計算・保存はコーディネータ(Botのプロセス)が行う
+    """
+
+    def __init__(
+        self,
+        bearer_tokens: List[str],
+        shards: int,
+        executor_factory: Optional[Callable[[], Executor]] = None,
+        checkpoint_path: Optional[str] = None,
+        client_factory: Optional[ClientFactory] = None,
+    ) -> None:
+        """
+        client_factory: Bearer Tokenからクライアントを作る関数(ワーカプロセスに渡すのでpickleできること、指定しなければtweepyのクライアントを作る)
+        """
+        if not bearer_tokens:
+            raise ValueError("ShardedCrawler needs at least one bearer token")
+        names = [f"shard-{i}" for i in range(shards)]
+        self.ring = HashRing(names)
+        self.checkpoint_path = checkpoint_path
+        self.client_factory = client_factory
+        # Botのプロセスはメトリクスのサーバやスレッドプールのスレッドが動いていて、forkすると子プロセスで
+        # 他のスレッドが持っていたロックが解放されずにデッドロックすることがあるので、ワーカはspawnで起動する
+        factory = executor_factory or (
+            lambda: ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        )
+        self.__shards: Dict[str, Tuple[str, Executor]] = {
+            name: (bearer_tokens[i % len(bearer_tokens)], factory()) for i, name in enumerate(names)
+        }
+
+    async def get_users_id_following(self, user_ids: List[int]) -> Dict[int, FollowingResult]:
+        """
+        各シャードの担当分を並列に取得して、対象ユーザごとに取得したユーザIDか失敗した時の例外を入力順に返す
+        シャード(ワーカプロセス)ごと失敗した場合は、そのシャードが担当する全ての対象ユーザの結果をその例外とする
+        """
+        loop = asyncio.get_running_loop()
+        partitions = {k: v for k, v in self.ring.partition(user_ids).items() if v}
+        sizes = {k: len(v) for k, v in partitions.items()}
+        logger.info(f"Crawl followings of target users in shards `{sizes}`")
+        futures = []
+        for name, ids in partitions.items():
+            token, executor = self.__shards[name]
+            futures.append(
+                loop.run_in_executor(executor, crawl_followings, token, ids, self.checkpoint_path, self.client_factory)
+            )
+        results: Dict[int, FollowingResult] = {}
+        for ids, result in zip(partitions.values(), await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(result, Exception):
+                logger.opt(exception=result).error(f"Failed to crawl followings of user ids `{ids}` in a shard")
+                results.update(dict.fromkeys(ids, result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                results.update(result)
+        return {user_id: results[user_id] for user_id in user_ids}
+
+    def shutdown(self) -> None:
+        for _, executor in self.__shards.values():
+            executor.shutdown(wait=False)
@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+from loguru import logger
+
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.metrics import DB_OPERATION_SECONDS, timed_method
+from influ_rader.storage import FetchedFollowings, Storage, UsersFollowings
+
+
+class SqliteDb(Storage):
+    """
+    ローカルのSQLiteにfollowingsを保存するストレージ
+    (対象ユーザ, フォローしているユーザ)を1行とする正規化したテーブルに保存し、差分はSQLで取る
+    Googleの認証情報がなくても動かせるので、オフラインでの実行やテストでも使える
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS followings (
+        target_id INTEGER NOT NULL,
+        followed_id INTEGER NOT NULL,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL,
+        PRIMARY KEY (target_id, followed_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS followings_followed_id ON followings (followed_id);
+    """
+
+    def __init__(self, path: str = ":memory:") -> None:
+        super().__init__()
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+        except sqlite3.Error:
+            logger.exception(f"Failed to initialize sqlite database `{path}`")
+            raise DbInitializeError
+        # スレッドプールから呼び出されるので、コネクションへのアクセスを直列化する
+        self.__lock = threading.Lock()
+
+    @timed_method(DB_OPERATION_SECONDS)
+    def get_users_followings(self, user_ids: List[int]) -> UsersFollowings:
+        users_followings: UsersFollowings = {}
+        try:
+            with self.__lock:
+                for user_id in user_ids:
+                    rows = self.connection.execute(
+                        "SELECT followed_id FROM followings WHERE target_id = ?", (user_id,)
+                    ).fetchall()
+                    if rows:
+                        users_followings[user_id] = [r[0] for r in rows]
+        except sqlite3.Error:
+            logger.exception("Failed to get followings from sqlite database")
+            raise DbOperationError
+        return users_followings
+
+    @timed_method(DB_OPERATION_SECONDS)
+    def diff_users_followings(self, from_twitter: FetchedFollowings) -> Tuple[UsersFollowings, UsersFollowings]:
+        """
+        Twitterから取得したfollowingsを一時テーブルに入れて、保存されているfollowingsとの差分をSQLで取る
+        (全件をメモリに読み込むスナップショットとの比較は行わない)
+        引き続きフォローしているユーザは、今回確認できたものとしてlast_seenを更新する
+        """
+        added: UsersFollowings = {k: [] for k in from_twitter}
+        removed: UsersFollowings = {}
+        try:
+            with self.__lock, self.__transaction():
+                self.connection.execute("DROP TABLE IF EXISTS temp.current_targets")
+                self.connection.execute("DROP TABLE IF EXISTS temp.current_followings")
+                self.connection.execute("CREATE TEMP TABLE current_targets (target_id INTEGER PRIMARY KEY)")
+                self.connection.execute(
+                    """
+                    CREATE TEMP TABLE current_followings (
+                        target_id INTEGER NOT NULL,
+                        followed_id INTEGER NOT NULL,
+                        PRIMARY KEY (target_id, followed_id)
+                    ) WITHOUT ROWID
+                    """
+                )
+                self.connection.executemany("INSERT INTO current_targets VALUES (?)", [(k,) for k in from_twitter])
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO current_followings VALUES (?, ?)",
+                    ((k, f) for k, v in from_twitter.items() for f in v),
+                )
+                for target_id, followed_id in self.connection.execute(
+                    """
+                    SELECT c.target_id, c.followed_id FROM current_followings c
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM followings f WHERE f.target_id = c.target_id AND f.followed_id = c.followed_id
+                    )
+                    """
+                ):
+                    added[target_id].append(followed_id)
+                for target_id, followed_id in self.connection.execute(
+                    """
+                    SELECT f.target_id, f.followed_id FROM followings f
+                    JOIN current_targets t ON t.target_id = f.target_id
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM current_followings c
+                        WHERE c.target_id = f.target_id AND c.followed_id = f.followed_id
+                    )
+                    """
+                ):
+                    removed.setdefault(target_id, []).append(followed_id)
+                self.connection.execute(
+                    """
+                    UPDATE followings SET last_seen = ?
+                    WHERE EXISTS (
+                        SELECT 1 FROM current_followings c
+                        WHERE c.target_id = followings.target_id AND c.followed_id = followings.followed_id
+                    )
+                    """,
+                    (time.time(),),
+                )
+        except sqlite3.Error:
+            logger.exception("Failed to diff followings on sqlite database")
+            raise DbOperationError
+        return added, removed
+
+    @timed_method(DB_OPERATION_SECONDS)
+    def save_users_followings(self, added: UsersFollowings, removed: UsersFollowings) -> None:
+        now = time.time()
+        try:
+            with self.__lock, self.__transaction():
+                self.connection.executemany(
+                    """
+                    INSERT INTO followings (target_id, followed_id, first_seen, last_seen) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (target_id, followed_id) DO UPDATE SET last_seen = excluded.last_seen
+                    """,
+                    ((k, f, now, now) for k, v in added.items() for f in v),
+                )
+                self.connection.executemany(
+                    "DELETE FROM followings WHERE target_id = ? AND followed_id = ?",
+                    ((k, f) for k, v in removed.items() for f in v),
+                )
+        except sqlite3.Error:
+            logger.exception("Failed to save followings to sqlite database")
+            raise DbOperationError
+        self._update_snapshots(added, removed)
+
+    @contextmanager
+    def __transaction(self) -> Iterator[None]:
+        """
+        autocommitモードのコネクションで、withブロック内の処理を1つのトランザクションにまとめる
+        """
+        self.connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
@@ -0,0 +1,98 @@
+from abc import ABC, abstractmethod
+from typing import Iterable, List, Mapping, Optional, Tuple
+
+from influ_rader.diff import Snapshot
+from influ_rader.metrics import DB_OPERATION_SECONDS, timed_method
+
+# 対象ユーザのユーザIDごとのfollowingsのユーザIDのリスト
+UsersFollowings = dict[int, List[int]]
+# Twitterから取得した対象ユーザのユーザIDごとのfollowingsのユーザID(整数配列などのイテラブル)
+FetchedFollowings = Mapping[int, Iterable[int]]
+
+
+class Storage(ABC):
+    """
+    対象ユーザのfollowingsを保存するストレージのインターフェース
+
+    差分は対象ユーザごとの直近のスナップショット(ソート済みの整数配列)とのマージで取る
+    スナップショットは初回だけストレージから読み込み、以降は保存に成功した差分を反映してメモリ上に保持する
+    """
+
+    def __init__(self) -> None:
+        self.__snapshots: dict[int, Snapshot] = {}
+
+    @abstractmethod
+    def get_users_followings(self, user_ids: List[int]) -> UsersFollowings:
+        """
+        対象ユーザごとに保存されているfollowingsを取得する
+        followingsが保存されていないユーザは結果に含めない
+        """
+
+    @abstractmethod
+    def save_users_followings(self, added: UsersFollowings, removed: UsersFollowings) -> None:
+        """
+        対象ユーザごとに追加/解除されたfollowingsをまとめて保存する
+        実装クラスは保存に成功したら`_update_snapshots`を呼び出すこと
+        """
+
+    def warm_up(self) -> None:
+        """
+        時間のかかるクライアントの初期化を済ませておく(起動後に裏で呼び出す)
+        """
+
+    @timed_method(DB_OPERATION_SECONDS)
+    def diff_users_followings(self, from_twitter: FetchedFollowings) -> Tuple[UsersFollowings, UsersFollowings]:
+        """
+        Twitterから取得したfollowingsと保存されているfollowingsの差分を取る
+        戻り値は(新たにフォローしたユーザ, フォロー解除したユーザ)のタプル
+        """
+        self.__load_snapshots([k for k in from_twitter if k not in self.__snapshots])
+        added: UsersFollowings = {}
+        removed: UsersFollowings = {}
+        for user_id, following in from_twitter.items():
+            add, remove = self.__snapshots[user_id].diff(Snapshot.from_ids(following))
+            added[user_id] = add.tolist()
+            if remove:
+                removed[user_id] = remove.tolist()
+        return added, removed
+
+    def get_snapshots(self, user_ids: List[int]) -> dict[int, Snapshot]:
+        """
+        対象ユーザごとの保存されているfollowingsのスナップショットを返す
+        まだ読み込んでいない対象ユーザの分だけストレージから読み込む
+        """
+        self.__load_snapshots([k for k in user_ids if k not in self.__snapshots])
+        return {user_id: self.__snapshots[user_id] for user_id in user_ids}
+
+    def _next_snapshots(self, added: UsersFollowings, removed: UsersFollowings) -> dict[int, Snapshot]:
+        """
+        差分があった対象ユーザについて、差分を反映した後のスナップショットを返す
+        (followings全体を書き込むストレージ向け。保持しているスナップショットは保存に成功するまで変えない)
+        """
+        user_ids = [k for k in dict.fromkeys([*added, *removed]) if added.get(k) or removed.get(k)]
+        return {
+            user_id: snapshot.apply(added.get(user_id, []), removed.get(user_id, []))
+            for user_id, snapshot in self.get_snapshots(user_ids).items()
+        }
+
+    def _update_snapshots(
+        self, added: UsersFollowings, removed: UsersFollowings, snapshots: Optional[dict[int, Snapshot]] = None
+    ) -> None:
+        """
+        保存に成功した差分を保持しているスナップショットに反映する
+        snapshots: _next_snapshotsで作った差分を反映済みのスナップショット(指定した場合はそのまま置き換える)
+        """
+        if snapshots is not None:
+            self.__snapshots.update(snapshots)
+            return
+        for user_id in set(added) | set(removed):
+            if user_id in self.__snapshots:
+                snapshot = self.__snapshots[user_id]
+                self.__snapshots[user_id] = snapshot.apply(added.get(user_id, []), removed.get(user_id, []))
+
+    def __load_snapshots(self, user_ids: List[int]) -> None:
+        if not user_ids:
+            return
+        from_db = self.get_users_followings(user_ids)
+        for user_id in user_ids:
+            self.__snapshots[user_id] = Snapshot.from_ids(from_db.get(user_id, []))
@@ -0,0 +1,208 @@
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from influ_rader.error import DbInitializeError, DbOperationError, TwitterRequestError
+from influ_rader.rate_limit import Clock
+from influ_rader.twitter import Twitter, User
+
+# ユーザ名のリストから、見つかったユーザと見つからなかったユーザ名を返す関数(Twitter.lookup_users)
+Lookup = Callable[[List[str]], Tuple[List[User], List[str]]]
+# Twitterのユーザ名に使える文字と長さ(これ以外のユーザ名を問い合わせるとリクエスト全体が400になる)
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,15}$")
+
+
+class Target(NamedTuple):
+    username: str
+    user_id: Optional[int]
+    status: str
+    error: Optional[str]
+
+
+class TargetRegistry:
+    """
+    対象ユーザの一覧を、ユーザ名とユーザIDの対応と一緒にSQLiteに保存するクラス
+
+    対象ユーザは pending(未解決) -> active(ユーザIDを解決済み) と進み、見つからないユーザ名は quarantined として
+    following取得の対象から外す(quarantine_interval秒後に解決し直す)
+    ユーザ名として正しくないものは問い合わせずに quarantined として登録し、解決し直さない
+    解決済みのユーザ名は再起動しても解決し直さないので、対象ユーザを追加した時は追加したユーザ名だけを解決する
+    削除した対象ユーザは removed として残し、環境変数の対象ユーザに含まれていても追加し直さない
+    """
+
+    PENDING = "pending"
+    ACTIVE = "active"
+    QUARANTINED = "quarantined"
+    REMOVED = "removed"
+
+    INVALID = "invalid username"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS targets (
+        username TEXT PRIMARY KEY,
+        user_id INTEGER,
+        status TEXT NOT NULL,
+        error TEXT,
+        updated_at REAL NOT NULL
+    );
+    """
+
+    def __init__(
+        self, path: str = ":memory:", quarantine_interval: float = 24 * 60 * 60, clock: Optional[Clock] = None
+    ) -> None:
+        self.quarantine_interval = quarantine_interval
+        self.clock = clock or Clock()
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+        except sqlite3.Error:
+            logger.exception(f"Failed to initialize target database `{path}`")
+            raise DbInitializeError
+        self.__lock = threading.Lock()
+
+    def seed(self, usernames: Iterable[str]) -> None:
+        """
+        まだ登録されていないユーザ名を pending として登録する(設定ファイルや環境変数の対象ユーザの読み込みに使う)
+        ユーザ名として正しくないものは quarantined として登録する
+        """
+        now = self.clock.time()
+        with self.__operation("seed targets"):
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO targets (username, status, error, updated_at) VALUES (?, ?, ?, ?)",
+                [(u.lower(), *self.__initial_status(u), now) for u in usernames],
+            )
+
+    def add(self, usernames: Iterable[str]) -> List[str]:
+        """
+        ユーザ名を pending として登録し、新しく追加した(または削除済み・隔離中から戻した)ユーザ名を返す
+        ユーザ名として正しくないものは quarantined として登録し、返すユーザ名には含めない
+        """
+        added: List[str] = []
+        with self.__operation("add targets"):
+            for username in dict.fromkeys(u.lower() for u in usernames):
+                row = self.connection.execute("SELECT status FROM targets WHERE username = ?", (username,)).fetchone()
+                if row is not None and row[0] in (self.PENDING, self.ACTIVE):
+                    continue
+                status, error = self.__initial_status(username)
+                self.connection.execute(
+                    """
+                    INSERT INTO targets (username, status, error, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (username) DO UPDATE SET status = excluded.status, error = excluded.error,
+                        updated_at = excluded.updated_at
+                    """,
+                    (username, status, error, self.clock.time()),
+                )
+                if status == self.PENDING:
+                    added.append(username)
+        return added
+
+    def remove(self, usernames: Iterable[str]) -> List[str]:
+        """
+        対象ユーザから外し、外したユーザ名を返す
+        """
+        removed: List[str] = []
+        with self.__operation("remove targets"):
+            for username in dict.fromkeys(u.lower() for u in usernames):
+                cursor = self.connection.execute(
+                    "UPDATE targets SET status = ?, updated_at = ? WHERE username = ? AND status != ?",
+                    (self.REMOVED, self.clock.time(), username, self.REMOVED),
+                )
+                if cursor.rowcount:
+                    removed.append(username)
+        return removed
+
+    def unresolved(self) -> List[str]:
+        """
+        ユーザIDを解決する必要があるユーザ名(pendingと、隔離してからquarantine_interval秒経ったもの)を返す
+        ユーザ名として正しくないために隔離したものは含めない
+        """
+        with self.__operation("get unresolved targets"):
+            rows = self.connection.execute(
+                """
+                SELECT username FROM targets
+                WHERE status = ? OR (status = ? AND updated_at <= ? AND error IS NOT ?) ORDER BY rowid
+                """,
+                (self.PENDING, self.QUARANTINED, self.clock.time() - self.quarantine_interval, self.INVALID),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def resolve(self, lookup: Lookup) -> Tuple[List[str], List[str]]:
+        """
+        未解決のユーザ名だけを最大100件ずつまとめてユーザIDに解決し、(解決したユーザ名, 隔離したユーザ名)を返す
+        lookupが失敗した(TwitterRequestError)バッチのユーザ名は未解決のまま残し、次に解決する時にリトライする
+        """
+        resolved: List[str] = []
+        quarantined: List[str] = []
+        usernames = self.unresolved()
+        for i in range(0, len(usernames), Twitter.USERS_LOOKUP_LIMIT):
+            batch = usernames[i : i + Twitter.USERS_LOOKUP_LIMIT]
+            try:
+                users, missing = lookup(batch)
+            except TwitterRequestError:
+                logger.exception(f"Failed to resolve target users `{batch}`. Retry them later.")
+                continue
+            now = self.clock.time()
+            with self.__operation("resolve targets"):
+                self.connection.executemany(
+                    "UPDATE targets SET user_id = ?, status = ?, error = NULL, updated_at = ? WHERE username = ?",
+                    [(int(u.id), self.ACTIVE, now, str(u.username).lower()) for u in users],
+                )
+                self.connection.executemany(
+                    "UPDATE targets SET status = ?, error = ?, updated_at = ? WHERE username = ?",
+                    [(self.QUARANTINED, "not found or suspended", now, u.lower()) for u in missing],
+                )
+            if missing:
+                logger.warning(f"Quarantine target users that were not found: `{missing}`")
+            resolved += [str(u.username).lower() for u in users]
+            quarantined += [u.lower() for u in missing]
+        return resolved, quarantined
+
+    def active_ids(self) -> List[int]:
+        """
+        following取得の対象になるユーザIDを、登録した順に返す
+        """
+        with self.__operation("get active targets"):
+            rows = self.connection.execute(
+                "SELECT user_id FROM targets WHERE status = ? ORDER BY rowid", (self.ACTIVE,)
+            ).fetchall()
+        return list(dict.fromkeys(int(r[0]) for r in rows))
+
+    def entries(self) -> List[Target]:
+        """
+        削除済みでない対象ユーザを、登録した順に返す
+        """
+        with self.__operation("get targets"):
+            rows = self.connection.execute(
+                "SELECT username, user_id, status, error FROM targets WHERE status != ? ORDER BY rowid",
+                (self.REMOVED,),
+            ).fetchall()
+        return [Target(r[0], None if r[1] is None else int(r[1]), r[2], r[3]) for r in rows]
+
+    def __initial_status(self, username: str) -> Tuple[str, Optional[str]]:
+        if USERNAME_PATTERN.match(username):
+            return self.PENDING, None
+        logger.warning(f"Quarantine target user `{username}` whose name is invalid")
+        return self.QUARANTINED, self.INVALID
+
+    @contextmanager
+    def __operation(self, description: str) -> Iterator[None]:
+        """
+        withブロック内の処理を1つのトランザクションにまとめ、SQLiteのエラーはDbOperationErrorにする
+        """
+        with self.__lock:
+            try:
+                self.connection.execute("BEGIN")
+                try:
+                    yield
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                logger.exception(f"Failed to {description} on target database")
+                raise DbOperationError
@@ -0,0 +1,24 @@
+import pytest
+from pytest_mock import MockerFixture
+
+from influ_rader.db import Db
+from influ_rader.tests.fakes import FakeFirestoreClient
+
+
+@pytest.fixture
+def firestore_client():
+    return FakeFirestoreClient()
+
+
+@pytest.fixture
+def db(mocker: MockerFixture, firestore_client: FakeFirestoreClient):
+    """
+    Firestoreの代わりにFakeFirestoreClientを使うDb
+    """
+    mocker.patch.object(Db, "_Db__parse_credential_string")
+    mocker.patch.object(Db, "_Db__initialize_credential")
+    mocker.patch.object(Db, "_Db__initialize_firebase_app")
+    mocker.patch.object(Db, "_Db__initialize_firestore")
+    db = Db(credential="test")
+    db.client = firestore_client
+    return db
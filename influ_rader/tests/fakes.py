@@ -0,0 +1,247 @@
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import requests
+from google.cloud.firestore_v1.transforms import DELETE_FIELD
+from tweepy import Response, TooManyRequests
+
+from influ_rader.rate_limit import Clock
+
+
+class FakeClock(Clock):
+    """
+    sleepすると実際には待たずに時刻だけを進める時計
+    """
+
+    def __init__(self, now: float = 0.0) -> None:
+        self.now = now
+        self.sleeps: List[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds: float) -> None:
+        self.sleep(seconds)
+
+
+class FakeTwitterClient:
+    """
+    Twitter APIのレート制限(15分ごとのウィンドウ)を再現するtweepy.Clientの代わり
+    followings: ユーザIDごとのfollowingのユーザIDのリスト
+    """
+
+    WINDOW = 15 * 60
+
+    def __init__(self, clock: FakeClock, followings: Dict[int, List[int]], limits: Dict[str, int]) -> None:
+        self.clock = clock
+        self.followings = followings
+        self.limits = limits
+        self.requests: List[str] = []
+        self.rejected = 0
+        self.last_response_headers: Optional[Dict[str, str]] = None
+        # このページ(開始位置)を要求されたら一度だけエラーを返す
+        self.fail_pages: List[int] = []
+        # このユーザのfollowingを要求されたら一度だけエラーを返す
+        self.fail_users: List[int] = []
+        self.__windows: Dict[str, List[float]] = {}
+        self.__lock = threading.Lock()
+
+    def __call(self, endpoint: str) -> None:
+        with self.__lock:
+            self.__check(endpoint)
+
+    def __check(self, endpoint: str) -> None:
+        now = self.clock.time()
+        start, used = self.__windows.get(endpoint, [now, 0])
+        if now >= start + self.WINDOW:
+            start, used = now, 0
+        headers = {
+            "x-rate-limit-limit": str(self.limits[endpoint]),
+            "x-rate-limit-reset": str(int(start + self.WINDOW)),
+        }
+        if used >= self.limits[endpoint]:
+            self.rejected += 1
+            res = requests.Response()
+            res.status_code = 429
+            res.headers.update({**headers, "x-rate-limit-remaining": "0"})
+            raise TooManyRequests(res)
+        used += 1
+        self.__windows[endpoint] = [start, used]
+        self.requests.append(endpoint)
+        self.last_response_headers = {**headers, "x-rate-limit-remaining": str(self.limits[endpoint] - used)}
+
+    def get_users(
+        self,
+        ids: Optional[List[int]] = None,
+        usernames: Optional[List[str]] = None,
+        user_fields: Optional[List[str]] = None,
+    ) -> Response:
+        """
+        ユーザIDがiのユーザのユーザ名はuser{i}とする
+        user_fieldsにpublic_metricsを指定すると、followingsの件数をフォロー数、ユーザIDをフォロワー数として返す
+        user_fieldsにdescription/created_at/verifiedを指定すると、ユーザIDから作った値を返す
+        """
+        self.__call("get_users")
+        user_ids = ids if ids is not None else [int(u[len("user") :]) for u in usernames or []]
+        data: List[Dict[str, Any]] = [{"id": i, "name": f"user{i}", "username": f"user{i}"} for i in user_ids]
+        if user_fields and "public_metrics" in user_fields:
+            for d in data:
+                d["public_metrics"] = {
+                    "following_count": len(self.followings.get(d["id"], [])),
+                    "followers_count": d["id"],
+                }
+        for d in data:
+            if "description" in (user_fields or []):
+                d["description"] = f"bio of user{d['id']}"
+            if "created_at" in (user_fields or []):
+                d["created_at"] = "2020-01-02T03:04:05.000Z"
+            if "verified" in (user_fields or []):
+                d["verified"] = d["id"] % 2 == 0
+        return Response(data=data, includes={}, errors=[], meta={})
+
+    def get_users_following(self, id: int, max_results: int, pagination_token: Optional[str] = None) -> Response:
+        self.__call("get_users_following")
+        start = int(pagination_token or 0)
+        if start in self.fail_pages or id in self.fail_users:
+            if start in self.fail_pages:
+                self.fail_pages.remove(start)
+            else:
+                self.fail_users.remove(id)
+            return Response(data=None, includes={}, errors=[{"title": "Service Unavailable"}], meta={})
+        ids = self.followings[id][start : start + max_results]
+        meta: Dict[str, Any] = {"result_count": len(ids)}
+        if start + max_results < len(self.followings[id]):
+            meta["next_token"] = str(start + max_results)
+        data = [{"id": i, "name": f"user{i}", "username": f"user{i}"} for i in ids]
+        return Response(data=data, includes={}, errors=[], meta=meta)
+
+
+class FakeClientFactory:
+    """
+    Bearer TokenごとにFakeTwitterClientを作る、pickleできるクライアントの作成関数(ワーカプロセスに渡して使う)
+    log_pathを指定すると、クライアントを作るたびに`{プロセスID} {Bearer Token}`の行を追記する
+    fail_usersのユーザのfollowingを要求されたら、作ったクライアントはそれぞれ一度だけエラーを返す
+    """
+
+    def __init__(
+        self,
+        followings: Dict[int, List[int]],
+        limits: Dict[str, int],
+        log_path: Optional[str] = None,
+        fail_users: Sequence[int] = (),
+    ) -> None:
+        self.followings = followings
+        self.limits = limits
+        self.log_path = log_path
+        self.fail_users = list(fail_users)
+
+    def __call__(self, bearer_token: str) -> FakeTwitterClient:
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(f"{os.getpid()} {bearer_token}\n")
+        client = FakeTwitterClient(FakeClock(), self.followings, self.limits)
+        client.fail_users.extend(self.fail_users)
+        return client
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: Optional[Dict[str, Any]]) -> None:
+        self.id = doc_id
+        self.exists = data is not None
+        self.__data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self.__data) if self.__data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestoreClient", collection: str, doc_id: str) -> None:
+        self.client = client
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self) -> FakeSnapshot:
+        self.client.rpcs.append("get")
+        return self.client.snapshot(self)
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> Dict[str, Any]:
+        self.client.rpcs.append("set")
+        self.client.write(self, data, merge)
+        return {"update_time": self.client.rpcs}
+
+    def update(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        self.client.rpcs.append("update")
+        self.client.write(self, data, merge=True)
+        return {"update_time": self.client.rpcs}
+
+    def delete(self) -> None:
+        self.client.rpcs.append("delete")
+        self.client.documents.get(self.collection, {}).pop(self.id, None)
+
+
+class FakeCollectionReference:
+    def __init__(self, client: "FakeFirestoreClient", name: str) -> None:
+        self.client = client
+        self.name = name
+
+    def document(self, doc_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self.client, self.name, doc_id)
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestoreClient") -> None:
+        self.client = client
+        self.writes: List[Any] = []
+
+    def set(self, ref: FakeDocumentReference, data: Dict[str, Any], merge: bool = False) -> None:
+        self.writes.append((ref, data, merge))
+
+    def delete(self, ref: FakeDocumentReference) -> None:
+        self.writes.append((ref, None, False))
+
+    def commit(self) -> None:
+        self.client.rpcs.append("commit")
+        for ref, data, merge in self.writes:
+            if data is None:
+                self.client.documents.get(ref.collection, {}).pop(ref.id, None)
+            else:
+                self.client.write(ref, data, merge)
+
+
+class FakeFirestoreClient:
+    """
+    Firestoreのクライアントの代わりにメモリ上にドキュメントを保持する
+    rpcs: Firestoreへのリクエスト(RPC)の履歴
+    """
+
+    def __init__(self, documents: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None) -> None:
+        self.documents: Dict[str, Dict[str, Dict[str, Any]]] = documents or {}
+        self.rpcs: List[str] = []
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def get_all(self, refs: List[FakeDocumentReference]) -> List[FakeSnapshot]:
+        self.rpcs.append("get_all")
+        return [self.snapshot(ref) for ref in refs]
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def snapshot(self, ref: FakeDocumentReference) -> FakeSnapshot:
+        return FakeSnapshot(ref.id, self.documents.get(ref.collection, {}).get(ref.id))
+
+    def write(self, ref: FakeDocumentReference, data: Dict[str, Any], merge: bool) -> None:
+        collection = self.documents.setdefault(ref.collection, {})
+        doc = dict(collection.get(ref.id, {})) if merge else {}
+        for k, v in data.items():
+            if v is DELETE_FIELD:
+                doc.pop(k, None)
+            else:
+                doc[k] = v
+        collection[ref.id] = doc
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+from array import array
+
+from pytest_mock import MockerFixture
+
+from influ_rader.aio import AsyncTwitter, BoundedExecutor
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+
+class BlockingClock(FakeClock):
+    """
+    レート制限の待機を、実際にスレッドをブロックする短い待機で再現する時計
+    """
+
+    def sleep(self, seconds: float) -> None:
+        super().sleep(seconds)
+        time.sleep(0.3)
+
+
+def test_event_loop_is_responsive_during_rate_limit_wait(mocker: MockerFixture) -> None:
+    """
+    followingの取得中にレート制限で待機している間も、イベントループが他の処理を実行し続けられること
+    """
+    clock = BlockingClock()
+    followings = {i: list(range(i * 10000, i * 10000 + 2000)) for i in range(1, 5)}
+    client = FakeTwitterClient(clock, followings, {"get_users_following": 4})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
+    async_twitter = AsyncTwitter(twitter, BoundedExecutor(max_workers=2))
+
+    async def heartbeat(done: asyncio.Event) -> int:
+        beats = 0
+        while not done.is_set():
+            beats += 1
+            await asyncio.sleep(0.01)
+        return beats
+
+    async def run() -> tuple[dict[int, "array[int]"], int]:
+        done = asyncio.Event()
+        beat = asyncio.create_task(heartbeat(done))
+        result = await async_twitter.get_users_id_following(list(followings))
+        done.set()
+        return result, await beat
+
+    result, beats = asyncio.run(run())
+    assert {k: v.tolist() for k, v in result.items()} == followings
+    assert len(clock.sleeps) >= 1
+    assert client.rejected == 0
+    assert beats >= 10  # 0.3秒以上の待機中も0.01秒ごとの処理が動き続けている
+
+
+def test_bounded_executor_limits_concurrency() -> None:
+    """
+    BoundedExecutorで同時に実行される処理の数がmax_workers以下に制限されること
+    """
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def task() -> None:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    async def run() -> None:
+        executor = BoundedExecutor(max_workers=3)
+        await asyncio.gather(*[executor.run(task) for _ in range(10)])
+
+    asyncio.run(run())
+    assert peak == 3
@@ -0,0 +1,63 @@
+import copy
+from typing import Any, Dict
+
+from benchmarks import bench_pipeline
+
+
+def test_pipeline_benchmark_reports_each_stage() -> None:
+    """
+    全てのフェーズについて、リクエスト数・DB操作数・レート制限の待ち時間を記録すること
+    """
+    fixture = bench_pipeline.make_fixture(targets=3, followings=2500)
+
+    stages = bench_pipeline.run(fixture, concurrency=2)
+
+    assert list(stages) == [
+        "startup",
+        "resolve",
+        "schedule",
+        "precheck",
+        "crawl",
+        "diff",
+        "save",
+        "reschedule",
+        "notify",
+        "send",
+    ]
+    assert stages["startup"]["api_requests"] == 0  # 対象ユーザのユーザIDは起動時ではなくループの中で解決する
+    assert stages["resolve"]["api_requests"] == 1
+    assert stages["crawl"]["api_requests"] == 3 * 3
+    assert stages["diff"]["db_ops"] == 1  # get_allの1回
+    assert stages["save"]["db_ops"] == 1  # commitの1回
+    assert stages["notify"]["api_requests"] == 1
+    assert all(s["wall_ms"] >= 0 and s["peak_kib"] >= 0 for s in stages.values())
+
+
+def test_recorded_fixture_round_trips(tmp_path) -> None:
+    """
+    保存したフィクスチャを読み込むと同じフィクスチャになること
+    """
+    fixture = bench_pipeline.make_fixture(targets=2, followings=100)
+    path = str(tmp_path / "fixture.json")
+
+    bench_pipeline.save_fixture(path, fixture)
+
+    assert bench_pipeline.load_fixture(path) == fixture
+
+
+def test_compare_detects_regressions() -> None:
+    """
+    リクエスト数・DB操作数は1つでも増えたら、実時間・ピークメモリは許容範囲を超えたら回帰とすること
+    """
+    stage = {"wall_ms": 100.0, "peak_kib": 1024.0, "api_requests": 10, "db_ops": 1, "rate_limit_wait_s": 0.0}
+    baseline: Dict[str, Any] = {"config": {"targets": 1}, "stages": {"crawl": stage}}
+    result = copy.deepcopy(baseline)
+    result["stages"]["crawl"].update(wall_ms=190.0, peak_kib=2000.0)
+    assert bench_pipeline.compare(result, baseline, tolerance=1.0) == []
+
+    result["stages"]["crawl"].update(wall_ms=250.0, db_ops=2)
+    assert bench_pipeline.compare(result, baseline, tolerance=1.0) == [
+        "crawl: db_ops 2 > 1",
+        "crawl: wall_ms 250.0 > 200.0",
+    ]
+    assert len(bench_pipeline.compare(result, {**baseline, "config": {"targets": 2}})) == 1
@@ -0,0 +1,93 @@
+from typing import Dict
+
+import pytest
+from pytest_mock import MockerFixture
+
+from influ_rader.cache import UserCache
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+
+def user_data(user_id: int) -> Dict[str, str]:
+    return {"id": str(user_id), "name": f"user{user_id}", "username": f"User{user_id}"}
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_get_by_id_and_username(clock: FakeClock) -> None:
+    """
+    ユーザID/ユーザ名(大文字小文字を区別しない)のどちらでもユーザ情報を取得でき、ヒット数/ミス数を数えること
+    """
+    cache = UserCache(clock=clock)
+    cache.put(user_data(1))
+
+    assert cache.get(1) == user_data(1)
+    assert cache.get("user1") == user_data(1)
+    assert cache.get(2) is None
+    assert cache.get("user2") is None
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 2}
+
+
+def test_lru_eviction(clock: FakeClock) -> None:
+    """
+    エントリ数が上限を超えた場合、最も使われていないエントリから削除すること
+    """
+    cache = UserCache(max_size=2, clock=clock)
+    cache.put(user_data(1))
+    cache.put(user_data(2))
+    cache.get(1)
+    cache.put(user_data(3))
+
+    assert cache.get(2) is None
+    assert cache.get("user2") is None
+    assert cache.get(1) is not None
+    assert cache.get(3) is not None
+
+
+def test_ttl_expiration(clock: FakeClock) -> None:
+    """
+    有効期限が切れたエントリは取得できないこと
+    """
+    cache = UserCache(ttl=60, clock=clock)
+    cache.put(user_data(1))
+    clock.sleep(59)
+    assert cache.get(1) is not None
+    clock.sleep(1)
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_persistence(tmp_path, clock: FakeClock) -> None:
+    """
+    ファイルに保存したキャッシュを、再起動後に読み込めること(有効期限が切れたものは除く)
+    """
+    path = str(tmp_path / "user_cache.json")
+    cache = UserCache(ttl=60, path=path, clock=clock)
+    cache.put(user_data(1))
+    clock.sleep(30)
+    cache.put(user_data(2))
+    cache.save()
+
+    clock.sleep(40)
+    reloaded = UserCache(ttl=60, path=path, clock=clock)
+    assert reloaded.get(1) is None
+    assert reloaded.get("user2") == user_data(2)
+
+
+def test_twitter_uses_cache(mocker: MockerFixture, clock: FakeClock) -> None:
+    """
+    キャッシュにあるユーザはTwitter APIにリクエストせずに取得すること
+    """
+    client = FakeTwitterClient(clock, {}, {"get_users": 300})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock), cache=UserCache(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
+
+    assert [u.username for u in twitter.get_users(["user1", "user2"])] == ["user1", "user2"]
+    assert [u.username for u in twitter.get_users_by_ids([2, 1, 3])] == ["user2", "user1", "user3"]
+    assert twitter.get_user("User1").id == 1
+    assert client.requests == ["get_users", "get_users"]
+    assert twitter.cache is not None and twitter.cache.stats() == {"size": 3, "hits": 3, "misses": 3}
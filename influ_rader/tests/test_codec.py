@@ -0,0 +1,38 @@
+import pytest
+
+from influ_rader.codec import available_compressions, decode_ids, encode_ids
+from influ_rader.diff import ids_array
+
+
+@pytest.mark.parametrize("compression", available_compressions())
+def test_encode_and_decode_ids(compression: str) -> None:
+    """
+    エンコードしたユーザIDをそのまま復元でき、10進数の文字列より小さくなること(圧縮した場合は1/3未満)
+    """
+    ids = ids_array([0, 1, 127, 128, 16384, 10**9, 2**62, 2**63 - 1])
+
+    data = encode_ids(ids, compression)
+
+    assert decode_ids(data) == ids
+    assert decode_ids(encode_ids(ids_array(), compression)) == ids_array()
+    many = ids_array(range(10**15, 10**15 + 3000 * 7919, 7919))
+    strings = sum(len(str(i)) for i in many)
+    assert len(encode_ids(many, compression)) < (strings if compression == "none" else strings / 3)
+
+
+def test_encode_and_decode_invalid_ids() -> None:
+    """
+    ソートされていないユーザIDや、壊れたバイト列・未知の形式はValueError例外になること
+    """
+    with pytest.raises(ValueError):
+        encode_ids(ids_array([2, 1]))
+    with pytest.raises(ValueError):
+        encode_ids(ids_array([1]), "lz4")
+
+    data = encode_ids(ids_array([1, 300, 70000]), "none")
+    with pytest.raises(ValueError):
+        decode_ids(data[:-1])
+    with pytest.raises(ValueError):
+        decode_ids(b"\x09" + data[1:])
+    with pytest.raises(ValueError):
+        decode_ids(encode_ids(ids_array(range(0, 30000, 3)), "zlib")[:-2])
@@ -0,0 +1,100 @@
+from typing import Mapping
+
+import pytest
+import requests
+from tweepy import Unauthorized
+
+from influ_rader.credentials import CredentialPool
+from influ_rader.error import TwitterRequestError
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+
+class RevokedClient:
+    """
+    全てのリクエストに401を返すクライアント(失効したBearer Token)
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def get_users(self, **kwargs) -> None:
+        self.calls += 1
+        res = requests.Response()
+        res.status_code = 401
+        raise Unauthorized(res)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=1000.0)
+
+
+def pooled_twitter(clock: FakeClock, clients: Mapping[str, object]) -> Twitter:
+    return Twitter(list(clients), rate_limiter=RateLimiter(clock=clock), client_factory=clients.__getitem__)
+
+
+def test_requests_are_balanced_across_tokens(clock: FakeClock) -> None:
+    """
+    枠が最も残っているBearer Tokenに振り分け、全てのBearer Tokenの枠を合わせた分だけ待たずに取得できること
+    """
+    followings = {1: list(range(30000))}
+    clients = {t: FakeTwitterClient(clock, followings, {"get_users_following": 15}) for t in ("a", "b")}
+    twitter = pooled_twitter(clock, clients)
+
+    assert len(twitter.get_user_id_following(1)) == 30000
+    assert clock.sleeps == []
+    assert [len(c.requests) for c in clients.values()] == [15, 15]
+
+    # 全てのBearer Tokenの枠を使い切ったら、最も早くリセットされるまで待つ
+    followings[2] = list(range(1000))
+    twitter.get_user_id_following(2)
+    assert clock.sleeps == [15 * 60]
+    assert sum(c.rejected for c in clients.values()) == 0
+    assert twitter.pool.stats() == {
+        "token1": {"ok": 16, "disabled": 0},
+        "token2": {"ok": 15, "disabled": 0},
+    }
+
+
+def test_rate_limited_token_is_skipped_until_reset(clock: FakeClock) -> None:
+    """
+    429が返されたBearer Tokenは、リセットされるまで使わずに他のBearer Tokenでリトライすること
+    """
+    clients = {
+        "a": FakeTwitterClient(clock, {}, {"get_users": 0}),
+        "b": FakeTwitterClient(clock, {}, {"get_users": 300}),
+    }
+    twitter = pooled_twitter(clock, clients)
+
+    for i in range(3):
+        assert [u.id for u in twitter.get_users_by_ids([i])] == [i]
+
+    assert clients["a"].rejected == 1
+    assert len(clients["b"].requests) == 3
+    assert clock.sleeps == []
+    assert twitter.pool.stats()["token1"] == {"rate_limited": 1, "disabled": 0}
+
+
+def test_revoked_token_is_rechecked_later(clock: FakeClock) -> None:
+    """
+    401が返されたBearer Tokenはローテーションから外し、一定時間後に確認し直すこと
+    全てのBearer Tokenが失効している場合はTwitterRequestError例外が発生すること
+    """
+    revoked = RevokedClient()
+    clients = {"a": revoked, "b": FakeTwitterClient(clock, {}, {"get_users": 300})}
+    twitter = pooled_twitter(clock, clients)
+
+    twitter.get_users_by_ids([1])
+    twitter.get_users_by_ids([2])
+    assert revoked.calls == 1
+    assert twitter.pool.stats()["token1"] == {"unauthorized": 1, "disabled": 1}
+
+    clock.sleep(CredentialPool.REVOKED_INTERVAL)
+    twitter.get_users_by_ids([3])
+    assert revoked.calls == 2
+
+    only_revoked = pooled_twitter(clock, {"a": RevokedClient()})
+    with pytest.raises(TwitterRequestError):
+        only_revoked.get_users_by_ids([1])
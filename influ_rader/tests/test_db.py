@@ -0,0 +1,198 @@
+from typing import List
+
+import pytest
+
+from influ_rader.db import Db, WriteBatch
+from influ_rader.error import DbInitializeError, DbOperationError
+from influ_rader.tests.fakes import FakeFirestoreClient, FakeWriteBatch
+
+
+def test_get_many_with_one_request(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    複数のドキュメントを1回のリクエストで取得し、存在しないドキュメントは結果に含めないこと
+    """
+    firestore_client.documents = {"influencers": {"1": {"followings": ["10"]}, "2": {"followings": ["20"]}}}
+
+    assert db.get_many(["1", "2", "3"]) == {"1": {"followings": ["10"]}, "2": {"followings": ["20"]}}
+    assert firestore_client.rpcs == ["get_all"]
+
+
+def test_get_many_with_no_ids(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    ドキュメントIDが空の場合、リクエストせずに空の結果を返すこと
+    """
+    assert db.get_many([]) == {}
+    assert firestore_client.rpcs == []
+
+
+def test_batch_commits_all_writes_at_once(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    複数ドキュメントへの更新/削除を1回のコミットで反映し、ドキュメントがなければ作成すること
+    """
+    firestore_client.documents = {"influencers": {"1": {"followings": ["10", "11"]}, "3": {"followings": ["30"]}}}
+
+    batch = db.batch()
+    batch.set("1", {"count": 2})
+    batch.set("2", {"followings": ["20"]})
+    batch.delete("3")
+    batch.commit()
+
+    assert firestore_client.documents["influencers"] == {
+        "1": {"followings": ["10", "11"], "count": 2},
+        "2": {"followings": ["20"]},
+    }
+    assert firestore_client.rpcs == ["commit"]
+
+
+def test_batch_splits_commits_over_limit(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    書き込み数がバッチの上限を超える場合、上限ごとに分けてコミットすること
+    """
+    batch = db.batch()
+    for i in range(WriteBatch.MAX_WRITES + 1):
+        batch.set(str(i), {"followings": ["1"]})
+    batch.commit()
+
+    assert len(firestore_client.documents["influencers"]) == WriteBatch.MAX_WRITES + 1
+    assert firestore_client.rpcs == ["commit", "commit"]
+
+
+def test_batch_splits_commits_over_byte_limit(mocker, db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    書き込みのバイト数がコミットの上限を超える場合、グループの区切りで分けてコミットすること
+    """
+    mocker.patch.object(WriteBatch, "MAX_BYTES", 1000)
+
+    batch = db.batch()
+    for i in range(5):
+        batch.set(str(i), {"snapshot": b"x" * 400})
+        batch.end_group()
+    batch.commit()
+
+    assert len(firestore_client.documents["influencers"]) == 5
+    assert firestore_client.rpcs == ["commit", "commit", "commit"]
+
+
+def test_large_snapshots_are_saved_in_multiple_commits(mocker, db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    スナップショットの合計がコミットの上限を超える場合は対象ユーザの区切りでコミットを分け、
+    1人の対象ユーザの分割は同じコミットで書き込むこと
+    """
+    mocker.patch.object(WriteBatch, "MAX_BYTES", 500)
+    batches: List[FakeWriteBatch] = []
+
+    def batch() -> FakeWriteBatch:
+        batches.append(FakeWriteBatch(firestore_client))
+        return batches[-1]
+
+    mocker.patch.object(firestore_client, "batch", side_effect=batch)
+    db.chunk_size = 16
+    followings = {u: [10**15 + u * 10**6 + i * 7919 for i in range(40)] for u in (1, 2, 3)}
+
+    db.save_users_followings(*db.diff_users_followings(followings))
+
+    assert firestore_client.rpcs == ["get_all", "commit", "commit", "commit"]
+    assert [{ref.id.split("_")[0] for ref, _, _ in b.writes} for b in batches] == [{"1"}, {"2"}, {"3"}]
+    influencers = firestore_client.documents["influencers"]
+    assert [len(b.writes) for b in batches] == [influencers[str(u)]["snapshot_chunks"] for u in (1, 2, 3)]
+    assert db.get_users_followings([1, 2, 3]) == followings
+
+
+def test_batch_with_commit_error(mocker, db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    コミットに失敗した場合、DbOperationError例外が発生すること
+    """
+    mocker.patch.object(firestore_client, "batch", side_effect=Exception)
+
+    batch = db.batch()
+    batch.set("1", {"followings": ["1"]})
+    with pytest.raises(DbOperationError):
+        batch.commit()
+
+
+def test_update_and_delete(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    ドキュメントを更新/削除できること
+    """
+    firestore_client.documents = {"influencers": {"1": {"followings": ["10"]}}}
+
+    db.update("1", {"name": "usera"})
+    assert db.get("1") == {"followings": ["10"], "name": "usera"}
+    db.delete("1")
+    assert db.get("1") is None
+
+
+def test_diff_and_save_users_followings(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    保存されているfollowingsとの差分を取り、差分だけを1回のコミットで保存すること
+    2回目以降は保存済みのスナップショットと比較するので、DBから読み込まないこと
+    """
+    firestore_client.documents = {"influencers": {"1": {"followings": ["10", "11"]}, "2": {"followings": ["20"]}}}
+
+    added, removed = db.diff_users_followings({1: [12, 11], 3: [30]})
+    assert added == {1: [12], 3: [30]}
+    assert removed == {1: [10]}
+
+    db.save_users_followings(added, removed)
+    assert db.get_users_followings([1, 2, 3]) == {1: [11, 12], 2: [20], 3: [30]}
+    assert "added_at" in firestore_client.documents["influencers"]["1"]
+    assert firestore_client.rpcs == ["get_all", "commit", "get_all"]
+
+    added, removed = db.diff_users_followings({1: [11, 12, 13], 3: []})
+    assert added == {1: [13], 3: []}
+    assert removed == {3: [30]}
+    assert firestore_client.rpcs == ["get_all", "commit", "get_all"]
+
+
+def test_snapshots_are_stored_compactly_in_chunks(db: Db, firestore_client: FakeFirestoreClient) -> None:
+    """
+    スナップショットをバイト列で保存し、chunk_sizeを超えたら分割して同じコミットで書き込むこと
+    以前の形式(文字列の配列)のドキュメントは、差分を保存する時に新しい形式に移すこと
+    分割数が減ったら不要になった分割を消すこと
+    """
+    firestore_client.documents = {"influencers": {"1": {"followings": ["10", "11"]}, "2": {"followings": ["20"]}}}
+    db.chunk_size = 16
+    followings = [10**15 + i * 7919 for i in range(40)]
+
+    db.save_users_followings(*db.diff_users_followings({1: followings, 2: [20]}))
+
+    influencers = firestore_client.documents["influencers"]
+    assert "followings" not in influencers["1"] and isinstance(influencers["1"]["snapshot"], bytes)
+    assert influencers["2"] == {"followings": ["20"]}  # 差分がなければ以前の形式のまま
+    chunks = influencers["1"]["snapshot_chunks"]
+    assert chunks > 1
+    assert set(firestore_client.documents["influencer_snapshot_chunks"]) == {f"1_{i}" for i in range(1, chunks)}
+    assert firestore_client.rpcs == ["get_all", "commit"]
+
+    firestore_client.rpcs.clear()
+    assert db.get_users_followings([1, 2]) == {1: followings, 2: [20]}
+    assert firestore_client.rpcs == ["get_all", "get_all"]  # 分割は全ての対象ユーザの分を1回で取得する
+
+    db.save_users_followings({}, {1: followings[1:]})
+    assert influencers["1"]["snapshot_chunks"] == 1
+    assert firestore_client.documents["influencer_snapshot_chunks"] == {}
+    assert db.get_users_followings([1]) == {1: followings[:1]}
+
+    influencers["3"] = {"snapshot": b"broken"}
+    with pytest.raises(DbOperationError):
+        db.get_users_followings([3])
+
+
+def test_firestore_is_initialized_on_first_use(mocker, firestore_client: FakeFirestoreClient) -> None:
+    """
+    作成時には認証情報の形式だけを確認し、Firestoreのクライアントは最初に使う時に1回だけ初期化すること
+    """
+    initialize_app = mocker.patch.object(Db, "_Db__initialize_firebase_app")
+    mocker.patch.object(Db, "_Db__initialize_credential")
+    initialize_firestore = mocker.patch.object(Db, "_Db__initialize_firestore", return_value=firestore_client)
+
+    db = Db(credential='{"type": "service_account"}')
+    assert not initialize_app.called and not initialize_firestore.called
+
+    db.warm_up()
+    db.get_many(["1"])
+
+    assert initialize_app.call_count == 1 and initialize_firestore.call_count == 1
+    assert firestore_client.rpcs == ["get_all"]
+    with pytest.raises(DbInitializeError):
+        Db(credential="not json")
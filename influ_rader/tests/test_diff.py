@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from influ_rader.diff import Snapshot, diff_sorted, ids_array, merge_sorted
+
+
+@pytest.mark.parametrize("size, changes", [(0, 0), (10, 3), (1000, 0), (1000, 10), (10000, 500)])
+def test_diff_sorted_matches_set_difference(size: int, changes: int) -> None:
+    """
+    ソート済みの配列のマージによる差分が、setの差集合と一致すること
+    """
+    rng = random.Random(size + changes)
+    old = set(rng.sample(range(1, 10**12), size))
+    new = set(rng.sample(sorted(old), size - changes)) | set(rng.sample(range(1, 10**12), changes))
+
+    added, removed = diff_sorted(ids_array(sorted(old)), ids_array(sorted(new)))
+    assert list(added) == sorted(new - old)
+    assert list(removed) == sorted(old - new)
+
+
+def test_diff_sorted_with_empty_arrays() -> None:
+    """
+    どちらかが空の場合、もう一方の全要素を差分として返すこと
+    """
+    assert diff_sorted(ids_array(), ids_array([1, 2])) == (ids_array([1, 2]), ids_array())
+    assert diff_sorted(ids_array([1, 2]), ids_array()) == (ids_array(), ids_array([1, 2]))
+
+
+def test_merge_sorted() -> None:
+    """
+    ソート済みの2つの配列を、重複なくソートされた1つの配列にマージすること
+    """
+    assert list(merge_sorted(ids_array([1, 3, 5, 7]), ids_array([2, 3, 8]))) == [1, 2, 3, 5, 7, 8]
+    assert list(merge_sorted(ids_array([1, 2]), ids_array())) == [1, 2]
+
+
+def test_snapshot_apply_and_contains() -> None:
+    """
+    スナップショットに差分を反映すると、新しいfollowingsのスナップショットと一致すること
+    """
+    old = Snapshot.from_ids([30, 10, 20, 10])
+    new = Snapshot.from_ids([40, 20, 5])
+    added, removed = old.diff(new)
+
+    assert list(old) == [10, 20, 30]
+    assert old.apply(added, removed) == new
+    assert 20 in new and 30 not in new
+    assert len(new) == 3
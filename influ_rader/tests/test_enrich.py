@@ -0,0 +1,101 @@
+import asyncio
+from typing import List, Sequence, Tuple
+
+import pytest
+from pytest_mock import MockerFixture
+
+from influ_rader.enrich import Enricher
+from influ_rader.error import TwitterRequestError
+from influ_rader.notify import Diff, Trend
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter, User
+
+Published = List[Tuple[Sequence[Diff], Sequence[Trend]]]
+
+
+def user(i: int) -> User:
+    return User({"id": i, "name": f"user{i}", "username": f"user{i}"})
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=1000.0)
+
+
+@pytest.fixture
+def client(clock: FakeClock):
+    return FakeTwitterClient(clock, {}, {"get_users": 300})
+
+
+@pytest.fixture
+def twitter(clock: FakeClock, client: FakeTwitterClient):
+    return Twitter("test", rate_limiter=RateLimiter(clock=clock), client_factory=lambda _: client)
+
+
+def submit(enricher: Enricher, diffs: List[Diff], trends: Sequence[Trend] = ()) -> Tuple[Published, Published]:
+    """
+    submitした直後に通知されたものと、詳細の取得を待ってから通知されたものを返す
+    """
+    published: Published = []
+
+    async def run() -> Published:
+        enricher.submit(diffs, trends, lambda d, t: published.append((d, t)))
+        before = list(published)
+        await enricher.join()
+        return before
+
+    return asyncio.run(run()), published
+
+
+def test_details_are_attached_after_submit_returns(twitter: Twitter) -> None:
+    """
+    submitは詳細の取得を待たずに戻り、取得した詳細を添えてから通知すること
+    """
+    enricher = Enricher(twitter, ["description", "public_metrics", "verified"])
+
+    before, published = submit(enricher, [Diff(user(1), [user(10), user(11)])], [Trend(user(12), [user(1)])])
+
+    assert before == []
+    [(diffs, trends)] = published
+    assert diffs[0].profiles == {
+        i: {
+            "description": f"bio of user{i}",
+            "public_metrics": {"following_count": 0, "followers_count": i},
+            "verified": i % 2 == 0,
+        }
+        for i in (10, 11)
+    }
+    assert trends[0].profile is not None and trends[0].profile["description"] == "bio of user12"
+
+
+def test_details_are_cached_and_fetched_within_budget(
+    twitter: Twitter, client: FakeTwitterClient, clock: FakeClock
+) -> None:
+    """
+    1リクエストあたり100件ずつ取得し、ウィンドウあたりのリクエスト数をbudgetまでに抑えること
+    取得した詳細はキャッシュし、同じユーザは取得し直さないこと
+    """
+    enricher = Enricher(twitter, budget=1, workers=1, clock=clock)
+    followings = [user(i) for i in range(150)]
+
+    submit(enricher, [Diff(user(1), followings)])
+    assert client.requests == ["get_users"] * 2
+    assert clock.sleeps == [RateLimiter.WINDOW]
+
+    _, [(diffs, _)] = submit(enricher, [Diff(user(2), followings[:10])])
+    assert len(client.requests) == 2
+    assert list(diffs[0].profiles) == list(range(10))
+
+
+def test_failed_lookup_is_notified_without_details(mocker: MockerFixture, twitter: Twitter) -> None:
+    """
+    詳細の取得に失敗しても、詳細なしで通知すること
+    """
+    mocker.patch.object(twitter, "get_users_with_fields", side_effect=TwitterRequestError)
+    enricher = Enricher(twitter)
+
+    _, [(diffs, _)] = submit(enricher, [Diff(user(1), [user(10)])])
+
+    assert diffs[0].profiles == {}
+    assert diffs[0].followings == [user(10)]
@@ -0,0 +1,73 @@
+import pytest
+
+from influ_rader.history import FollowEvent, FollowHistory
+from influ_rader.tests.fakes import FakeClock
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=100 * DAY)
+
+
+@pytest.fixture
+def history(clock: FakeClock):
+    return FollowHistory(":memory:", clock=clock)
+
+
+def test_followings_at_replays_events(clock: FakeClock, history: FollowHistory) -> None:
+    """
+    最初に取得したfollowingsを起点に、任意の時点のfollowingsをイベントから復元できること
+    """
+    history.record({1: [10, 11]}, {1: [10, 11]}, {})
+    start = clock.now
+    clock.now += DAY
+    history.record({1: [10, 11, 12]}, {1: [12]}, {})
+    clock.now += DAY
+    history.record({1: [11, 12]}, {1: []}, {1: [10]})
+    clock.now += DAY
+    history.record({1: [10, 11, 12]}, {1: [10]}, {})
+
+    assert history.followings_at(1, start - 1) == []
+    assert history.followings_at(1, start) == [10, 11]
+    assert history.followings_at(1, start + DAY) == [10, 11, 12]
+    assert history.followings_at(1, start + 2 * DAY + 1) == [11, 12]
+    assert history.followings_at(1, clock.now) == [10, 11, 12]
+    assert history.events(1, start) == [
+        FollowEvent(start + DAY, 1, 12, FollowHistory.FOLLOW),
+        FollowEvent(start + 2 * DAY, 1, 10, FollowHistory.UNFOLLOW),
+        FollowEvent(start + 3 * DAY, 1, 10, FollowHistory.FOLLOW),
+    ]
+    assert history.counts() == {FollowHistory.BASELINE: 2, FollowHistory.FOLLOW: 2, FollowHistory.UNFOLLOW: 1}
+
+
+def test_co_followed_counts_distinct_targets_in_window(clock: FakeClock, history: FollowHistory) -> None:
+    """
+    期間内に複数の対象ユーザがフォローしたユーザを、対象ユーザの数が多い順に返し、BASELINEは数えないこと
+    """
+    history.record({1: [50], 2: [50], 3: [50], 4: []}, {}, {})
+    clock.now += DAY
+    history.record(
+        {1: [50, 60, 70], 2: [50, 60, 70], 3: [50, 60], 4: [70]},
+        {1: [60, 70], 2: [60, 70], 3: [60], 4: [70]},
+        {},
+    )
+    clock.now += 10 * DAY
+    history.record({1: [50, 60, 70, 80], 2: [50, 60, 70, 80]}, {1: [80], 2: [80]}, {})
+
+    assert history.co_followed(clock.now - 30 * DAY, min_targets=3) == [(60, 3), (70, 3)]
+    assert history.co_followed(clock.now - 7 * DAY, min_targets=2) == [(80, 2)]
+    assert history.co_followed(clock.now - 30 * DAY, min_targets=2, limit=1) == [(60, 3)]
+
+
+def test_history_survives_restart(tmp_path, clock: FakeClock) -> None:
+    """
+    開き直しても記録済みの対象ユーザにはBASELINEを記録し直さないこと
+    """
+    path = str(tmp_path / "history.sqlite3")
+    FollowHistory(path, clock=clock).record({1: [10]}, {1: [10]}, {})
+
+    FollowHistory(path, clock=clock).record({1: [10, 11]}, {1: [11]}, {})
+
+    assert FollowHistory(path).counts() == {FollowHistory.BASELINE: 1, FollowHistory.FOLLOW: 1}
@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import List
+
+import pytest
+from pytest_mock import MockerFixture
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.history_cog import HistoryCog, parse_time
+from influ_rader.history import FollowHistory
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+DAY = 24 * 60 * 60
+START = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=START)
+
+
+@pytest.fixture
+def twitter(mocker: MockerFixture, clock: FakeClock):
+    twitter_client = FakeTwitterClient(clock, {}, {"get_users": 300, "get_users_following": 15})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", twitter_client)
+    return twitter
+
+
+@pytest.fixture
+def history(clock: FakeClock):
+    history = FollowHistory(":memory:", clock=clock)
+    history.record({1: [10], 2: [10], 3: []}, {}, {})
+    clock.sleep(DAY)
+    history.record({1: [10, 20], 2: [20], 3: [20]}, {1: [20], 2: [20], 3: [20]}, {2: [10]})
+    clock.sleep(DAY)
+    return history
+
+
+@pytest.fixture
+def cog(mocker: MockerFixture, twitter: Twitter, history: FollowHistory):
+    return HistoryCog(mocker.MagicMock(), twitter, history, BoundedExecutor(max_workers=2))
+
+
+def messages(ctx) -> List[str]:
+    return [c.args[0] for c in ctx.send.call_args_list]
+
+
+def test_parse_time() -> None:
+    assert parse_time("2024-01-01") == START + DAY - 1e-6
+    assert parse_time("2024-01-01T09:00:00+09:00") == START
+
+
+def test_co_followed_command(mocker: MockerFixture, cog: HistoryCog) -> None:
+    """
+    複数の対象ユーザがフォローしたアカウントを、フォローした対象ユーザの数と一緒に表示すること
+    """
+    ctx = mocker.AsyncMock()
+
+    asyncio.run(HistoryCog.co_followed.callback(cog, ctx, 7, 3))
+    asyncio.run(HistoryCog.co_followed.callback(cog, ctx, 0.5, 3))
+
+    assert messages(ctx) == [
+        "**直近7日間に3人以上の対象ユーザがフォローしたアカウント**\nhttps://twitter.com/user20 (3人)",
+        "**直近0.5日間に3人以上の対象ユーザがフォローしたアカウント**\nなし",
+    ]
+
+
+def test_followings_and_history_commands(mocker: MockerFixture, cog: HistoryCog) -> None:
+    """
+    過去の時点のfollowingsと、期間内のフォロー/フォロー解除を表示すること
+    """
+    ctx = mocker.AsyncMock()
+
+    asyncio.run(HistoryCog.followings_at.callback(cog, ctx, "user2", "2024-01-01"))
+    asyncio.run(HistoryCog.events.callback(cog, ctx, "user2", 7))
+    asyncio.run(HistoryCog.followings_at.callback(cog, ctx, "user2", "yesterday"))
+
+    assert messages(ctx) == [
+        "**@user2が2024-01-01の時点でフォローしていたアカウント(1件)**\nhttps://twitter.com/user10",
+        "**@user2の直近7日間のフォロー(+)/フォロー解除(-)**\n"
+        "2024-01-02 00:00 + https://twitter.com/user20\n"
+        "2024-01-02 00:00 - https://twitter.com/user10",
+        "日時は`YYYY-MM-DD`または`YYYY-MM-DDTHH:MM:SS+09:00`の形式で指定してください",
+    ]
@@ -0,0 +1,123 @@
+import sqlite3
+
+import pytest
+
+from influ_rader.diff import ids_array
+from influ_rader.jobs import JobQueue, SqliteCheckpoint
+from influ_rader.tests.fakes import FakeClock
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=1000.0)
+
+
+@pytest.fixture
+def jobs(clock: FakeClock):
+    return JobQueue(":memory:", max_attempts=3, backoff=60, clock=clock)
+
+
+def test_run_finishes_when_all_jobs_are_done(jobs: JobQueue) -> None:
+    """
+    全てのジョブが完了したらrunが終わり、次のstart_runで新しいrunが作られること
+    """
+    run_id = jobs.start_run([1, 2])
+    assert jobs.runnable() == [1, 2]
+
+    jobs.start([1, 2])
+    assert jobs.runnable() == []
+    jobs.complete([1])
+    assert jobs.has_open_run()
+    jobs.complete([2])
+    assert not jobs.has_open_run()
+
+    assert jobs.start_run([1, 2]) == run_id + 1
+    assert jobs.runnable() == [1, 2]
+
+
+def test_failed_job_is_retried_with_backoff(clock: FakeClock, jobs: JobQueue) -> None:
+    """
+    失敗したジョブは待ち時間を倍々に延ばしながら再実行され、max_attempts回失敗したら諦めること
+    """
+    jobs.start_run([1, 2])
+    jobs.start([1, 2])
+    jobs.complete([2])
+
+    jobs.fail([1], "error")
+    assert jobs.runnable() == []
+    clock.now += 60
+    assert jobs.runnable() == [1]
+
+    jobs.fail([1], "error")
+    clock.now += 60
+    assert jobs.runnable() == []
+    clock.now += 60
+    assert jobs.runnable() == [1]
+
+    jobs.fail([1], "error")
+    assert jobs.states() == {1: (JobQueue.DEAD, 3), 2: (JobQueue.DONE, 0)}
+    assert not jobs.has_open_run()
+
+
+def test_restart_resumes_unfinished_run(tmp_path, clock: FakeClock) -> None:
+    """
+    終わっていないrunは再起動後に再開され、完了したジョブは再実行しないこと
+    実行中のまま止まったジョブはpendingに戻し、追加された対象ユーザのジョブも加えること
+    """
+    path = str(tmp_path / "jobs.sqlite3")
+    jobs = JobQueue(path, clock=clock)
+    run_id = jobs.start_run([1, 2, 3])
+    jobs.start([1, 2, 3])
+    jobs.complete([1])
+    jobs.fail([2], "error")
+
+    restarted = JobQueue(path, clock=clock)
+    assert restarted.start_run([1, 2, 3, 4]) == run_id
+    assert restarted.runnable() == [3, 4]
+    assert restarted.states()[1] == (JobQueue.DONE, 0)
+
+
+def test_sqlite_checkpoint_persists_pages(tmp_path) -> None:
+    """
+    取得したページと次のページのトークンを保存し、開き直しても続きから再開できること
+    """
+    path = str(tmp_path / "jobs.sqlite3")
+    checkpoint = SqliteCheckpoint(path)
+    assert checkpoint.load(1) is None
+
+    checkpoint.save_page(1, "1000", ids_array(range(1000)))
+    checkpoint.save_page(1, "2000", ids_array(range(1000, 2000)))
+
+    progress = SqliteCheckpoint(path).load(1)
+    assert progress is not None
+    assert progress[0] == "2000"
+    assert progress[1].tolist() == list(range(2000))
+
+    checkpoint.clear(1)
+    assert SqliteCheckpoint(path).load(1) is None
+
+
+def test_sqlite_checkpoint_discards_stale_pages(tmp_path, clock: FakeClock) -> None:
+    """
+    max_age秒より前に保存した途中経過は捨てて、最初から取得し直すこと
+    saved_atを記録していなかった頃のファイルの途中経過も古いものとして捨てること
+    """
+    path = str(tmp_path / "jobs.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE crawl_cursors (user_id INTEGER PRIMARY KEY, next_token TEXT NOT NULL, ids BLOB NOT NULL)"
+    )
+    connection.execute("INSERT INTO crawl_cursors VALUES (?, ?, ?)", (1, "1000", ids_array(range(1000)).tobytes()))
+    connection.commit()
+    connection.close()
+
+    checkpoint = SqliteCheckpoint(path, max_age=900, clock=clock)
+    assert checkpoint.load(1) is None
+
+    checkpoint.save_page(1, "1000", ids_array(range(1000)))
+    clock.now += 900
+    assert checkpoint.load(1) is not None
+    clock.now += 1
+    assert checkpoint.load(1) is None
+    clock.now -= 1
+    assert checkpoint.load(1) is None  # 捨てた途中経過は削除される
@@ -0,0 +1,162 @@
+import asyncio
+import urllib.request
+
+import pytest
+from discord.ext import tasks
+from pytest_mock import MockerFixture
+
+from influ_rader import metrics
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.twitter_cog import TwitterCog
+from influ_rader.db import Db
+from influ_rader.metrics import MetricsServer, Registry, RunProfiler, StartupTimer
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeFirestoreClient, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+
+@pytest.fixture
+def registry():
+    """
+    グローバルなメトリクスを有効にして、テストの前後でリセットする
+    """
+    metrics.REGISTRY.reset()
+    metrics.REGISTRY.enabled = True
+    yield metrics.REGISTRY
+    metrics.REGISTRY.enabled = False
+    metrics.REGISTRY.reset()
+
+
+def test_disabled_registry_records_nothing() -> None:
+    """
+    無効な間は、カウンタもヒストグラムも記録しないこと
+    """
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests.", ["endpoint"])
+    histogram = registry.histogram("latency_seconds", "Latency.")
+
+    counter.inc(endpoint="get_users")
+    with histogram.time():
+        pass
+
+    assert counter.value(endpoint="get_users") == 0
+    assert histogram.count() == 0
+
+
+def test_render_prometheus_text_format() -> None:
+    """
+    Prometheusのテキスト形式で、ヒストグラムは累積のバケットとして出力すること
+    """
+    registry = Registry()
+    registry.enabled = True
+    counter = registry.counter("requests_total", "Requests.", ["endpoint"])
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=[0.1, 1.0])
+    counter.inc(endpoint="get_users")
+    counter.inc(2, endpoint="get_users")
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+
+    assert registry.render() == (
+        "# HELP requests_total Requests.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{endpoint="get_users"} 3\n'
+        "# HELP latency_seconds Latency.\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.1"} 1\n'
+        'latency_seconds_bucket{le="1"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 2\n'
+        "latency_seconds_sum 0.55\n"
+        "latency_seconds_count 2\n"
+    )
+
+
+def test_metrics_server_serves_metrics(registry: Registry) -> None:
+    """
+    `/metrics`でメトリクスを返すこと
+    """
+    metrics.FOLLOWING_PAGES.inc(3)
+    server = MetricsServer(0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as res:
+            body = res.read().decode()
+    finally:
+        server.stop()
+
+    assert "influ_rader_following_pages_total 3\n" in body
+
+
+def test_pipeline_is_instrumented(
+    mocker: MockerFixture, registry: Registry, db: Db, firestore_client: FakeFirestoreClient, tmp_path
+) -> None:
+    """
+    1回の実行で、フェーズごとの時間、エンドポイントごとのリクエスト数、Firestoreへのリクエスト数、
+    レート制限による待機を記録し、プロファイルを保存すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    clock = FakeClock()
+    client = FakeTwitterClient(clock, {1: list(range(2500)), 2: [20]}, {"get_users": 300, "get_users_following": 2})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = mocker.AsyncMock()
+    cog = TwitterCog(
+        bot, twitter, db, ["user1", "user2"], 0, BoundedExecutor(max_workers=1), profiler=RunProfiler(str(tmp_path))
+    )
+
+    asyncio.run(cog.diff_users_followings.coro(cog))
+
+    for phase in ["schedule", "precheck", "crawl", "diff", "save", "reschedule", "notify"]:
+        assert metrics.PHASE_SECONDS.count(phase=phase) == 1
+    assert metrics.TWITTER_REQUESTS.value(endpoint="get_users_following", result="ok") == 4
+    assert metrics.FOLLOWING_PAGES.value() == 4
+    assert metrics.RATE_LIMIT_WAITS.value(endpoint="get_users_following") >= 1
+    assert metrics.DB_RPCS.value(rpc="get_all") == 1
+    assert metrics.DB_RPCS.value(rpc="commit") == 1
+    assert metrics.DB_OPERATION_SECONDS.count(backend="Db", method="save_users_followings") == 1
+    assert metrics.CRAWL_JOBS.value(result="done") == 2
+    assert len(list(tmp_path.glob("diff_users_followings-*.prof"))) == 1
+
+
+def test_startup_timer_reports_phases_until_ready() -> None:
+    """
+    フェーズごとの時間と、準備完了までの時間を記録すること(準備完了の後のフェーズは準備完了までの時間に含めない)
+    """
+    metrics.STARTUP_SECONDS.reset()
+    now = [100.0]
+    timer = StartupTimer(timer=lambda: now[0])
+    with timer.phase("config"):
+        now[0] += 0.5
+    with timer.phase("storage"):
+        now[0] += 1.5
+    now[0] += 3.0
+    timer.ready()
+    with timer.phase("warm_up_storage"):
+        now[0] += 2.0
+
+    assert timer.phases == {"config": 0.5, "storage": 1.5, "connect": 3.0, "warm_up_storage": 2.0}
+    assert timer.report().splitlines()[1:] == [
+        "          config |    0.500 |  10.0%",
+        "         storage |    1.500 |  30.0%",
+        "         connect |    3.000 |  60.0%",
+        " warm_up_storage |    2.000 |  40.0%",
+        "           ready |    5.000 |",
+    ]
+    # メトリクスのサーバを起動していなくても、起動時間はヒストグラムに記録する
+    assert not metrics.REGISTRY.enabled
+    assert metrics.STARTUP_SECONDS.count(phase="storage") == 1
+
+
+def test_startup_timer_reports_imports_from_process_start() -> None:
+    """
+    started_atを指定した場合、その時刻から計測し、importにかかった時間をフェーズとして記録できること
+    """
+    now = [100.0]
+    timer = StartupTimer(timer=lambda: now[0], started_at=97.5)
+    timer.mark("imports")
+    with timer.phase("config"):
+        now[0] += 0.5
+    timer.ready()
+
+    assert timer.phases == {"imports": 2.5, "config": 0.5, "connect": 0.0}
+    assert timer.report().splitlines()[-1] == "           ready |    3.000 |"
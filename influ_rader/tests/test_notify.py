@@ -0,0 +1,303 @@
+import asyncio
+import json
+from typing import List, Sequence
+
+import discord
+import pytest
+from aiohttp import web
+from pytest_mock import MockerFixture
+
+from influ_rader.notify import (
+    Diff,
+    DiscordChannelSink,
+    FileSink,
+    NotificationQueue,
+    Notifier,
+    Sink,
+    Trend,
+    WebhookSink,
+    build_notifier,
+    pack_messages,
+)
+from influ_rader.tests.fakes import FakeClock
+from influ_rader.twitter import User
+
+
+def user(i: int) -> User:
+    return User({"id": i, "name": f"user{i}", "username": f"user{i}"})
+
+
+def diff(target: int, *followings: int) -> Diff:
+    return Diff(user(target), [user(f) for f in followings])
+
+
+def test_pack_messages_fits_blocks_into_limit() -> None:
+    """
+    複数のブロックを1つのメッセージにまとめ、上限を超える場合は見出しを付け直して分割すること
+    """
+    blocks = [("**a**", ["a1", "a2"]), ("**b**", ["b1", "b2", "b3", "b4"])]
+
+    messages = pack_messages(blocks, limit=20)
+
+    assert messages == ["**a**\na1\na2\n**b**\nb1", "**b**\nb2\nb3\nb4"]
+    assert all(len(m) <= 20 for m in messages)
+    assert pack_messages([("**a**", ["x" * 50])], limit=20) == ["**a**\n" + "x" * 14]
+    assert pack_messages([("**a**", [])]) == []
+
+
+def http_exception(mocker: MockerFixture, status: int) -> discord.HTTPException:
+    return discord.HTTPException(mocker.MagicMock(status=status, reason="error"), "error")
+
+
+def publish(notifier: Notifier, diffs: List[Diff], trends: Sequence[Trend] = ()) -> None:
+    async def run() -> None:
+        notifier.publish(diffs, trends)
+        await notifier.close()
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def channel(mocker: MockerFixture):
+    return mocker.AsyncMock()
+
+
+@pytest.fixture
+def bot(mocker: MockerFixture, channel):
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    return bot
+
+
+def test_discord_sink_retries_server_errors(mocker: MockerFixture, clock: FakeClock, bot, channel) -> None:
+    """
+    レート制限やサーバエラーで失敗した投稿は待ち時間を倍々に延ばして再送し、権限エラーの投稿は捨てること
+    """
+    channel.send.side_effect = [
+        http_exception(mocker, 429),
+        http_exception(mocker, 503),
+        None,
+        http_exception(mocker, 403),
+    ]
+    sink = DiscordChannelSink(bot, 0, clock=clock, sleep=clock.async_sleep)
+    notifier = Notifier([NotificationQueue(sink, backoff=1.0, sleep=clock.async_sleep)])
+    mocker.patch.object(sink, "render", return_value=["first", "second"])
+
+    publish(notifier, [diff(1, 10)])
+
+    assert [c.args[0] for c in channel.send.call_args_list] == ["first", "first", "first", "second"]
+    assert clock.sleeps == [1.0, 2.0]
+
+
+def test_discord_sink_paces_sends_per_channel(mocker: MockerFixture, clock: FakeClock, bot, channel) -> None:
+    """
+    1つのチャンネルへの投稿は5秒に5件を超えないこと
+    """
+    sink = DiscordChannelSink(bot, 0, clock=clock, sleep=clock.async_sleep)
+    mocker.patch.object(sink, "render", return_value=[str(i) for i in range(12)])
+
+    publish(Notifier([NotificationQueue(sink)]), [diff(1, 10)])
+
+    assert channel.send.call_count == 12
+    assert clock.sleeps == [5.0, 5.0]
+
+
+def test_diffs_are_routed_by_target_to_each_sink(tmp_path, mocker: MockerFixture, bot, channel) -> None:
+    """
+    targetsを指定した通知先には、その対象ユーザの差分だけを送ること
+    """
+    path = tmp_path / "diffs.jsonl"
+    clock = FakeClock(now=1000.0)
+    notifier = Notifier(
+        [
+            NotificationQueue(DiscordChannelSink(bot, 0, targets=["User1"])),
+            NotificationQueue(FileSink(str(path), clock=clock)),
+        ]
+    )
+
+    publish(notifier, [diff(1, 10, 11), diff(2, 20)])
+
+    messages = [c.args[0] for c in channel.send.call_args_list]
+    assert messages == ["**user1(@user1)**が新しくフォローしたアカウント\nhttps://twitter.com/user10\nhttps://twitter.com/user11"]
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["target"]["id"] for line in lines] == [1, 2]
+    assert lines[1] == {
+        "detected_at": 1000.0,
+        "target": {"id": 2, "username": "user2", "name": "user2"},
+        "followings": [{"id": 20, "username": "user20", "name": "user20"}],
+    }
+
+
+def test_trends_are_sent_as_one_digest(tmp_path, bot, channel) -> None:
+    """
+    トレンドは1つのまとめとして投稿し、targetsを指定した通知先には、そのいずれかがフォローしたトレンドだけを送ること
+    """
+    path = tmp_path / "diffs.jsonl"
+    notifier = Notifier(
+        [
+            NotificationQueue(DiscordChannelSink(bot, 0)),
+            NotificationQueue(FileSink(str(path), targets=["user4"], clock=FakeClock(now=1000.0))),
+        ]
+    )
+    trends = [Trend(user(10), [user(1), user(2), user(3)]), Trend(user(20), [user(3), user(4)])]
+
+    publish(notifier, [], trends)
+
+    assert [c.args[0] for c in channel.send.call_args_list] == [
+        "**複数の対象ユーザがフォローしたアカウント**\n"
+        "https://twitter.com/user10 (3人: @user1, @user2, @user3)\n"
+        "https://twitter.com/user20 (2人: @user3, @user4)"
+    ]
+    assert [json.loads(line) for line in path.read_text().splitlines()] == [
+        {
+            "detected_at": 1000.0,
+            "trend": {"id": 20, "username": "user20", "name": "user20"},
+            "targets": [
+                {"id": 3, "username": "user3", "name": "user3"},
+                {"id": 4, "username": "user4", "name": "user4"},
+            ],
+        }
+    ]
+
+
+class SlowSink(Sink):
+    def __init__(self, release: asyncio.Event) -> None:
+        super().__init__("slow")
+        self.release = release
+        self.delivered: List[str] = []
+
+    def render(self, diffs):
+        return [str(d.target.id) for d in diffs]
+
+    async def deliver(self, payload) -> None:
+        await self.release.wait()
+        self.delivered.append(payload)
+
+
+def test_slow_sink_does_not_delay_others(tmp_path) -> None:
+    """
+    遅い通知先があっても他の通知先は送信を終え、溢れたキューは古いものから捨てること
+    """
+    path = tmp_path / "diffs.jsonl"
+
+    async def run() -> List[str]:
+        release = asyncio.Event()
+        slow = SlowSink(release)
+        notifier = Notifier([NotificationQueue(slow, max_size=2), NotificationQueue(FileSink(str(path)))])
+        notifier.publish([diff(1, 10)])
+        await asyncio.sleep(0)  # 遅い通知先のワーカが1件目を取り出す
+        notifier.publish([diff(2, 20)])
+        notifier.publish([diff(3, 30)])
+        notifier.publish([diff(4, 40)])
+        await notifier.queues[1].join()
+        assert len(path.read_text().splitlines()) == 4
+        assert slow.delivered == []
+
+        release.set()
+        await notifier.join()
+        return slow.delivered
+
+    assert asyncio.run(run()) == ["1", "3", "4"]
+
+
+def test_notifier_limits_concurrent_sends(clock: FakeClock) -> None:
+    """
+    全ての通知先を合わせて、同時に送信する数をconcurrencyまでに制限すること
+    """
+    running: List[int] = []
+    peak: List[int] = []
+
+    class CountingSink(Sink):
+        def render(self, diffs):
+            return [d.target.id for d in diffs]
+
+        async def deliver(self, payload) -> None:
+            running.append(payload)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(payload)
+
+    notifier = Notifier([NotificationQueue(CountingSink(f"sink{i}")) for i in range(4)], concurrency=2)
+
+    publish(notifier, [diff(1, 10), diff(2, 20)])
+
+    assert len(peak) == 8
+    assert max(peak) == 2
+
+
+def test_webhook_sink_waits_retry_after(clock: FakeClock) -> None:
+    """
+    Webhookから429が返されたら、retry_after秒待って再送すること
+    """
+    received: List[str] = []
+
+    async def handle(request: web.Request) -> web.Response:
+        body = await request.json()
+        received.append(body["content"])
+        if len(received) == 1:
+            return web.json_response({"retry_after": 3.5}, status=429)
+        return web.Response(status=204)
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_post("/api/webhooks/1/token", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        try:
+            sink = WebhookSink(f"http://127.0.0.1:{port}/api/webhooks/1/token")
+            notifier = Notifier([NotificationQueue(sink, backoff=1.0, sleep=clock.async_sleep)])
+            notifier.publish([diff(1, 10)])
+            await notifier.close()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    assert received == ["**user1(@user1)**が新しくフォローしたアカウント\nhttps://twitter.com/user10"] * 2
+    assert clock.sleeps == [3.5]
+
+
+def test_build_notifier_defaults_to_channel(bot) -> None:
+    """
+    通知先の設定がなければ、指定したチャンネルに全ての差分を投稿すること
+    """
+    notifier = build_notifier(bot, 123)
+    assert [q.sink.name for q in notifier.queues] == ["discord:123"]
+
+    notifier = build_notifier(
+        bot, 123, [{"type": "discord", "channel_id": 456, "targets": ["user1"]}, {"type": "file", "path": "a.jsonl"}]
+    )
+    assert [q.sink.name for q in notifier.queues] == ["discord:456", "file:a.jsonl"]
+
+
+def test_profiles_are_shown_with_each_following(tmp_path, bot, channel) -> None:
+    """
+    Enricherが添えた詳細は、フォローしたユーザの行(ファイルにはprofile)に含め、詳細がないユーザはリンクだけにすること
+    """
+    path = tmp_path / "diffs.jsonl"
+    notifier = Notifier([NotificationQueue(DiscordChannelSink(bot, 0)), NotificationQueue(FileSink(str(path)))])
+    profile = {
+        "description": "自己紹介\nです" + "x" * 100,
+        "public_metrics": {"followers_count": 12345},
+        "created_at": "2012-03-04T05:06:07.000Z",
+        "verified": True,
+    }
+
+    publish(notifier, [diff(1, 10, 11)._replace(profiles={10: profile})])
+
+    assert channel.send.call_args.args[0].split("\n") == [
+        "**user1(@user1)**が新しくフォローしたアカウント",
+        "https://twitter.com/user10 (フォロワー12,345人, 2012-03-04作成, 認証済み) 自己紹介 です" + "x" * 72 + "…",
+        "https://twitter.com/user11",
+    ]
+    followings = json.loads(path.read_text())["followings"]
+    assert followings[0]["profile"] == profile
+    assert "profile" not in followings[1]
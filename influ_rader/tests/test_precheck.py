@@ -0,0 +1,61 @@
+import pytest
+
+from influ_rader.precheck import ChangeDetector
+from influ_rader.tests.fakes import FakeClock
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=1000.0)
+
+
+@pytest.fixture
+def detector(clock: FakeClock):
+    return ChangeDetector(full_crawl_interval=7 * DAY, clock=clock)
+
+
+def test_plan_by_following_count(detector: ChangeDetector) -> None:
+    """
+    指紋がなければ全件、フォロー数が同じなら省略、増えていれば部分取得、減っていれば全件取得すること
+    """
+    assert detector.plan({1: 10, 2: 20, 3: 30}, [1, 2, 3, 4]) == {
+        1: ChangeDetector.FULL,
+        2: ChangeDetector.FULL,
+        3: ChangeDetector.FULL,
+        4: ChangeDetector.FULL,
+    }
+    for user_id in [1, 2, 3]:
+        detector.update(user_id)
+
+    assert detector.plan({1: 10, 2: 23, 3: 29}, [1, 2, 3]) == {
+        1: ChangeDetector.SKIP,
+        2: ChangeDetector.PARTIAL,
+        3: ChangeDetector.FULL,
+    }
+    assert detector.expected_new(2) == 3
+    assert detector.expected_new(3) is None
+
+
+def test_full_crawl_after_interval(clock: FakeClock, detector: ChangeDetector) -> None:
+    """
+    部分取得や省略が続いても、前回の全件取得からfull_crawl_interval経ったら全件取得すること
+    """
+    detector.plan({1: 10}, [1])
+    detector.update(1)
+    clock.sleep(4 * DAY)
+    assert detector.plan({1: 12}, [1]) == {1: ChangeDetector.PARTIAL}
+    detector.crawled_partially(1)
+    detector.update(1)
+
+    clock.sleep(3 * DAY)
+    assert detector.plan({1: 12}, [1]) == {1: ChangeDetector.FULL}
+
+
+def test_saved_requests_counter(detector: ChangeDetector) -> None:
+    detector.add_saved_requests(3)
+    detector.add_saved_requests(2)
+
+    assert detector.take_saved_requests() == 5
+    assert detector.take_saved_requests() == 0
@@ -0,0 +1,89 @@
+import pytest
+from pytest_mock import MockerFixture
+
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=1000.0)
+
+
+@pytest.fixture
+def rate_limiter(clock):
+    return RateLimiter(clock=clock)
+
+
+def test_acquire_waits_until_reset_time_in_headers(clock: FakeClock, rate_limiter: RateLimiter) -> None:
+    """
+    レスポンスヘッダで残りリクエスト数が0になった場合、ヘッダのリセット時刻までちょうど待機すること
+    """
+    rate_limiter.acquire("get_users_following")
+    rate_limiter.update("get_users_following", {"x-rate-limit-remaining": "0", "x-rate-limit-reset": "1234"})
+
+    rate_limiter.acquire("get_users_following")
+    assert clock.sleeps == [234.0]
+    assert clock.now == 1234.0
+
+
+def test_acquire_without_headers_waits_for_window(clock: FakeClock, rate_limiter: RateLimiter) -> None:
+    """
+    レスポンスヘッダがない場合でも、エンドポイントの上限回数を使い切ったらウィンドウ1つ分待機すること
+    """
+    for _ in range(15):
+        rate_limiter.acquire("get_users_following")
+    assert clock.sleeps == []
+
+    rate_limiter.acquire("get_users_following")
+    assert clock.sleeps == [RateLimiter.WINDOW]
+    rate_limiter.acquire("get_user")  # 他のエンドポイントの枠には影響しない
+    assert clock.sleeps == [RateLimiter.WINDOW]
+
+
+def test_exhaust_waits_until_reset_time(clock: FakeClock, rate_limiter: RateLimiter) -> None:
+    """
+    429が返された場合、ヘッダのリセット時刻まで待機してから次のリクエストを行うこと
+    """
+    rate_limiter.exhaust("get_users", {"x-rate-limit-reset": "1100"})
+    rate_limiter.acquire("get_users")
+    assert clock.sleeps == [100.0]
+
+
+def test_get_users_id_following_spreads_pages_across_windows(
+    mocker: MockerFixture, clock: FakeClock, rate_limiter: RateLimiter
+) -> None:
+    """
+    複数ユーザのfollowing取得が上限に達した場合、429を受けずにリセット時刻まで待って続きのページを取得すること
+    3ユーザ x 10ページ = 30リクエストは、15リクエストのウィンドウ2つで終わる
+    """
+    followings = {i: list(range(i * 100000, i * 100000 + 10000)) for i in range(1, 4)}
+    client = FakeTwitterClient(clock, followings, {"get_users_following": 15})
+    twitter = Twitter(bearer_token="test", rate_limiter=rate_limiter)
+    mocker.patch.object(twitter, "_Twitter__client", client)
+
+    assert {k: v.tolist() for k, v in twitter.get_users_id_following([1, 2, 3]).items()} == followings
+    assert len(client.requests) == 30
+    assert client.rejected == 0
+    assert clock.sleeps == [RateLimiter.WINDOW]
+
+
+def test_get_users_id_following_retries_after_too_many_requests(
+    mocker: MockerFixture, clock: FakeClock, rate_limiter: RateLimiter
+) -> None:
+    """
+    他のプロセスなどで既に枠を使い切っていて429が返された場合、リセット時刻まで待ってからリトライすること
+    """
+    followings = {1: list(range(3000))}
+    client = FakeTwitterClient(clock, followings, {"get_users_following": 3})
+    for _ in range(3):  # 他のプロセスが枠を使い切った状態にする
+        client.get_users_following(1, max_results=1000)
+    client.requests.clear()
+    twitter = Twitter(bearer_token="test", rate_limiter=rate_limiter)
+    mocker.patch.object(twitter, "_Twitter__client", client)
+
+    assert twitter.get_user_id_following(1).tolist() == followings[1]
+    assert len(client.requests) == 3
+    assert client.rejected == 1
+    assert clock.now == 1000.0 + FakeTwitterClient.WINDOW
@@ -0,0 +1,71 @@
+import asyncio
+
+from discord.ext import tasks
+from pytest_mock import MockerFixture
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.twitter_cog import TwitterCog
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.replay import Archive, RecordingStorage, ReplayClient, ReplayClock, recording_client_factory, replay
+from influ_rader.sqlite_db import SqliteDb
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.tests.test_twitter_cog import tick
+from influ_rader.twitter import Twitter
+
+
+def test_recorded_run_is_replayed_offline(mocker: MockerFixture, tmp_path) -> None:
+    """
+    記録モードで実行したrunを、記録したアーカイブだけで同じ差分と投稿になるように再生できること
+    24時間のループは仮想の時計で実行し、実際には待たないこと
+    """
+    path = str(tmp_path / "archive.jsonl")
+    clock = FakeClock(now=1000.0)
+    client = FakeTwitterClient(clock, {1: [10, 11, 12], 2: [20, 21]}, {"get_users": 300, "get_users_following": 15})
+    archive = Archive(path, clock)
+    archive.append("targets", users=["user1", "user2"])
+    client_factory = recording_client_factory(lambda _: client, archive)
+    twitter = Twitter("test", rate_limiter=RateLimiter(clock=clock), client_factory=client_factory)
+    db = SqliteDb()
+    db.save_users_followings({1: [10, 13]}, {})
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    channel = mocker.AsyncMock()
+    bot.get_channel.return_value = channel
+    cog = TwitterCog(bot, twitter, RecordingStorage(db, archive), ["user1", "user2"], 0, BoundedExecutor(2))
+    tick(cog, TwitterCog.diff_users_followings)
+    mocker.stopall()
+
+    recorded = Archive.load(path)
+    assert "test" not in open(path).read()  # Bearer Tokenは記録しない
+    assert recorded.stored() == {1: [10, 13], 2: []}
+    result = asyncio.run(replay(recorded, hours=24))
+
+    assert result.misses == 0
+    assert result.messages == [c.args[0] for c in channel.send.call_args_list] != []
+    assert result.recorded == result.replayed == (4, 1)
+    assert result.runs == 24 * 4
+    assert result.virtual_seconds >= 24 * 60 * 60 - TwitterCog.RETRY_INTERVAL
+
+
+def test_recorded_rate_limit_is_replayed_on_virtual_clock() -> None:
+    """
+    記録した429はそのまま返し、リセット時刻までの待機は仮想の時計を進めるだけにすること
+    記録にないユーザ情報は記録したレスポンスから組み立て、組み立てられないものはmissとして数えること
+    """
+    archive = Archive(clock=FakeClock(now=1000.0))
+    request = {"endpoint": "get_users_following", "params": {"id": 1, "max_results": 1000}, "credential": "a"}
+    archive.append("request", **request, status=429, headers={"x-rate-limit-reset": "1900"}, response=None)
+    page = {"data": [{"id": "10", "name": "ten", "username": "user10"}], "includes": {}, "errors": [], "meta": {}}
+    archive.append("request", **request, status=200, headers={}, response=page)
+    clock = ReplayClock(archive.started_at())
+    client = ReplayClient(archive)
+    twitter = Twitter(archive.credentials(), rate_limiter=RateLimiter(clock=clock), client_factory=lambda _: client)
+
+    assert twitter.get_user_id_following(1).tolist() == [10]
+    assert clock.time() == 1900.0
+    # 記録を使い切った後は、最後に成功したレスポンスを返し続ける
+    assert twitter.get_user_id_following(1).tolist() == [10]
+
+    assert [u.name for u in twitter.get_users_by_ids([10])] == ["ten"]
+    assert twitter.get_users_by_ids([99]) == []
+    assert client.misses == 1
@@ -0,0 +1,90 @@
+from typing import Dict
+
+import pytest
+
+from influ_rader.schedule import PollScheduler
+from influ_rader.tests.fakes import FakeClock
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=0.0)
+
+
+@pytest.fixture
+def scheduler(clock: FakeClock):
+    return PollScheduler(min_interval=HOUR, max_interval=7 * DAY, initial_interval=DAY, budget=15, clock=clock)
+
+
+def simulate(
+    clock: FakeClock, scheduler: PollScheduler, follows_per_day: Dict[int, float], days: int
+) -> Dict[int, int]:
+    """
+    対象ユーザが1日あたりfollows_per_day件ずつフォローする状況で、1時間ごとにtickした時の取得回数を返す
+    """
+    polls = {user_id: 0 for user_id in follows_per_day}
+    last_polled = {user_id: clock.now for user_id in follows_per_day}
+    for _ in range(days * 24):
+        for user_id in scheduler.due(list(follows_per_day)):
+            changes = int(follows_per_day[user_id] * (clock.now - last_polled[user_id]) / DAY)
+            scheduler.record(user_id, changes, 1)
+            polls[user_id] += 1
+            last_polled[user_id] = clock.now
+        clock.sleep(HOUR)
+    return polls
+
+
+def test_active_targets_are_polled_more_often(clock: FakeClock, scheduler: PollScheduler) -> None:
+    """
+    頻繁にフォローする対象ユーザは短い間隔(最短1時間)で取得し、フォローしない対象ユーザは間隔を延ばすこと
+    """
+    polls = simulate(clock, scheduler, {1: 48, 2: 2, 3: 0}, days=14)
+
+    assert polls[1] > 14 * 20
+    assert 14 < polls[2] < 14 * 4
+    assert polls[3] < 7
+    intervals = scheduler.intervals()
+    assert intervals[1] == HOUR
+    assert intervals[3] == 7 * DAY
+
+
+def test_due_targets_are_limited_by_budget(scheduler: PollScheduler) -> None:
+    """
+    取得時刻を迎えた対象ユーザは、見込みのページ数がbudgetに収まる分だけ選び、残りは次のtickに回すこと
+    budgetより多くのページがある対象ユーザでも、1件目なら選ぶこと
+    """
+    assert scheduler.due([1, 2, 3]) == [1, 2, 3]
+    scheduler.record(1, 0, 10)
+    scheduler.record(2, 0, 10)
+    scheduler.record(3, 0, 20)
+    scheduler.clock.sleep(DAY)
+
+    assert len(scheduler.due([1, 2])) == 1
+    assert scheduler.due([3]) == [3]
+
+
+def test_detection_latency(clock: FakeClock, scheduler: PollScheduler) -> None:
+    """
+    変化を検出した取得について、前回の取得からの経過時間を検出遅延として集計すること
+    """
+    assert scheduler.detection_latency()["count"] == 0
+    scheduler.record(1, 0, 1)
+    clock.sleep(DAY)
+    scheduler.record(1, 3, 1)
+    clock.sleep(2 * HOUR)
+    scheduler.record(1, 0, 1)
+
+    assert scheduler.detection_latency() == {"count": 1, "mean": DAY, "p50": DAY, "max": DAY}
+
+
+def test_schedule_persists_to_file(tmp_path, clock: FakeClock) -> None:
+    """
+    学習した取得予定は、開き直しても引き継がれること
+    """
+    path = str(tmp_path / "jobs.sqlite3")
+    PollScheduler(path, clock=clock).record(1, 0, 1)
+
+    assert PollScheduler(path, clock=clock).due([1, 2]) == [2]
@@ -0,0 +1,125 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import pytest
+from pytest_mock import MockerFixture
+
+from influ_rader import shard
+from influ_rader.error import TwitterRequestError
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.shard import HashRing, ShardedCrawler
+from influ_rader.tests.fakes import FakeClientFactory, FakeClock, FakeTwitterClient
+from influ_rader.twitter import FollowingResult, Twitter
+
+
+def fetched(result: Dict[int, FollowingResult]) -> Dict[int, List[int]]:
+    """
+    取得できた対象ユーザのfollowingだけをリストにして返す
+    """
+    return {k: v.tolist() for k, v in result.items() if not isinstance(v, Exception)}
+
+
+def test_hash_ring_is_deterministic_and_balanced() -> None:
+    """
+    同じキーは常に同じシャードに割り当てられ、各シャードにおおよそ均等に分散されること
+    """
+    keys = list(range(10000))
+    partitions = HashRing([f"shard-{i}" for i in range(4)]).partition(keys)
+
+    assert partitions == HashRing([f"shard-{i}" for i in range(4)]).partition(keys)
+    assert sorted(k for v in partitions.values() for k in v) == keys
+    assert all(1500 < len(v) < 3500 for v in partitions.values())
+
+
+def test_hash_ring_moves_few_keys_when_adding_shard() -> None:
+    """
+    シャードを追加した場合、移動するキーは新しいシャードに移るものだけで、全体の一部で済むこと
+    """
+    keys = list(range(10000))
+    before = HashRing([f"shard-{i}" for i in range(4)])
+    after = HashRing([f"shard-{i}" for i in range(5)])
+
+    moved = [k for k in keys if before.get(k) != after.get(k)]
+    assert all(after.get(k) == "shard-4" for k in moved)
+    assert len(moved) < len(keys) * 0.35
+
+
+@pytest.fixture
+def clients(mocker: MockerFixture):
+    """
+    Bearer Tokenごとに別のFakeTwitterClientを使うTwitterをワーカで作るようにする
+    """
+    followings = {i: list(range(i * 10000, i * 10000 + 1500)) for i in range(1, 9)}
+    clients = {}
+
+    def create_twitter(bearer_token: str, checkpoint=None, client_factory=None) -> Twitter:
+        clock = FakeClock()
+        clients[bearer_token] = FakeTwitterClient(clock, followings, {"get_users_following": 15})
+        twitter = Twitter(bearer_token=bearer_token, rate_limiter=RateLimiter(clock=clock))
+        mocker.patch.object(twitter, "_Twitter__client", clients[bearer_token])
+        return twitter
+
+    mocker.patch.object(shard, "Twitter", side_effect=create_twitter)
+    mocker.patch.object(shard, "_twitters", {})
+    return followings, clients
+
+
+def test_sharded_crawler_splits_targets_across_tokens(clients) -> None:
+    """
+    対象ユーザをシャードごとに分割して取得し、入力順の1つの結果にまとめること
+    各シャードは自分のBearer Tokenで、担当する対象ユーザのページだけをリクエストすること
+    """
+    followings, fake_clients = clients
+    crawler = ShardedCrawler(["token0", "token1"], 2, lambda: ThreadPoolExecutor(max_workers=1))
+    user_ids = list(followings)
+
+    result = asyncio.run(crawler.get_users_id_following(user_ids))
+    crawler.shutdown()
+
+    assert list(result) == user_ids
+    assert fetched(result) == followings
+    partitions = crawler.ring.partition(user_ids)
+    assert len(fake_clients["token0"].requests) == 2 * len(partitions["shard-0"])
+    assert len(fake_clients["token1"].requests) == 2 * len(partitions["shard-1"])
+
+
+def test_sharded_crawler_returns_results_per_target(mocker: MockerFixture) -> None:
+    """
+    シャード内の一部の対象ユーザで失敗しても、他の対象ユーザの結果は返し、失敗した対象ユーザだけ例外を返すこと
+    """
+    mocker.patch.object(shard, "_twitters", {})
+    followings = {i: list(range(i * 10000, i * 10000 + 1500)) for i in range(1, 5)}
+    factory = FakeClientFactory(followings, {"get_users_following": 15}, fail_users=[2])
+    crawler = ShardedCrawler(["token0"], 1, lambda: ThreadPoolExecutor(max_workers=1), client_factory=factory)
+
+    result = asyncio.run(crawler.get_users_id_following(list(followings)))
+    crawler.shutdown()
+
+    assert list(result) == [1, 2, 3, 4]
+    assert isinstance(result[2], TwitterRequestError)
+    assert fetched(result) == {k: v for k, v in followings.items() if k != 2}
+
+
+def test_sharded_crawler_runs_shards_in_worker_processes(tmp_path) -> None:
+    """
+    各シャードは別のワーカプロセスで取得し、クライアントはプロセスごとに1回だけ作って次の実行でも使い続けること
+    """
+    followings = {i: list(range(i * 10000, i * 10000 + 500)) for i in range(1, 7)}
+    log_path = tmp_path / "clients.log"
+    factory = FakeClientFactory(followings, {"get_users_following": 15}, str(log_path))
+    crawler = ShardedCrawler(["token0", "token1"], 2, client_factory=factory)
+    user_ids = list(followings)
+    try:
+        results = [asyncio.run(crawler.get_users_id_following(user_ids)) for _ in range(2)]
+    finally:
+        crawler.shutdown()
+
+    for result in results:
+        assert list(result) == user_ids
+        assert fetched(result) == followings
+    created = [line.split() for line in log_path.read_text().splitlines()]
+    assert sorted(token for _, token in created) == ["token0", "token1"]
+    pids = {int(pid) for pid, _ in created}
+    assert len(pids) == 2 and os.getpid() not in pids
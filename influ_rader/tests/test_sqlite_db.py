@@ -0,0 +1,60 @@
+import pytest
+
+from influ_rader.sqlite_db import SqliteDb
+
+
+@pytest.fixture
+def sqlite_db():
+    return SqliteDb(":memory:")
+
+
+def test_diff_users_followings_with_empty_database(sqlite_db: SqliteDb) -> None:
+    """
+    何も保存されていない場合、Twitterから取得した全てのfollowingsを追加分として返すこと
+    """
+    added, removed = sqlite_db.diff_users_followings({1: [10, 11], 2: []})
+
+    assert {k: sorted(v) for k, v in added.items()} == {1: [10, 11], 2: []}
+    assert removed == {}
+
+
+def test_diff_and_save_users_followings(sqlite_db: SqliteDb) -> None:
+    """
+    保存されているfollowingsとの差分を取り、差分を保存できること
+    Twitterから取得していない対象ユーザのfollowingsは解除扱いにしないこと
+    """
+    sqlite_db.save_users_followings({1: [10, 11], 2: [20]}, {})
+
+    added, removed = sqlite_db.diff_users_followings({1: [11, 12]})
+    assert added == {1: [12]}
+    assert removed == {1: [10]}
+
+    sqlite_db.save_users_followings(added, removed)
+    followings = sqlite_db.get_users_followings([1, 2, 3])
+    assert {k: sorted(v) for k, v in followings.items()} == {1: [11, 12], 2: [20]}
+
+
+def test_first_seen_and_last_seen(sqlite_db: SqliteDb) -> None:
+    """
+    初めて確認した時刻を保持したまま、最後に確認した時刻を更新すること
+    """
+    sqlite_db.save_users_followings({1: [10]}, {})
+    ((first_seen, last_seen),) = sqlite_db.connection.execute("SELECT first_seen, last_seen FROM followings").fetchall()
+    assert first_seen == last_seen
+
+    sqlite_db.diff_users_followings({1: [10]})
+    ((first_seen_after, last_seen_after),) = sqlite_db.connection.execute(
+        "SELECT first_seen, last_seen FROM followings"
+    ).fetchall()
+    assert first_seen_after == first_seen
+    assert last_seen_after >= last_seen
+
+
+def test_persists_to_file(tmp_path) -> None:
+    """
+    ファイルに保存したfollowingsを、開き直しても取得できること
+    """
+    path = str(tmp_path / "influ_rader.sqlite3")
+    SqliteDb(path).save_users_followings({1: [10]}, {})
+
+    assert SqliteDb(path).get_users_followings([1]) == {1: [10]}
@@ -0,0 +1,130 @@
+from typing import List, Tuple
+
+import pytest
+
+from influ_rader.error import TwitterRequestError
+from influ_rader.targets import Target, TargetRegistry
+from influ_rader.tests.fakes import FakeClock
+from influ_rader.twitter import User
+
+DAY = 24 * 60 * 60
+
+
+class FakeLookup:
+    """
+    ユーザ名user{i}のユーザIDをiとし、existsに含まれないユーザは見つからないとする
+    """
+
+    def __init__(self, *exists: str) -> None:
+        self.exists = set(exists)
+        self.calls: List[List[str]] = []
+
+    def __call__(self, usernames: List[str]) -> Tuple[List[User], List[str]]:
+        self.calls.append(list(usernames))
+        users = [User({"id": int(u[len("user") :]), "name": u, "username": u}) for u in usernames if u in self.exists]
+        return users, [u for u in usernames if u not in self.exists]
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=DAY)
+
+
+def test_resolve_only_unresolved_usernames(tmp_path, clock: FakeClock) -> None:
+    """
+    解決済みのユーザ名は再起動しても解決し直さず、追加したユーザ名だけを解決すること
+    """
+    path = str(tmp_path / "targets.sqlite3")
+    lookup = FakeLookup("user1", "user2", "user3")
+    registry = TargetRegistry(path, clock=clock)
+    registry.seed(["User1", "user2"])
+    assert registry.resolve(lookup) == (["user1", "user2"], [])
+
+    registry = TargetRegistry(path, clock=clock)
+    registry.seed(["user1", "user2"])
+    assert registry.resolve(lookup) == ([], [])
+    assert registry.add(["user3", "USER2"]) == ["user3"]
+    assert registry.resolve(lookup) == (["user3"], [])
+
+    assert lookup.calls == [["user1", "user2"], ["user3"]]
+    assert registry.active_ids() == [1, 2, 3]
+
+
+def test_unknown_usernames_are_quarantined(clock: FakeClock) -> None:
+    """
+    見つからないユーザ名は隔離してquarantine_interval秒後に解決し直し、リクエストの失敗では隔離しないこと
+    """
+    registry = TargetRegistry(quarantine_interval=DAY, clock=clock)
+    registry.seed(["user1", "user9"])
+
+    def fail(usernames: List[str]) -> Tuple[List[User], List[str]]:
+        raise TwitterRequestError
+
+    assert registry.resolve(fail) == ([], [])
+    assert registry.unresolved() == ["user1", "user9"]
+
+    assert registry.resolve(FakeLookup("user1")) == (["user1"], ["user9"])
+    assert registry.entries() == [
+        Target("user1", 1, TargetRegistry.ACTIVE, None),
+        Target("user9", None, TargetRegistry.QUARANTINED, "not found or suspended"),
+    ]
+    assert registry.unresolved() == []
+    clock.sleep(DAY)
+    assert registry.unresolved() == ["user9"]
+
+
+def test_invalid_usernames_are_quarantined_without_lookup(clock: FakeClock) -> None:
+    """
+    ユーザ名として正しくないものは問い合わせずに隔離し、quarantine_interval秒経っても解決し直さないこと
+    """
+    lookup = FakeLookup("user1", "user2")
+    registry = TargetRegistry(quarantine_interval=DAY, clock=clock)
+    registry.seed(["user1", "foo-bar"])
+    assert registry.add(["user2", "@user3", "a" * 16]) == ["user2"]
+
+    assert registry.resolve(lookup) == (["user1", "user2"], [])
+    assert lookup.calls == [["user1", "user2"]]
+    assert [(e.username, e.status, e.error) for e in registry.entries() if e.status != TargetRegistry.ACTIVE] == [
+        ("foo-bar", TargetRegistry.QUARANTINED, TargetRegistry.INVALID),
+        ("@user3", TargetRegistry.QUARANTINED, TargetRegistry.INVALID),
+        ("a" * 16, TargetRegistry.QUARANTINED, TargetRegistry.INVALID),
+    ]
+    clock.sleep(DAY)
+    assert registry.unresolved() == []
+
+
+def test_failed_lookup_batch_does_not_block_others(clock: FakeClock) -> None:
+    """
+    100件ずつのバッチのうち失敗したバッチのユーザ名だけを未解決のまま残し、他のバッチは解決すること
+    """
+    usernames = [f"user{i}" for i in range(1, 151)]
+    registry = TargetRegistry(clock=clock)
+    registry.seed(usernames)
+    lookup = FakeLookup(*usernames)
+
+    def fail_first(batch: List[str]) -> Tuple[List[User], List[str]]:
+        if "user1" in batch:
+            raise TwitterRequestError
+        return lookup(batch)
+
+    resolved, quarantined = registry.resolve(fail_first)
+
+    assert resolved == usernames[100:] and quarantined == []
+    assert registry.unresolved() == usernames[:100]
+
+
+def test_removed_targets_are_not_seeded_again(clock: FakeClock) -> None:
+    """
+    削除した対象ユーザは、設定に含まれていても追加し直さず、コマンドで追加した場合だけ戻すこと
+    """
+    registry = TargetRegistry(clock=clock)
+    registry.seed(["user1", "user2"])
+    registry.resolve(FakeLookup("user1", "user2"))
+
+    assert registry.remove(["user1", "user5"]) == ["user1"]
+    registry.seed(["user1", "user2"])
+    assert registry.active_ids() == [2]
+
+    assert registry.add(["user1"]) == ["user1"]
+    assert registry.resolve(FakeLookup("user1", "user2")) == (["user1"], [])
+    assert registry.active_ids() == [1, 2]
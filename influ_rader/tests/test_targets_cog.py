@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+import requests
+from pytest_mock import MockerFixture
+from tweepy import TwitterServerError
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.targets_cog import TargetsCog
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.targets import TargetRegistry
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
+from influ_rader.twitter import Twitter
+
+
+@pytest.fixture
+def twitter_client():
+    return FakeTwitterClient(FakeClock(), {}, {"get_users": 300, "get_users_following": 15})
+
+
+@pytest.fixture
+def twitter(mocker: MockerFixture, twitter_client: FakeTwitterClient):
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=twitter_client.clock))
+    mocker.patch.object(twitter, "_Twitter__client", twitter_client)
+    return twitter
+
+
+@pytest.fixture
+def registry():
+    registry = TargetRegistry()
+    registry.seed(["user1"])
+    return registry
+
+
+@pytest.fixture
+def cog(mocker: MockerFixture, twitter: Twitter, registry: TargetRegistry):
+    return TargetsCog(mocker.MagicMock(), twitter, registry, BoundedExecutor(max_workers=2))
+
+
+def test_add_and_remove_targets(
+    mocker: MockerFixture,
+    cog: TargetsCog,
+    registry: TargetRegistry,
+    twitter: Twitter,
+    twitter_client: FakeTwitterClient,
+) -> None:
+    """
+    追加したユーザ名だけを解決し、削除した対象ユーザは取得の対象から外すこと
+    """
+    ctx = mocker.AsyncMock()
+    registry.resolve(twitter.lookup_users)
+    twitter_client.requests.clear()
+    get_users = mocker.spy(twitter_client, "get_users")
+
+    asyncio.run(TargetsCog.add_targets.callback(cog, ctx, "@user2", "user3", "User1"))
+    asyncio.run(TargetsCog.remove_targets.callback(cog, ctx, "user3"))
+    asyncio.run(TargetsCog.list_targets.callback(cog, ctx))
+
+    assert get_users.call_args.kwargs["usernames"] == ["user2", "user3"]
+    assert twitter_client.requests == ["get_users"]
+    assert [c.args[0] for c in ctx.send.call_args_list] == [
+        "追加しました: user2, user3\nすでに対象ユーザです: user1",
+        "削除しました: user3",
+        "**対象ユーザ(2人)**\nhttps://twitter.com/user1\nhttps://twitter.com/user2",
+    ]
+    assert registry.active_ids() == [1, 2]
+
+
+def test_add_invalid_or_unconfirmed_targets(
+    mocker: MockerFixture, cog: TargetsCog, registry: TargetRegistry, twitter_client: FakeTwitterClient
+) -> None:
+    """
+    ユーザ名として正しくないものは問い合わせずに保留し、問い合わせに失敗したユーザ名は次のループで確認し直すこと
+    """
+    ctx = mocker.AsyncMock()
+    res = requests.Response()
+    res.status_code = 503
+    get_users = mocker.patch.object(twitter_client, "get_users", side_effect=TwitterServerError(res))
+
+    asyncio.run(TargetsCog.add_targets.callback(cog, ctx, "foo-bar", "user4"))
+
+    assert get_users.call_args.kwargs["usernames"] == ["user1", "user4"]
+    assert ctx.send.call_args.args[0].split("\n") == [
+        "追加しました。ユーザの確認に失敗したので、次のループで確認し直します: user4",
+        "ユーザ名が正しくないので保留しました: foo-bar",
+    ]
+    assert registry.unresolved() == ["user1", "user4"]
@@ -0,0 +1,37 @@
+import requests
+
+from benchmarks.bench_transport import StubServer
+from influ_rader.credentials import create_client
+from influ_rader.transport import Transport
+
+
+def test_session_reuses_connections_and_negotiates_compression() -> None:
+    """
+    共有したSessionでは1つの接続を使い回し、gzipで圧縮したレスポンスを展開して返すこと
+    """
+    transport = Transport()
+    with StubServer() as server:
+        for _ in range(3):
+            res = transport.session.get(server.url)
+            assert res.content == server.body
+        assert res.headers["Content-Encoding"] == "gzip"
+        assert server.connections == 1
+        assert server.body_bytes == 3 * len(server.gzipped)
+
+        uncompressed = Transport(compress=False)
+        assert uncompressed.session.get(server.url).headers.get("Content-Encoding") is None
+    transport.close()
+    uncompressed.close()
+
+
+def test_clients_share_transport_session() -> None:
+    """
+    Transportを指定して作ったtweepyのクライアントは、Bearer Tokenが違っても同じSessionを使うこと
+    """
+    transport = Transport(pool_size=16)
+    a, b = create_client("a", transport), create_client("b", transport)
+
+    assert a.session is b.session is transport.session
+    assert transport.session.get_adapter("https://api.twitter.com")._pool_maxsize == 16
+    assert isinstance(create_client("c").session, requests.Session)
+    assert create_client("c").session is not transport.session
@@ -0,0 +1,67 @@
+from influ_rader.history import FollowHistory
+from influ_rader.tests.fakes import FakeClock
+from influ_rader.trending import CoFollow, TrendIndex
+
+DAY = 24 * 60 * 60
+
+
+def baseline(index: TrendIndex, *targets: int) -> None:
+    index.apply({t: [] for t in targets}, {}, {})
+
+
+def test_apply_reports_accounts_reaching_min_targets() -> None:
+    """
+    min_targets人の対象ユーザがフォローしたユーザを1回だけ通知し、さらに対象ユーザが増えたら通知し直すこと
+    初めて差分を適用する対象ユーザのフォローは数えないこと
+    """
+    clock = FakeClock(now=DAY)
+    index = TrendIndex(window=7 * DAY, min_targets=3, clock=clock)
+    index.apply({1: [50], 2: [50], 3: [50]}, {1: [50], 2: [50], 3: [50]}, {})
+    assert index.ranking() == []
+
+    assert index.apply({1: [], 2: []}, {1: [60], 2: [60, 70]}, {}) == []
+    assert index.apply({3: []}, {3: [60, 70]}, {}) == [CoFollow(60, [1, 2, 3])]
+    assert index.apply({4: [60]}, {4: [60]}, {}) == []
+    assert index.apply({1: []}, {1: [70]}, {}) == [CoFollow(70, [2, 3, 1])]
+    assert index.apply({4: []}, {4: [70]}, {}) == [CoFollow(70, [2, 3, 1, 4])]
+    assert index.apply({5: []}, {}, {}) == []
+    assert index.ranking() == [CoFollow(70, [2, 3, 1, 4]), CoFollow(60, [1, 2, 3])]
+
+
+def test_unfollow_and_window_expiry_remove_targets() -> None:
+    """
+    フォロー解除とwindowを過ぎたフォローはインデックスから取り除き、再び集まった場合は通知し直すこと
+    """
+    clock = FakeClock(now=DAY)
+    index = TrendIndex(window=7 * DAY, min_targets=2, clock=clock)
+    baseline(index, 1, 2, 3)
+
+    index.apply({1: []}, {1: [50]}, {})
+    clock.sleep(3 * DAY)
+    assert index.apply({2: []}, {2: [50, 60]}, {}) == [CoFollow(50, [1, 2])]
+    index.apply({2: []}, {}, {2: [50]})
+    assert index.ranking() == []
+
+    assert index.apply({3: []}, {3: [50, 60]}, {}) == [CoFollow(50, [1, 3]), CoFollow(60, [2, 3])]
+    clock.sleep(5 * DAY)
+    assert index.ranking() == [CoFollow(60, [2, 3])]
+    clock.sleep(3 * DAY)
+    assert index.ranking() == []
+
+
+def test_load_from_history() -> None:
+    """
+    履歴から直前までのインデックスを作り直し、すでにトレンドだったユーザは通知し直さないこと
+    """
+    clock = FakeClock(now=DAY)
+    history = FollowHistory(":memory:", clock=clock)
+    history.record({1: [], 2: [], 3: []}, {}, {})
+    clock.sleep(DAY)
+    history.record({1: [50, 60], 2: [50, 60]}, {1: [50, 60], 2: [50, 60]}, {1: [70]})
+
+    index = TrendIndex(window=7 * DAY, min_targets=2, clock=clock)
+    index.load(history.targets(), history.changes(clock.now - index.window))
+
+    assert index.ranking() == [CoFollow(50, [1, 2]), CoFollow(60, [1, 2])]
+    assert index.apply({3: []}, {3: [50]}, {}) == [CoFollow(50, [1, 2, 3])]
+    assert index.apply({3: [50, 60]}, {3: [60]}, {3: [50]}) == [CoFollow(60, [1, 2, 3])]
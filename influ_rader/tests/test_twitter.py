@@ -1,10 +1,17 @@
+from typing import Dict, List, Optional
+
 import pytest
 import requests
 from pytest_mock import MockerFixture
-from tweepy import Response, TooManyRequests
+from tweepy import BadRequest, Response, TooManyRequests, TwitterServerError
 
+from influ_rader.cache import UserCache
+from influ_rader.diff import Snapshot
 from influ_rader.error import TwitterRequestError
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.tests.fakes import FakeClock, FakeTwitterClient
 from influ_rader.twitter import Twitter, User
+from influ_rader.twitter_client import Client
 
 
 @pytest.fixture
@@ -27,6 +34,21 @@ def error_response():
     return Response(data={}, includes={}, errors=[{"value": "someerror", "title": "Not Found Error"}], meta={})
 
 
+def test_client_is_created_on_first_use(mocker: MockerFixture) -> None:
+    """
+    tweepyのクライアントは作成時ではなく、最初に使う時にBearer Tokenごとに1回だけ作ること
+    """
+    factory = mocker.Mock(side_effect=lambda token: Client(bearer_token=token))
+    twitter = Twitter(bearer_token=["a", "b"], client_factory=factory)
+    factory.assert_not_called()
+
+    twitter.warm_up()
+    twitter.warm_up()
+
+    assert [c.args for c in factory.call_args_list] == [("a",), ("b",)]
+    assert all(isinstance(c.client, Client) for c in twitter.pool.credentials)
+
+
 def test_get_user_with_valid_id(mocker: MockerFixture, twitter: Twitter, response: Response) -> None:
     """
     正常にユーザーデータを取得できた場合、その値を返すこと
@@ -99,51 +121,179 @@ def test_get_user_with_10_times_too_many_requests_exception(
         _ = twitter.get_user("usera")
 
 
-def test_get_users_by_ids_with_valid_responses(mocker: MockerFixture, twitter: Twitter, response: Response) -> None:
+@pytest.mark.parametrize("status, error", [(400, BadRequest), (503, TwitterServerError)])
+def test_get_user_with_other_http_errors(mocker: MockerFixture, twitter: Twitter, status: int, error: type) -> None:
     """
-    正常にユーザーデータを取得できた場合、その値を返すこと
+    429/401以外のエラー(400や5xxなど)が返された場合、リトライせずにTwitterRequestError例外が発生すること
     """
+    res = requests.Response()
+    res.status_code = status
     client_mock = mocker.MagicMock()
-    client_mock.get_user = mocker.Mock(return_value=response)
+    client_mock.get_user = mocker.Mock(side_effect=error(res))
     mocker.patch.object(twitter, "_Twitter__client", client_mock)
 
-    usera = User({"id": 1, "name": "ユーザーA", "username": "usera"})
-    user_ids = [1, 1]
-    assert twitter.get_users_by_ids(user_ids) == [usera, usera]
+    with pytest.raises(TwitterRequestError):
+        _ = twitter.get_user(0)
+    assert client_mock.get_user.call_count == 1
+    assert twitter.pool.stats()["token1"] == {"failed": 1, "disabled": 0}
+
 
+def users_response(users: List[User], errors: Optional[List[Dict[str, str]]] = None) -> Response:
+    return Response(data=users, includes={}, errors=errors or [], meta={})
 
-def test_get_users_by_ids_with_res_errors(mocker: MockerFixture, twitter: Twitter, error_response: Response) -> None:
+
+def test_get_users_by_ids_with_valid_responses(mocker: MockerFixture, twitter: Twitter, user: User) -> None:
     """
-    ユーザーデータ取得時にTwitterRequestError例外が発生した場合、そのまま例外をraiseすること
+    正常にユーザーデータを取得できた場合、入力順にその値を返すこと
     """
+    userb = User({"id": 2, "name": "ユーザーB", "username": "userb"})
     client_mock = mocker.MagicMock()
-    client_mock.get_user = mocker.Mock(return_value=error_response)
+    client_mock.get_users = mocker.Mock(return_value=users_response([userb, user]))
     mocker.patch.object(twitter, "_Twitter__client", client_mock)
 
-    with pytest.raises(TwitterRequestError):
-        _ = twitter.get_users_by_ids([1, 1])
+    assert twitter.get_users_by_ids([1, 2, 1]) == [user, userb, user]
+    client_mock.get_users.assert_called_once_with(ids=[1, 2])
 
 
-def test_get_users_with_valid_responses(mocker: MockerFixture, twitter: Twitter, response: Response) -> None:
+def test_get_users_by_ids_with_res_errors(mocker: MockerFixture, twitter: Twitter, user: User) -> None:
     """
-    正常にユーザーデータを取得できた場合、その値を返すこと
+    一部のユーザーが見つからない/凍結されている場合、バッチ全体を失敗させずに見つからなかったIDを返すこと
     """
+    errors = [
+        {"value": "3", "title": "Not Found Error", "detail": "Could not find user with ids: [3]."},
+        {"value": "4", "title": "Forbidden", "detail": "User has been suspended: [4]."},
+    ]
     client_mock = mocker.MagicMock()
-    client_mock.get_user = mocker.Mock(return_value=response)
+    client_mock.get_users = mocker.Mock(return_value=users_response([user], errors))
+    mocker.patch.object(twitter, "_Twitter__client", client_mock)
+
+    assert twitter.lookup_users_by_ids([3, 1, 4]) == ([user], [3, 4])
+
+
+def test_get_users_by_ids_with_more_than_100_ids(mocker: MockerFixture, twitter: Twitter) -> None:
+    """
+    100件を超えるユーザーIDを指定した場合、100件ずつまとめてリクエストすること
+    """
+
+    def get_users(ids):
+        return users_response([User({"id": i, "name": f"user{i}", "username": f"user{i}"}) for i in ids])
+
+    client_mock = mocker.MagicMock()
+    client_mock.get_users = mocker.Mock(side_effect=get_users)
+    mocker.patch.object(twitter, "_Twitter__client", client_mock)
+
+    user_ids = list(range(250, 0, -1))
+    assert [u.id for u in twitter.get_users_by_ids(user_ids)] == user_ids
+    assert client_mock.get_users.call_count == 3
+    assert client_mock.get_user.call_count == 0
+
+
+def test_get_users_with_valid_responses(mocker: MockerFixture, twitter: Twitter, user: User) -> None:
+    """
+    正常にユーザーデータを取得できた場合、その値を返すこと(ユーザー名の大文字小文字は区別しない)
+    """
+    client_mock = mocker.MagicMock()
+    client_mock.get_users = mocker.Mock(return_value=users_response([user]))
     mocker.patch.object(twitter, "_Twitter__client", client_mock)
 
-    usera = User({"id": 1, "name": "ユーザーA", "username": "usera"})
-    user_ids = ["usera", "usera"]
-    assert twitter.get_users(user_ids) == [usera, usera]
+    assert twitter.get_users(["usera", "UserA"]) == [user, user]
+    client_mock.get_users.assert_called_once_with(usernames=["usera"])
 
 
 def test_get_users_with_res_errors(mocker: MockerFixture, twitter: Twitter, error_response: Response) -> None:
     """
-    ユーザーデータ取得時にTwitterRequestError例外が発生した場合、そのまま例外をraiseすること
+    ユーザーデータを1件も取得できなかった場合、空のリストと見つからなかったユーザー名を返すこと
     """
     client_mock = mocker.MagicMock()
-    client_mock.get_user = mocker.Mock(return_value=error_response)
+    client_mock.get_users = mocker.Mock(
+        return_value=Response(data=None, includes={}, errors=error_response.errors, meta={})
+    )
+    mocker.patch.object(twitter, "_Twitter__client", client_mock)
+
+    assert twitter.lookup_users(["usera", "userb"]) == ([], ["usera", "userb"])
+
+
+def test_get_users_with_too_many_requests_exception(mocker: MockerFixture, twitter: Twitter, user: User) -> None:
+    """
+    Twitter APIの取得制限に引っかかった場合、一定時間待機後に再度リクエストを実施すること
+    """
+    client_mock = mocker.MagicMock()
+    client_mock.get_users = mocker.Mock(
+        side_effect=[TooManyRequests(response=requests.Response()), users_response([user])]
+    )
     mocker.patch.object(twitter, "_Twitter__client", client_mock)
+    mocker.patch.object(twitter, "_Twitter__retry_interval", 0.1)  # テストなので、待ち時間を0.1秒に短縮する
+
+    assert twitter.get_users(["usera"]) == [user]
+    assert client_mock.get_users.call_count == 2
+
+
+def test_iter_user_id_following_yields_pages(mocker: MockerFixture) -> None:
+    """
+    followingを1ページずつ整数配列としてyieldし、取得し終えたら途中経過を消すこと
+    """
+    clock = FakeClock(now=1000.0)
+    client = FakeTwitterClient(clock, {1: list(range(2500))}, {"get_users_following": 15})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
+
+    pages = twitter.iter_user_id_following(1)
+    assert next(pages).tolist() == list(range(1000))
+    assert len(client.requests) == 1
+    assert [len(page) for page in pages] == [1000, 500]
+    assert twitter.checkpoint.load(1) is None
+
+
+def test_get_user_id_following_resumes_from_checkpoint(mocker: MockerFixture) -> None:
+    """
+    途中のページでエラーになった場合、次の呼び出しでは最初からではなく失敗したページから取得を再開すること
+    """
+    clock = FakeClock(now=1000.0)
+    client = FakeTwitterClient(clock, {1: list(range(3000))}, {"get_users_following": 15})
+    client.fail_pages.append(2000)
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
 
     with pytest.raises(TwitterRequestError):
-        _ = twitter.get_users(["usera", "usera"])
+        twitter.get_user_id_following(1)
+    assert len(client.requests) == 3
+
+    assert twitter.get_user_id_following(1).tolist() == list(range(3000))
+    assert len(client.requests) == 4
+
+
+def test_get_following_counts_bypasses_cache(mocker: MockerFixture) -> None:
+    """
+    フォロー数は100件ずつまとめて、キャッシュを使わずに取得すること
+    """
+    clock = FakeClock(now=1000.0)
+    followings = {i: list(range(i)) for i in range(1, 151)}
+    client = FakeTwitterClient(clock, followings, {"get_users": 300})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock), cache=UserCache(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
+    twitter.get_users_by_ids([1, 2])
+
+    assert twitter.get_following_counts(list(range(1, 151))) == {i: i for i in range(1, 151)}
+    assert client.requests == ["get_users"] * 3
+
+
+def test_get_user_id_following_since_stops_at_known_ids(mocker: MockerFixture) -> None:
+    """
+    新しくフォローしたユーザが見込み通りの件数なら、保存済みのユーザIDに到達したところで取得をやめること
+    見込みと合わない(フォロー解除もあった)場合は、最後のページまで取得すること
+    """
+    clock = FakeClock(now=1000.0)
+    known = list(range(5000))
+    client = FakeTwitterClient(clock, {1: [10001, 10000] + known}, {"get_users_following": 15})
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=clock))
+    mocker.patch.object(twitter, "_Twitter__client", client)
+
+    following, pages = twitter.get_user_id_following_since(1, Snapshot.from_ids(known), 2)
+    assert sorted(following) == known + [10000, 10001]
+    assert pages == 1
+    assert twitter.checkpoint.load(1) is None
+
+    client.followings[1] = [10001, 10000] + known[1:]
+    following, pages = twitter.get_user_id_following_since(1, Snapshot.from_ids(known), 1)
+    assert sorted(following) == known[1:] + [10000, 10001]
+    assert pages == 6
@@ -0,0 +1,419 @@
+import asyncio
+import threading
+from typing import List
+
+import pytest
+from discord.ext import tasks
+from pytest_mock import MockerFixture
+
+from influ_rader.aio import BoundedExecutor
+from influ_rader.cogs.twitter_cog import TwitterCog
+from influ_rader.db import Db
+from influ_rader.diff import ids_array
+from influ_rader.enrich import Enricher, Profiles
+from influ_rader.error import TwitterRequestError
+from influ_rader.history import FollowHistory
+from influ_rader.jobs import JobQueue
+from influ_rader.notify import DiscordChannelSink, NotificationQueue, Notifier
+from influ_rader.precheck import ChangeDetector
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.schedule import PollScheduler
+from influ_rader.sqlite_db import SqliteDb
+from influ_rader.targets import TargetRegistry
+from influ_rader.tests.fakes import FakeClock, FakeFirestoreClient, FakeTwitterClient
+from influ_rader.trending import TrendIndex
+from influ_rader.twitter import Twitter
+
+
+def tick(cog: TwitterCog, loop: tasks.Loop) -> None:
+    """
+    ループを1回実行し、キューに入ったDiscordへの投稿を送り終えるまで待つ
+    """
+
+    async def run() -> None:
+        await loop.coro(cog)
+        await cog.notifier.join()
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def twitter_client():
+    clock = FakeClock()
+    followings = {1: [10, 11, 12], 2: [20, 21], 3: [30]}
+    return FakeTwitterClient(clock, followings, {"get_users": 300, "get_users_following": 15})
+
+
+@pytest.fixture
+def twitter(mocker: MockerFixture, twitter_client: FakeTwitterClient):
+    twitter = Twitter(bearer_token="test", rate_limiter=RateLimiter(clock=twitter_client.clock))
+    mocker.patch.object(twitter, "_Twitter__client", twitter_client)
+    return twitter
+
+
+@pytest.fixture
+def channel(mocker: MockerFixture):
+    return mocker.AsyncMock()
+
+
+@pytest.fixture
+def cog(mocker: MockerFixture, twitter: Twitter, db: Db, channel):
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    return TwitterCog(bot, twitter, db, ["user1", "user2", "user3"], 0, BoundedExecutor(max_workers=2))
+
+
+def test_diff_users_followings_with_batched_db_requests(
+    cog: TwitterCog, db: Db, firestore_client: FakeFirestoreClient, channel
+) -> None:
+    """
+    全ての対象ユーザのfollowingsを1回のリクエストで取得し、差分を1回のコミットで保存すること
+    投稿は文字数の上限に収まる限り1つのメッセージにまとめること
+    """
+    firestore_client.documents = {"influencers": {"1": {"followings": ["10", "13"]}, "2": {"followings": ["20", "21"]}}}
+
+    tick(cog, TwitterCog.diff_users_followings)
+
+    assert firestore_client.rpcs == ["get_all", "commit"]
+    assert db.get_users_followings([1, 2, 3]) == {1: [10, 11, 12], 2: [20, 21], 3: [30]}
+    messages = [c.args[0] for c in channel.send.call_args_list]
+    assert len(messages) == 1
+    assert messages[0].split("\n") == [
+        "**user1(@user1)**が新しくフォローしたアカウント",
+        "https://twitter.com/user11",
+        "https://twitter.com/user12",
+        "**user3(@user3)**が新しくフォローしたアカウント",
+        "https://twitter.com/user30",
+    ]
+
+
+def test_diff_users_followings_without_changes(cog: TwitterCog, firestore_client: FakeFirestoreClient, channel) -> None:
+    """
+    差分がない場合、DBへの書き込みもDiscordへの投稿もしないこと
+    """
+    firestore_client.documents = {
+        "influencers": {
+            "1": {"followings": ["10", "11", "12"]},
+            "2": {"followings": ["20", "21"]},
+            "3": {"followings": ["30"]},
+        }
+    }
+
+    tick(cog, TwitterCog.diff_users_followings)
+
+    assert firestore_client.rpcs == ["get_all"]
+    channel.send.assert_not_called()
+
+
+def test_diff_users_followings_with_sqlite(mocker: MockerFixture, twitter: Twitter, channel) -> None:
+    """
+    SQLiteをストレージに使った場合も、差分を保存してDiscordに投稿すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    sqlite_db = SqliteDb(":memory:")
+    sqlite_db.save_users_followings({1: [10, 13]}, {})
+    cog = TwitterCog(bot, twitter, sqlite_db, ["user1", "user2", "user3"], 0, BoundedExecutor(max_workers=2))
+
+    tick(cog, TwitterCog.diff_users_followings)
+
+    followings = sqlite_db.get_users_followings([1, 2, 3])
+    assert {k: sorted(v) for k, v in followings.items()} == {1: [10, 11, 12], 2: [20, 21], 3: [30]}
+    assert channel.send.call_count == 1
+    assert channel.send.call_args.args[0].count("が新しくフォローしたアカウント") == 3
+
+
+def test_diff_users_followings_with_enrichment(mocker: MockerFixture, twitter: Twitter, channel) -> None:
+    """
+    Enricherを指定した場合、ループは詳細の取得を待たずに終わり、取得した詳細を添えて投稿すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    enricher = Enricher(twitter, ["description"])
+    cog = TwitterCog(bot, twitter, SqliteDb(), ["user1"], 0, BoundedExecutor(max_workers=2), enricher=enricher)
+    # ループが終わるまで詳細の取得が終わらないように、取得を止めておく
+    profiles = enricher.profiles
+    released = asyncio.Event()
+
+    async def gated_profiles(user_ids: List[int]) -> Profiles:
+        await released.wait()
+        return await profiles(user_ids)
+
+    mocker.patch.object(enricher, "profiles", gated_profiles)
+
+    async def run() -> None:
+        await TwitterCog.diff_users_followings.coro(cog)
+        assert channel.send.call_count == 0
+        released.set()
+        await enricher.join()
+        await cog.notifier.join()
+
+    asyncio.run(run())
+
+    assert channel.send.call_args.args[0].split("\n") == [
+        "**user1(@user1)**が新しくフォローしたアカウント",
+        "https://twitter.com/user10 bio of user10",
+        "https://twitter.com/user11 bio of user11",
+        "https://twitter.com/user12 bio of user12",
+    ]
+
+
+def test_diff_users_followings_records_history(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    保存した差分を履歴に記録し、初回に取得したfollowingsはBASELINEとして記録すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    clock = FakeClock(now=1000.0)
+    history = FollowHistory(":memory:", clock=clock)
+    cog = TwitterCog(
+        bot,
+        twitter,
+        SqliteDb(":memory:"),
+        ["user1", "user2"],
+        0,
+        BoundedExecutor(max_workers=2),
+        scheduler=PollScheduler(clock=clock),
+        history=history,
+    )
+
+    tick(cog, TwitterCog.diff_users_followings)
+    twitter_client.followings[1] = [11, 12, 13, 14]
+    clock.sleep(7 * 24 * 60 * 60)
+    tick(cog, TwitterCog.diff_users_followings)
+
+    assert history.counts() == {FollowHistory.BASELINE: 5, FollowHistory.FOLLOW: 2, FollowHistory.UNFOLLOW: 1}
+    assert [(e.followed_id, e.kind) for e in history.events(1, 0)] == [
+        (13, FollowHistory.FOLLOW),
+        (14, FollowHistory.FOLLOW),
+        (10, FollowHistory.UNFOLLOW),
+    ]
+    assert history.followings_at(1, 1000.0) == [10, 11, 12]
+
+
+def test_diff_users_followings_posts_trending_digest(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    複数の対象ユーザが同じユーザをフォローしたら、対象ユーザごとの差分とは別にまとめて投稿すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    clock = FakeClock(now=1000.0)
+    cog = TwitterCog(
+        bot,
+        twitter,
+        SqliteDb(":memory:"),
+        ["user1", "user2", "user3"],
+        0,
+        BoundedExecutor(max_workers=2),
+        scheduler=PollScheduler(clock=clock),
+        trends=TrendIndex(min_targets=2, clock=clock),
+    )
+    tick(cog, TwitterCog.diff_users_followings)
+    channel.send.reset_mock()
+
+    twitter_client.followings.update({1: [10, 11, 12, 99], 2: [20, 21, 99]})
+    clock.sleep(7 * 24 * 60 * 60)
+    tick(cog, TwitterCog.diff_users_followings)
+
+    messages = [c.args[0] for c in channel.send.call_args_list]
+    assert messages[-1] == "**複数の対象ユーザがフォローしたアカウント**\nhttps://twitter.com/user99 (2人: @user1, @user2)"
+
+
+def test_target_users_are_resolved_in_the_loop(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    起動時にはTwitter APIにリクエストせず、ループの中で対象ユーザを解決すること
+    追加した対象ユーザは次のループから取得すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    sqlite_db = SqliteDb(":memory:")
+    registry = TargetRegistry()
+    cog = TwitterCog(bot, twitter, sqlite_db, ["user1"], 0, BoundedExecutor(max_workers=2), registry=registry)
+    assert twitter_client.requests == []
+
+    tick(cog, TwitterCog.diff_users_followings)
+    registry.add(["user2"])
+    tick(cog, TwitterCog.diff_users_followings)
+
+    assert twitter_client.requests.count("get_users_following") == 2
+    assert sorted(sqlite_db.get_users_followings([1, 2])) == [1, 2]
+
+
+def test_failed_target_is_retried_without_refetching_others(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    一部の対象ユーザのfollowing取得に失敗しても、他の対象ユーザの差分は保存して投稿すること
+    失敗した対象ユーザだけを待ち時間の後に再実行し、完了した対象ユーザは取得し直さないこと
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    clock = FakeClock(now=1000.0)
+    jobs = JobQueue(":memory:", backoff=60, clock=clock)
+    sqlite_db = SqliteDb(":memory:")
+    cog = TwitterCog(bot, twitter, sqlite_db, ["user1", "user2", "user3"], 0, BoundedExecutor(max_workers=2), jobs=jobs)
+    twitter_client.fail_users.append(2)
+
+    tick(cog, TwitterCog.diff_users_followings)
+
+    assert sorted(sqlite_db.get_users_followings([1, 2, 3])) == [1, 3]
+    assert jobs.states() == {1: (JobQueue.DONE, 0), 2: (JobQueue.FAILED, 1), 3: (JobQueue.DONE, 0)}
+    assert channel.send.call_count == 1
+
+    twitter_client.requests.clear()
+    tick(cog, TwitterCog.retry_crawl_jobs)
+    assert twitter_client.requests == []  # 待ち時間が過ぎるまでは再実行しない
+
+    clock.now += 60
+    tick(cog, TwitterCog.retry_crawl_jobs)
+    assert twitter_client.requests.count("get_users_following") == 1
+    assert sorted(sqlite_db.get_users_followings([1, 2, 3])) == [1, 2, 3]
+    assert not jobs.has_open_run()
+    assert channel.send.call_count == 2
+    assert "https://twitter.com/user20" in channel.send.call_args.args[0]
+
+
+def test_unexpected_error_does_not_stop_the_loop(
+    mocker: MockerFixture, cog: TwitterCog, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    ループの中で想定していない例外が発生しても、ログに残して戻り、次のループでは取得を続けること
+    """
+    twitter_client.get_users = mocker.Mock(side_effect=RuntimeError("unexpected"))  # type: ignore[method-assign]
+
+    tick(cog, TwitterCog.diff_users_followings)
+    channel.send.assert_not_called()
+
+    del twitter_client.get_users
+    tick(cog, TwitterCog.diff_users_followings)
+    assert channel.send.call_count == 1
+
+
+def test_waiting_fetches_do_not_block_db_requests(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, db: Db, channel
+) -> None:
+    """
+    following取得がレート制限などで待っている間も、DBへの処理やジョブの記録は別のスレッドプールで実行されること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    cog = TwitterCog(bot, twitter, db, ["user1", "user2", "user3"], 0, BoundedExecutor(max_workers=1))
+    entered, released = threading.Event(), threading.Event()
+    get_users_following = twitter_client.get_users_following
+
+    def waiting_get_users_following(*args, **kwargs):
+        entered.set()
+        released.wait(5)
+        return get_users_following(*args, **kwargs)
+
+    twitter_client.get_users_following = waiting_get_users_following  # type: ignore[method-assign]
+
+    async def run() -> None:
+        task = asyncio.create_task(TwitterCog.diff_users_followings.coro(cog))
+        await asyncio.to_thread(entered.wait, 5)
+        try:
+            states = await asyncio.wait_for(cog.executor.run(cog.jobs.states), 1)
+        finally:
+            released.set()
+        assert set(states) == {1, 2, 3}
+        await task
+        await cog.notifier.join()
+
+    asyncio.run(run())
+    assert cog.jobs.states() == {1: (JobQueue.DONE, 0), 2: (JobQueue.DONE, 0), 3: (JobQueue.DONE, 0)}
+
+
+def test_crawler_receives_all_due_targets_at_once(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    crawlerを指定した場合、実行する全ての対象ユーザを1回でcrawlerに渡し、結果を対象ユーザごとに保存すること
+    crawlerが一部の対象ユーザで失敗した場合は、その対象ユーザのジョブだけを失敗にすること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    jobs = JobQueue(":memory:", backoff=60, clock=FakeClock(now=1000.0))
+    sqlite_db = SqliteDb(":memory:")
+    failing: List[int] = []
+    crawler = mocker.MagicMock()
+    crawler.get_users_id_following = mocker.AsyncMock(
+        side_effect=lambda user_ids: {
+            u: TwitterRequestError() if u in failing else ids_array(twitter_client.followings[u]) for u in user_ids
+        }
+    )
+    targets = ["user1", "user2", "user3"]
+    cog = TwitterCog(bot, twitter, sqlite_db, targets, 0, BoundedExecutor(max_workers=2), jobs=jobs, crawler=crawler)
+
+    tick(cog, TwitterCog.diff_users_followings)
+
+    crawler.get_users_id_following.assert_awaited_once_with([1, 2, 3])
+    assert twitter_client.requests.count("get_users_following") == 0
+    assert sqlite_db.get_users_followings([1, 2, 3]) == {1: [10, 11, 12], 2: [20, 21], 3: [30]}
+    assert jobs.states() == {1: (JobQueue.DONE, 0), 2: (JobQueue.DONE, 0), 3: (JobQueue.DONE, 0)}
+
+    failing.append(2)
+    twitter_client.followings.update({1: [10, 11, 12, 13], 2: [20, 21, 22]})
+    jobs.start_run([1, 2])
+    tick(cog, TwitterCog.retry_crawl_jobs)
+
+    crawler.get_users_id_following.assert_awaited_with([1, 2])
+    assert jobs.states() == {1: (JobQueue.DONE, 0), 2: (JobQueue.FAILED, 1)}
+    assert sqlite_db.get_users_followings([1, 2, 3]) == {1: [10, 11, 12, 13], 2: [20, 21], 3: [30]}
+
+
+def test_precheck_skips_or_partially_crawls_by_following_count(
+    mocker: MockerFixture, twitter: Twitter, twitter_client: FakeTwitterClient, channel
+) -> None:
+    """
+    フォロー数が変わっていない対象ユーザはfollowingを取得せず、増えた対象ユーザは先頭のページだけを取得すること
+    """
+    mocker.patch.object(tasks.Loop, "start")
+    bot = mocker.MagicMock()
+    bot.get_channel.return_value = channel
+    clock = FakeClock(now=1000.0)
+    twitter_client.followings.update({1: list(range(100, 3100)), 2: list(range(200, 2200))})
+    detector = ChangeDetector(clock=clock)
+    scheduler = PollScheduler(clock=clock)
+    sqlite_db = SqliteDb(":memory:")
+    discord_clock = FakeClock()
+    sink = DiscordChannelSink(bot, 0, clock=discord_clock, sleep=discord_clock.async_sleep)
+    notifier = Notifier([NotificationQueue(sink, sleep=discord_clock.async_sleep)])
+    cog = TwitterCog(
+        bot,
+        twitter,
+        sqlite_db,
+        ["user1", "user2"],
+        0,
+        BoundedExecutor(max_workers=2),
+        scheduler=scheduler,
+        detector=detector,
+        notifier=notifier,
+    )
+    tick(cog, TwitterCog.diff_users_followings)
+    assert twitter_client.requests.count("get_users_following") == 5
+
+    twitter_client.requests.clear()
+    saved_requests = mocker.spy(detector, "take_saved_requests")
+    twitter_client.followings[1] = [50] + twitter_client.followings[1]
+    clock.sleep(7 * 24 * 60 * 60 - 1)
+    tick(cog, TwitterCog.diff_users_followings)
+
+    assert twitter_client.requests == ["get_users", "get_users_following", "get_users"]  # フォロー数、following、表示用
+    assert sorted(sqlite_db.get_users_followings([1])[1]) == [50] + list(range(100, 3100))
+    assert "https://twitter.com/user50" in channel.send.call_args.args[0]
+    assert saved_requests.spy_return == 3 + 2  # user1は4ページ中3ページ、user2は2ページとも省略
@@ -0,0 +1,53 @@
+import threading
+from typing import Any, Optional
+
+
+class Transport:
+    """
+    Twitter APIへのHTTP接続を、全てのBearer Tokenのクライアントで共有する層
+
+    tweepyはクライアントごとにrequests.Sessionを作るので、Bearer Tokenが複数あるとホストごとの接続プールも
+    Bearer Tokenの数だけでき、それぞれでTLSのハンドシェイクが必要になる
+    1つのSessionを共有し、接続プールを並列にリクエストするスレッド数以上にしておけば、keep-aliveした接続を使い回せる
+    (プールより多くのスレッドが同時にリクエストすると、溢れた接続は使い終わった時に捨てられてしまう)
+
+    Accept-Encodingには、urllib3が展開できる形式(gzip/deflateと、インストールされていればbrotli/zstd)を全て指定する
+    tweepyはrequestsを使うのでHTTP/1.1のみ(FirestoreはgRPCのHTTP/2の接続をクライアントライブラリが使い回す)
+    """
+
+    POOL_SIZE = 10  # requestsのデフォルトの接続プールの大きさ
+
+    def __init__(self, pool_size: int = POOL_SIZE, compress: bool = True) -> None:
+        self.pool_size = pool_size
+        self.compress = compress
+        self.__session: Optional[Any] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def session(self) -> Any:
+        """
+        共有するrequests.Session(最初に使う時に作る)
+        """
+        with self.__lock:
+            if self.__session is None:
+                self.__session = self.__create_session()
+            return self.__session
+
+    def __create_session(self) -> Any:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import make_headers
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        encoding = make_headers(accept_encoding=True)["accept-encoding"] if self.compress else "identity"
+        session.headers["Accept-Encoding"] = encoding
+        return session
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__session is not None:
+                self.__session.close()
+                self.__session = None
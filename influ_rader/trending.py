@@ -0,0 +1,115 @@
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+from influ_rader.history import FollowEvent, FollowHistory
+from influ_rader.rate_limit import Clock
+from influ_rader.storage import UsersFollowings
+
+
+class CoFollow(NamedTuple):
+    """
+    複数の対象ユーザがwindow秒以内にフォローしたユーザと、フォローした対象ユーザ(フォローした順)
+    """
+
+    user_id: int
+    target_ids: List[int]
+
+
+class TrendIndex:
+    """
+    フォローされたユーザから、直近window秒以内にそのユーザをフォローした対象ユーザへの転置インデックス
+
+    差分(フォロー/フォロー解除)を適用するたびに、変化したユーザの分だけを更新する(O(差分の件数))
+    window秒を過ぎたフォローは、フォローした順に並べたキューの先頭から取り除く
+    フォローした対象ユーザがmin_targets人に達したユーザを、トレンドとして1回の差分ごとにまとめて返す
+
+    初めて差分を適用する対象ユーザは、followings全体が新しいフォローとして渡されるので、トレンドには数えない
+    """
+
+    def __init__(self, window: float = 7 * 24 * 60 * 60, min_targets: int = 3, clock: Optional[Clock] = None) -> None:
+        self.window = window
+        self.min_targets = min_targets
+        self.clock = clock or Clock()
+        # フォローされたユーザID -> {対象ユーザID: フォローした時刻}(フォローした順)
+        self.__index: Dict[int, Dict[int, float]] = {}
+        # (フォローした時刻, フォローされたユーザID, 対象ユーザID)をフォローした順に並べたキュー
+        self.__follows: Deque[Tuple[float, int, int]] = deque()
+        # トレンドとして通知した時の、フォローした対象ユーザの数
+        self.__reported: Dict[int, int] = {}
+        self.__known: Set[int] = set()
+
+    def load(self, targets: Iterable[int], events: Iterable[FollowEvent]) -> None:
+        """
+        記録済みの対象ユーザと、フォロー/フォロー解除のイベント(時刻順)からインデックスを作り直す
+        再起動した場合に、直前までのトレンドを引き継ぐために使う
+        """
+        self.__known.update(targets)
+        for event in events:
+            if event.kind == FollowHistory.FOLLOW:
+                self.__follow(event.at, event.followed_id, event.target_id)
+            elif event.kind == FollowHistory.UNFOLLOW:
+                self.__unfollow(event.followed_id, event.target_id)
+        self.__expire()
+        # 読み込んだ時点ですでにトレンドだったユーザは、通知済みとみなす
+        self.__reported = {f: len(t) for f, t in self.__index.items() if len(t) >= self.min_targets}
+
+    def apply(
+        self, followings: Mapping[int, Iterable[int]], added: UsersFollowings, removed: UsersFollowings
+    ) -> List[CoFollow]:
+        """
+        保存した差分をインデックスに適用し、新しくトレンドになったユーザ(または前回の通知からフォローした対象ユーザが
+        増えたユーザ)を、フォローした対象ユーザの数が多い順に返す
+        """
+        now = self.clock.time()
+        touched: Set[int] = set()
+        for target_id in followings:
+            if target_id not in self.__known:
+                self.__known.add(target_id)
+                continue
+            for followed_id in added.get(target_id, []):
+                self.__follow(now, followed_id, target_id)
+                touched.add(followed_id)
+        for target_id, unfollowed in removed.items():
+            for followed_id in unfollowed:
+                self.__unfollow(followed_id, target_id)
+        self.__expire()
+
+        co_follows: List[CoFollow] = []
+        for followed_id in touched:
+            targets = self.__index.get(followed_id, {})
+            if len(targets) >= self.min_targets and len(targets) > self.__reported.get(followed_id, 0):
+                self.__reported[followed_id] = len(targets)
+                co_follows.append(CoFollow(followed_id, list(targets)))
+        return sorted(co_follows, key=lambda t: (-len(t.target_ids), t.user_id))
+
+    def ranking(self, limit: int = 50) -> List[CoFollow]:
+        """
+        直近window秒以内にmin_targets人以上の対象ユーザがフォローしたユーザを、対象ユーザの数が多い順に返す
+        """
+        self.__expire()
+        ranking = [CoFollow(f, list(t)) for f, t in self.__index.items() if len(t) >= self.min_targets]
+        return sorted(ranking, key=lambda t: (-len(t.target_ids), t.user_id))[:limit]
+
+    def __follow(self, at: float, followed_id: int, target_id: int) -> None:
+        targets = self.__index.setdefault(followed_id, {})
+        targets.pop(target_id, None)
+        targets[target_id] = at
+        self.__follows.append((at, followed_id, target_id))
+
+    def __unfollow(self, followed_id: int, target_id: int) -> None:
+        targets = self.__index.get(followed_id)
+        if targets is None or targets.pop(target_id, None) is None:
+            return
+        if not targets:
+            del self.__index[followed_id]
+            self.__reported.pop(followed_id, None)
+        elif self.__reported.get(followed_id, 0) > len(targets):
+            self.__reported[followed_id] = len(targets)
+
+    def __expire(self) -> None:
+        since = self.clock.time() - self.window
+        while self.__follows and self.__follows[0][0] < since:
+            at, followed_id, target_id = self.__follows.popleft()
+            # フォロー解除済み、または後からフォローし直した場合はインデックスの値が違うのでそのままにする
+            if self.__index.get(followed_id, {}).get(target_id) == at:
+                self.__unfollow(followed_id, target_id)
@@ -1,22 +1,105 @@
-import time
-from typing import List, Union, overload
+import functools
+from array import array
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    overload,
+)
 
-import tweepy
 from loguru import logger
-from tweepy import Paginator, Response, TooManyRequests
 
+from influ_rader.cache import UserCache
+from influ_rader.checkpoint import Checkpoint
+from influ_rader.credentials import ClientFactory, CredentialPool, create_client
+from influ_rader.diff import Snapshot, ids_array
 from influ_rader.error import TwitterRequestError
+from influ_rader.metrics import FOLLOWING_PAGES, TWITTER_REQUEST_SECONDS, TWITTER_REQUESTS
+from influ_rader.rate_limit import RateLimiter
+from influ_rader.transport import Transport
 
+if TYPE_CHECKING:
+    from tweepy import Response
 
-class User(tweepy.User):
-    def __init__(self, data) -> None:
-        super().__init__(data)
+UserKey = TypeVar("UserKey", int, str)
+# 対象ユーザごとのfollowingの取得結果(取得できたユーザID、または失敗した時の例外)
+FollowingResult = Union["array[int]", Exception]
+
+
+class User:
+    """
+    Twitter APIのユーザ(tweepy.Userと同じく、レスポンスのフィールドを属性として参照できる)
+    tweepyを読み込まなくても扱えるように、APIのレスポンスそのもの(dict)だけを保持する
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: Any) -> None:
+        # tweepy.Userを渡された場合も、APIのレスポンスそのもの(dict)を保持する
+        self.data: Dict[str, Any] = data if isinstance(data, dict) else data.data
+
+    @property
+    def id(self) -> int:
+        return int(self.data["id"])
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "data":  # dataを設定する前(unpickle中など)に呼ばれた場合
+            raise AttributeError(name)
+        try:
+            return self.data[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, User):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return self.id
+
+    def __repr__(self) -> str:
+        return f"<User id={self.id} name={self.data.get('name')} username={self.data.get('username')}>"
 
 
 class Twitter:
-    def __init__(self, bearer_token: str) -> None:
-        self.__client = tweepy.Client(bearer_token=bearer_token)
-        self.__retry_interval = 15 * 60  # 15分
+    USERS_LOOKUP_LIMIT = 100  # users lookupエンドポイントで1リクエストあたりに指定できるユーザ数の上限
+
+    FOLLOWING_MAX_RESULTS = 1000  # following取得時に1リクエストで取得できるユーザ数の上限
+
+    def __init__(
+        self,
+        bearer_token: Union[str, Sequence[str]],
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[UserCache] = None,
+        checkpoint: Optional[Checkpoint] = None,
+        client_factory: Optional[ClientFactory] = None,
+        transport: Optional[Transport] = None,
+    ) -> None:
+        """
+        bearer_token: Bearer Token、または複数のBearer Token(リクエストごとに枠が最も残っているものを使う)
+        client_factory: Bearer Tokenからクライアントを作る関数(指定しなければtweepyのクライアントを作る)
+        transport: 全てのBearer Tokenのtweepyのクライアントで共有するHTTP接続(指定しなければ既定の設定で作る)
+        """
+        tokens = [bearer_token] if isinstance(bearer_token, str) else list(bearer_token)
+        # tweepyのクライアントは最初にリクエストする時に作る(tweepyの読み込みを起動時に行わない)
+        # __clientを設定すると、Bearer Tokenごとに作る代わりにそのクライアントを全てのBearer Tokenで使う
+        self.__client: Optional[Any] = None
+        self.transport = transport or Transport()
+        self.__client_factory = client_factory or functools.partial(create_client, transport=self.transport)
+        self.pool = CredentialPool(tokens, rate_limiter or RateLimiter(), self.__create_client)
+        self.cache = cache
+        self.checkpoint = checkpoint or Checkpoint()
+        self.__retry_interval = 15 * 60  # レスポンスにリセット時刻が含まれていなかった場合の待ち時間(15分)
 
     @overload
     def get_user(self, arg: int) -> User:
@@ -30,61 +113,275 @@ class Twitter:
         """
         ユーザ情報を取得する
         arg: ユーザID(int) or ユーザ名(str)
+        """
+        cached = self.cache.get(arg) if self.cache is not None else None
+        if cached is not None:
+            return User(cached)
+        if isinstance(arg, int):
+            res = self.__request("get_user", id=arg)
+        else:
+            res = self.__request("get_user", username=arg)
+        if len(res.errors) != 0:
+            raise TwitterRequestError()
+        user = User(res.data)
+        if self.cache is not None:
+            self.cache.put(user.data)
+        return user
+
+    def get_users_by_ids(self, user_ids: List[int]) -> List[User]:
+        users, _ = self.lookup_users_by_ids(user_ids)
+        return users
+
+    def get_users(self, usernames: List[str]) -> List[User]:
+        users, _ = self.lookup_users(usernames)
+        return users
+
+    def lookup_users_by_ids(self, user_ids: List[int]) -> Tuple[List[User], List[int]]:
+        """
+        ユーザIDのリストからユーザ情報をまとめて取得する
+        見つかったユーザ(入力順)と、見つからなかった/凍結されているユーザIDのタプルを返す
+        """
+        return self.__lookup_users(user_ids, "ids", int, lambda u: int(u.id))
+
+    def lookup_users(self, usernames: List[str]) -> Tuple[List[User], List[str]]:
+        """
+        ユーザ名のリストからユーザ情報をまとめて取得する
+        見つかったユーザ(入力順)と、見つからなかった/凍結されているユーザ名のタプルを返す
+        """
+        return self.__lookup_users(usernames, "usernames", str.lower, lambda u: str(u.username).lower())
+
+    def __lookup_users(
+        self,
+        keys: List[UserKey],
+        param: str,
+        normalize: Callable[[UserKey], UserKey],
+        key_of: Callable[[User], UserKey],
+    ) -> Tuple[List[User], List[UserKey]]:
+        """
+        users lookupエンドポイントを使って、1リクエストあたり最大100件ずつユーザ情報を取得する
+        一部のユーザが見つからなくてもバッチ全体は失敗させず、見つからなかったキーとして返す
+        """
+        unique = list(dict.fromkeys(normalize(k) for k in keys))
+        found: Dict[UserKey, User] = {}
+        if self.cache is not None:
+            for k in unique:
+                cached = self.cache.get(k)
+                if cached is not None:
+                    found[k] = User(cached)
+            unique = [k for k in unique if k not in found]
+        for i in range(0, len(unique), self.USERS_LOOKUP_LIMIT):
+            chunk = unique[i : i + self.USERS_LOOKUP_LIMIT]
+            res = self.__request("get_users", **{param: chunk})
+            for d in res.data or []:
+                user = User(d)
+                found[key_of(user)] = user
+                if self.cache is not None:
+                    self.cache.put(user.data)
+            for e in res.errors:
+                logger.warning(f"Failed to get user `{e.get('value')}`: {e.get('title')} ({e.get('detail')})")
+
+        users = [found[normalize(k)] for k in keys if normalize(k) in found]
+        missing = [k for k in keys if normalize(k) not in found]
+        if missing:
+            logger.warning(f"These users were not found or suspended: `{missing}`")
+        return users, missing
+
+    def get_following_counts(self, user_ids: List[int]) -> Dict[int, int]:
+        """
+        users lookupエンドポイントで、ユーザごとのフォロー数(public_metrics.following_count)をまとめて取得する
+        変化の検出に使うので、キャッシュは使わずに毎回取得する(取得したユーザ情報でキャッシュは更新する)
+        """
+        counts: Dict[int, int] = {}
+        unique = list(dict.fromkeys(user_ids))
+        for i in range(0, len(unique), self.USERS_LOOKUP_LIMIT):
+            chunk = unique[i : i + self.USERS_LOOKUP_LIMIT]
+            res = self.__request("get_users", ids=chunk, user_fields=["public_metrics"])
+            for d in res.data or []:
+                user = User(d)
+                metrics = getattr(user, "public_metrics", None) or {}
+                if "following_count" in metrics:
+                    counts[int(user.id)] = int(metrics["following_count"])
+                if self.cache is not None:
+                    self.cache.put(user.data)
+            for e in res.errors:
+                logger.warning(f"Failed to get user `{e.get('value')}`: {e.get('title')} ({e.get('detail')})")
+        return counts
+
+    def get_users_with_fields(self, user_ids: List[int], user_fields: Sequence[str]) -> List[User]:
+        """
+        users lookupエンドポイントで、user_fieldsに指定したフィールドを含むユーザ情報をまとめて取得する
+        通常のユーザ情報とフィールドが異なるので、キャッシュは使わずキャッシュも更新しない
+        見つからなかった/凍結されているユーザは結果に含めない
+        """
+        users: List[User] = []
+        unique = list(dict.fromkeys(user_ids))
+        for i in range(0, len(unique), self.USERS_LOOKUP_LIMIT):
+            chunk = unique[i : i + self.USERS_LOOKUP_LIMIT]
+            res = self.__request("get_users", ids=chunk, user_fields=list(user_fields))
+            users.extend(User(d) for d in res.data or [])
+        return users
+
+    def warm_up(self) -> None:
+        """
+        tweepyを読み込んで全てのBearer Tokenのクライアントを作っておく
+        (最初のリクエストを待たせないように、起動後に裏で呼び出す)
+        """
+        for credential in self.pool.credentials:
+            _ = credential.client
+
+    def __create_client(self, bearer_token: str) -> Any:
+        if self.__client is not None:
+            return self.__client
+        return self.__client_factory(bearer_token)
 
-        Twitter APIの制限に引っかかった際にAPIリクエストをリトライできるようにループ内でリクエスト処理を行う
+    def __request(self, endpoint: str, **kwargs: Any) -> "Response":
         """
+        枠が最も残っているBearer Tokenを選び、レート制限の枠を確保してからAPIリクエストを行う
+        Twitter APIの制限に引っかかった際は、他のBearer Token(全て使い切っていればリセット時刻まで待って)でリトライする
+        401が返された(失効した)Bearer Tokenはしばらく使わずに、他のBearer Tokenでリトライする
+        それ以外のtweepyの例外(5xx、400、403、404、接続エラーなど)はTwitterRequestErrorにして送出する
+        """
+        from tweepy import TooManyRequests, TweepyException, Unauthorized
+
         for i in range(10):  # リトライ上限は10回
+            credential = self.pool.acquire(endpoint)
+            client = credential.client
             try:
-                res = self.__client.get_user(id=arg) if isinstance(arg, int) else self.__client.get_user(username=arg)
-            except TooManyRequests:
-                logger.warning("Twitter API request limit reached. Wait 15 minitue and retry.")
-                time.sleep(self.__retry_interval)  # 15分待つ
+                with TWITTER_REQUEST_SECONDS.time(endpoint=endpoint):
+                    res = getattr(client, endpoint)(**kwargs)
+            except TooManyRequests as e:
+                TWITTER_REQUESTS.inc(endpoint=endpoint, result="rate_limited")
+                credential.record(endpoint, "rate_limited")
+                logger.warning(
+                    f"Twitter API request limit reached on `{endpoint}` with `{credential.name}`. "
+                    "Retry with another token or after reset."
+                )
+                credential.rate_limiter.exhaust(endpoint, e.response.headers, self.__retry_interval)
+            except Unauthorized:
+                TWITTER_REQUESTS.inc(endpoint=endpoint, result="unauthorized")
+                credential.record(endpoint, "unauthorized")
+                self.pool.revoke(credential)
+            except TweepyException as e:
+                TWITTER_REQUESTS.inc(endpoint=endpoint, result="failed")
+                credential.record(endpoint, "failed")
+                logger.warning(f"Failed to request `{endpoint}` with `{credential.name}`: {e!r}")
+                raise TwitterRequestError() from e
             else:
-                if len(res.errors) != 0:
-                    raise TwitterRequestError()
-                return User(res.data)
-        logger.error("Failed to get user data for 10 times due to some reason...")
+                result = "error" if res.errors else "ok"
+                TWITTER_REQUESTS.inc(endpoint=endpoint, result=result)
+                credential.record(endpoint, result)
+                credential.rate_limiter.update(endpoint, getattr(client, "last_response_headers", None))
+                return res
+        logger.error(f"Failed to request `{endpoint}` for 10 times due to some reason...")
         raise TwitterRequestError()
 
-    # TODO: ジェネリクスとかでget_usersメソッドと統合する
-    def get_users_by_ids(self, user_ids: List[int]) -> List[User]:
-        try:
-            users = [self.get_user(i) for i in user_ids]
-        except TwitterRequestError:
-            logger.exception("Failed to get users info from Twitter API")
-            raise
-        return users
+    def save_cache(self) -> None:
+        if self.cache is not None:
+            self.cache.save()
+            logger.info(f"User cache stats: `{self.cache.stats()}`")
+        logger.info(f"Bearer token stats: `{self.pool.stats()}`")
 
-    def get_users(self, usernames: List[str]) -> List[User]:
-        try:
-            users = [self.get_user(u) for u in usernames]
-        except TwitterRequestError:
-            logger.exception("Failed to get users info from Twitter API")
-            raise
-        return users
+    def iter_user_id_following(self, user_id: int) -> Generator["array[int]", None, None]:
+        """
+        ユーザのfollowingのユーザIDを、1ページずつ64bit整数の配列としてyieldする
 
-    def get_user_id_following(self, user_id: int) -> List[int]:
-        following: List[int] = []
-        try:
-            for res in Paginator(self.__client.get_users_following, id=user_id, max_results=1000):
-                r: Response = res  # 型付け
-                if len(r.errors) != 0:
-                    raise TwitterRequestError()
-                following += [u.id for u in [User(d) for d in r.data]]
-        except TooManyRequests:
-            logger.exception("Failed to get user id following data because of Twitter API threshold")
-            raise TwitterRequestError()
-        except TwitterRequestError:
-            raise
+        取得できたページごとに次のページのトークンをcheckpointに記録する
+        途中で失敗した場合、次に呼び出した時は記録済みのユーザIDを最初のページとしてyieldし、続きのページから取得する
+        最後のページまで取得できたら記録を消す
+        """
+        pagination_token: Optional[str] = None
+        progress = self.checkpoint.load(user_id)
+        if progress is not None:
+            pagination_token, ids = progress
+            logger.info(f"Resume getting following of user id `{user_id}` from {len(ids)} ids")
+            yield ids
+        while True:
+            params: Dict[str, Any] = {"id": user_id, "max_results": self.FOLLOWING_MAX_RESULTS}
+            if pagination_token is not None:
+                params["pagination_token"] = pagination_token
+            res = self.__request("get_users_following", **params)
+            if len(res.errors) != 0:
+                logger.error(f"Failed to get following from Twitter API: `{res.errors}`")
+                raise TwitterRequestError()
+            # ユーザIDを読むだけなので、Userオブジェクトは作らない
+            page = ids_array(int(d["id"]) for d in res.data or [])
+            FOLLOWING_PAGES.inc()
+            pagination_token = res.meta.get("next_token")
+            if not pagination_token:
+                self.checkpoint.clear(user_id)
+                yield page
+                return
+            self.checkpoint.save_page(user_id, pagination_token, page)
+            yield page
+
+    def get_user_id_following(self, user_id: int) -> "array[int]":
+        following = ids_array()
+        for page in self.iter_user_id_following(user_id):
+            following.extend(page)
         return following
 
-    def get_users_id_following(self, user_ids: List[int]) -> dict[int, List[int]]:
-        users_following: dict[int, List[int]] = {}
-        for user_id in user_ids:
-            try:
-                following = self.get_user_id_following(user_id)
-                users_following[user_id] = following
-            except TwitterRequestError:
-                logger.exception("Failed to get following from Twitter API")
-                raise
+    def get_user_id_following_since(self, user_id: int, known: Snapshot, expected_new: int) -> Tuple["array[int]", int]:
+        """
+        保存されているfollowing(known)から、新たにexpected_new件フォローしただけだと見込まれるユーザのfollowingを取得する
+        戻り値は(followingのユーザID, 取得したページ数)のタプル
+
+        followingは新しくフォローした順に返されるので、先頭のページからknownに含まれないユーザIDを集め、
+        knownに含まれるユーザIDまで到達した時点で新しいユーザIDがちょうどexpected_new件なら、
+        フォロー解除はなかったことになるので、残りのページは取得せずにknownと合わせて返す
+        見込みと合わなければ(フォロー解除があった場合など)、最後のページまで取得する
+        """
+        following = ids_array()
+        new = ids_array()
+        reached_known = False
+        pages = 0
+        iterator: Generator["array[int]", None, None] = self.iter_user_id_following(user_id)
+        for page in iterator:
+            pages += 1
+            following.extend(page)
+            for i in page:
+                if i in known:
+                    reached_known = True
+                else:
+                    new.append(i)
+            if reached_known and len(new) == expected_new:
+                iterator.close()
+                self.checkpoint.clear(user_id)
+                merged = ids_array(known)
+                merged.extend(new)
+                return merged, pages
+        return following, pages
+
+    def get_users_id_following(self, user_ids: List[int]) -> dict[int, "array[int]"]:
+        """
+        複数ユーザのfollowingをまとめて取得する(いずれかのユーザで失敗した場合は、その例外を送出する)
+        """
+        users_following: Dict[int, "array[int]"] = {}
+        for user_id, result in self.get_users_id_following_results(user_ids).items():
+            if isinstance(result, Exception):
+                raise result
+            users_following[user_id] = result
         return users_following
+
+    def get_users_id_following_results(self, user_ids: List[int]) -> Dict[int, FollowingResult]:
+        """
+        複数ユーザのfollowingをまとめて取得し、ユーザごとに取得したユーザIDか失敗した時の例外を入力順に返す
+
+        following取得は15分あたりのリクエスト数が少ないため、各ユーザのページを順番に1ページずつリクエストする
+        ウィンドウ内の枠を使い切ったらリセット時刻まで待って続きのページを取得するので、
+        全ユーザのページ数の合計に対して最小のウィンドウ数で取得が終わる
+        あるユーザで失敗しても、他のユーザの取得は続ける(失敗したユーザの途中までのページはcheckpointに残る)
+        """
+        users_following = {user_id: ids_array() for user_id in user_ids}
+        errors: Dict[int, Exception] = {}
+        pages = deque((user_id, self.iter_user_id_following(user_id)) for user_id in user_ids)
+        while pages:
+            user_id, iterator = pages.popleft()
+            try:
+                page = next(iterator, None)
+            except Exception as e:
+                errors[user_id] = e
+                continue
+            if page is not None:
+                users_following[user_id].extend(page)
+                pages.append((user_id, iterator))
+        return {user_id: errors.get(user_id, users_following[user_id]) for user_id in user_ids}
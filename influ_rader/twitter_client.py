@@ -0,0 +1,35 @@
+import threading
+from typing import Any, Mapping, Optional
+
+import requests
+import tweepy
+from tweepy import TooManyRequests
+
+
+class Client(tweepy.Client):
+    """
+    直近のレスポンスヘッダ(レート制限の情報を含む)をスレッドごとに保持するtweepy.Client
+    tweepyの読み込みには時間がかかるので、このモジュールはTwitterが最初にリクエストする時に読み込む
+    """
+
+    def __init__(self, bearer_token: str, session: Optional[requests.Session] = None) -> None:
+        """
+        session: 他のクライアントと共有するSession(指定しなければtweepyがクライアントごとに作る)
+        """
+        super().__init__(bearer_token=bearer_token)
+        if session is not None:
+            self.session = session
+        self.__local = threading.local()
+
+    @property
+    def last_response_headers(self) -> Optional[Mapping[str, Any]]:
+        return getattr(self.__local, "headers", None)
+
+    def request(self, method, route, params=None, json=None, user_auth=False):
+        try:
+            response = super().request(method, route, params=params, json=json, user_auth=user_auth)
+        except TooManyRequests as e:
+            self.__local.headers = e.response.headers
+            raise
+        self.__local.headers = response.headers
+        return response